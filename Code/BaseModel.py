@@ -4,6 +4,8 @@
 # imports all openGL functions
 from OpenGL.GL import *
 
+import ctypes
+
 # import a bunch of helper functions
 from matutils import *
 
@@ -14,6 +16,13 @@ from mesh import Mesh
 from shaders import *
 from texture import Texture
 
+# the render passes, drawn in this order by the render queue of the scene. Models in the opaque pass whose
+# material is transparent are moved to the blended pass.
+PASS_BACKGROUND = 0
+PASS_OPAQUE = 1
+PASS_BLENDED = 2
+PASS_OVERLAY = 3
+
 
 class BaseModel:
     """
@@ -21,7 +30,7 @@ class BaseModel:
     Inherit from this to create new models.
     """
 
-    def __init__(self, scene, M=poseMatrix(), mesh=Mesh(), color=[1., 1., 1.], primitive=GL_TRIANGLES, visible=True):
+    def __init__(self, scene, M=poseMatrix(), mesh=Mesh(), color=[1., 1., 1.], primitive=GL_TRIANGLES, visible=True, vertex_format=None):
         """
         Initialises the model data and stores the scene reference.
         :param scene: the scene object
@@ -30,6 +39,8 @@ class BaseModel:
         :param color: the color of the object
         :param primitive: the primitive to use for drawing, e.g. GL_TRIANGLES, GL_QUADS, GL_POINTS, etc.
         :param visible: whether the model is visible or not
+        :param vertex_format: [optional] a VertexFormat to store all vertex attributes in one interleaved buffer,
+        by default each attribute has its own float32 VBO
         """
 
         print('+ Initializing {}'.format(self.__class__.__name__))
@@ -37,6 +48,9 @@ class BaseModel:
         # if this flag is set to False, the model is not rendered
         self.visible = visible
 
+        # the render pass in which the model is drawn
+        self.render_pass = PASS_OPAQUE
+
         # store the scene reference
         self.scene = scene
 
@@ -62,6 +76,15 @@ class BaseModel:
         # dict of attributes
         self.attributes = {}
 
+        # the layout of the vertex buffer, see vertexFormat.py
+        self.vertex_format = vertex_format
+
+        # the matrix mapping quantised vertex positions back to model coordinates, applied after the model matrix
+        self.vertex_transform = None
+
+        # the static batch drawing this model, if any, which is rebuilt when the model matrix is changed
+        self.batch = None
+
         # store the position of the model in the scene
         self.M = M
 
@@ -71,6 +94,34 @@ class BaseModel:
         # this buffer will be used to store indices, if using shared vertex representation
         self.index_buffer = None
 
+        # the (number of indices, byte offset) of each level of detail in the index buffer, and the level drawn
+        self.lod_ranges = []
+        self.lod = 0
+
+        # the faces of the cube map in which the model is drawn when the scene renders a layered cube map, one bit
+        # per face (see EnvironmentMappingTexture)
+        self.face_mask = 0
+
+    @property
+    def M(self):
+        """
+        The model matrix, giving the position of the model in the scene.
+        """
+        return self._M
+
+    @M.setter
+    def M(self, M):
+        previous = getattr(self, '_M', None)
+        self._M = M
+
+        # the world coordinates stored in the static batch are no longer valid
+        if self.batch is not None:
+            self.batch.invalidate()
+
+        # the environment maps refresh the faces in which the model was or is now visible
+        if previous is not None:
+            self.scene.model_moved(self, previous)
+
     def initialise_vbo(self, name, data):
         """
         Initialises a VBO for the given attribute name and data.
@@ -88,7 +139,7 @@ class BaseModel:
 
         # bind the location of the attribute in the GLSL program to the next index
         # the name of the location must correspond to a 'in' variable in the GLSL vertex shader code
-        self.attributes[name] = len(self.vbos)
+        self.attributes[name] = len(self.attributes)
 
         # create a buffer object
         self.vbos[name] = glGenBuffers(1)
@@ -107,6 +158,45 @@ class BaseModel:
         # and we set the data in the buffer as the vertex array
         glBufferData(GL_ARRAY_BUFFER, data, GL_STATIC_DRAW)
 
+    def initialise_interleaved_vbo(self):
+        """
+        Initialises a single VBO holding all vertex attributes of the mesh, packed and interleaved according to
+        the vertex format of the model, and links each attribute to its offset in the buffer.
+        :return: None
+        """
+        arrays = [(name, data) for name, data in self.vertex_arrays() if data is not None]
+        if len(arrays) == 0:
+            return
+
+        data, layout, stride, self.vertex_transform = self.vertex_format.pack(arrays)
+
+        print('Initialising interleaved VBO ({} format, {} bytes per vertex)'.format(self.vertex_format.name, stride))
+
+        self.vbos['vertices'] = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbos['vertices'])
+        glBufferData(GL_ARRAY_BUFFER, data, GL_STATIC_DRAW)
+
+        # each attribute reads its components at its offset in each row of the buffer
+        for name, size, gl_type, normalized, offset in layout:
+            self.attributes[name] = len(self.attributes)
+            glEnableVertexAttribArray(self.attributes[name])
+            glVertexAttribPointer(index=self.attributes[name], size=size, type=gl_type, normalized=normalized,
+                                  stride=stride, pointer=ctypes.c_void_p(offset))
+
+    def vertex_arrays(self):
+        """
+        Returns the vertex attributes of the mesh, in the order of their locations.
+        :return: a list of tuples (attribute name, data array or None)
+        """
+        return [
+            ('position', self.mesh.vertices),
+            ('normal', self.mesh.normals),
+            ('color', self.mesh.colors),
+            ('texCoord', self.mesh.textureCoords),
+            ('tangent', self.mesh.tangents),
+            ('binormal', self.mesh.binormals),
+        ]
+
     def bind_shader(self, shader):
         """
         Binds a shader program to this model.
@@ -132,29 +222,53 @@ class BaseModel:
         """
 
         # bind the VAO to retrieve all buffers and rendering context
-        glBindVertexArray(self.vao)
+        render_state.bind_vertex_array(self.vao)
         
         if self.mesh.vertices is None:
             print('(W) Warning in {}.bind(): No vertex array!'.format(self.__class__.__name__))
 
-        # initialise vertex position VBO and link to shader program attribute
-        self.initialise_vbo('position', self.mesh.vertices)
-        self.initialise_vbo('normal', self.mesh.normals)
-        self.initialise_vbo('color', self.mesh.colors)
-        self.initialise_vbo('texCoord', self.mesh.textureCoords)
-        self.initialise_vbo('tangent', self.mesh.tangents)
-        self.initialise_vbo('binormal', self.mesh.binormals)
+        # initialise the vertex attribute VBO(s) and link them to the shader program attributes
+        if self.vertex_format is not None:
+            self.initialise_interleaved_vbo()
+        else:
+            for name, data in self.vertex_arrays():
+                self.initialise_vbo(name, data)
 
-        # if indices are provided, put them in a buffer too
+        # if indices are provided, put them in a buffer too, followed by the faces of the levels of detail
         if self.mesh.faces is not None:
+            levels = [np.asarray(faces, dtype=np.uint32).ravel() for faces in [self.mesh.faces] + list(self.mesh.lods)]
+            offsets = np.cumsum([0] + [indices.shape[0] for indices in levels[:-1]])
+            self.lod_ranges = [(indices.shape[0], 4 * int(offset)) for indices, offset in zip(levels, offsets)]
+
             self.index_buffer = glGenBuffers(1)
             glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
-            glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.mesh.faces, GL_STATIC_DRAW)
+            glBufferData(GL_ELEMENT_ARRAY_BUFFER, np.concatenate(levels), GL_STATIC_DRAW)
 
         # finally unbind the VAO and VBO when we're done to avoid side effects
-        glBindVertexArray(0)
+        render_state.bind_vertex_array(0)
         glBindBuffer(GL_ARRAY_BUFFER, 0)
 
+    def local_bounds(self):
+        """
+        Returns the bounding volumes of the model, before the model matrix is applied.
+        :return: a tuple (box, sphere) with the min and max corners of the box and the center and radius of the
+        sphere, or None if the mesh has no bounds
+        """
+        if self.mesh.bounds is None:
+            return None
+        return self.mesh.bounds, self.mesh.sphere
+
+    def world_bounds(self):
+        """
+        Returns the bounding volumes of the model transformed by its model matrix.
+        :return: a tuple (box, sphere) in world coordinates, or None if the mesh has no bounds
+        """
+        bounds = self.local_bounds()
+        if bounds is None:
+            return None
+        boxes, spheres = transformBounds(bounds[0][None], bounds[1][None], np.asarray(self.M)[None])
+        return boxes[0], spheres[0]
+
     def draw(self, Mp=poseMatrix()):
         """
         Draws the model using OpenGL functions.
@@ -171,30 +285,84 @@ class BaseModel:
                 print('(W) Warning in {}.draw(): No vertex array!'.format(self.__class__.__name__))
 
             # bind the Vertex Array Object so that all buffers are bound correctly and following operations affect them
-            glBindVertexArray(self.vao)
+            render_state.bind_vertex_array(self.vao)
 
             # setup the shader program and provide it the Model, View and Projection matrices to use
-            # for rendering this model
-            self.shader.bind(
+            # for rendering this model, with the variant drawing in all faces when rendering a layered cube map
+            shader = self.shader.layered_variant() if self.scene.layered else self.shader
+            shader.bind(
                 model=self,
-                M=np.matmul(Mp, self.M)
+                M=self.model_matrix(Mp)
             )
+            if self.scene.layered:
+                shader.uniforms['face_mask'].bind_int(self.face_mask)
 
             # bind all textures. Note that your shader needs to handle each one with a sampler object.
             for unit, tex in enumerate(self.mesh.textures):
-                glActiveTexture(GL_TEXTURE0 + unit)
-                tex.bind()
+                render_state.bind_texture(unit, tex)
 
-            # check whether the data is stored as vertex array or index array
-            if self.mesh.faces is not None:
-                # draw the data in the buffer using the index array
-                glDrawElements(self.primitive, self.mesh.faces.flatten().shape[0], GL_UNSIGNED_INT, None )
-            else:
-                # draw the data in the buffer using the vertex array ordering only.
-                glDrawArrays(self.primitive, 0, self.mesh.vertices.shape[0])
+            # the level of detail is chosen from the camera, and kept when drawing in the shadow or environment maps
+            if self.scene.main_pass:
+                self.lod = self.select_lod()
+
+            # the VAO is left bound, so that the next model drawn with the same VAO does not bind it again
+            self.draw_primitives()
+
+    def select_lod(self):
+        """
+        Chooses the level of detail to draw from the height in pixels of the bounding sphere of the model, projected
+        with the perspective projection of the camera at its distance from the camera, in the window. The model switches
+        to the next level each time the height goes under one of the scene.lod_thresholds. This is only called in the
+        main pass, see Scene.draw_models(), as the projections of the other passes differ.
+        :return: the level of detail, 0 for the full resolution mesh
+        """
+        if len(self.lod_ranges) <= 1:
+            return 0
+
+        if self.scene.forced_lod is not None:
+            return min(self.scene.forced_lod, len(self.lod_ranges) - 1)
+
+        bounds = self.world_bounds()
+        if bounds is None:
+            return 0
 
-            # unbind the shader to avoid side effects
-            glBindVertexArray(0)
+        # the full mesh is drawn when the camera is inside the sphere
+        center, radius = bounds[1][:3], bounds[1][3]
+        depth = -np.dot(self.scene.camera.V[2], homog(center))
+        if depth <= radius:
+            return 0
+
+        height = radius * abs(self.scene.P[1, 1]) * self.scene.window_size[1] / depth
+        level = sum(1 for threshold in self.scene.lod_thresholds if height < threshold)
+        return min(level, len(self.lod_ranges) - 1)
+
+    def model_matrix(self, Mp=poseMatrix()):
+        """
+        Returns the model matrix given to the shader, which also maps quantised vertex positions back to model
+        coordinates.
+        :param Mp: The model matrix of the parent object, for composite objects.
+        :return: the model matrix
+        """
+        M = np.matmul(Mp, self.M)
+        if self.vertex_transform is not None:
+            M = np.matmul(M, self.vertex_transform)
+        return M
+
+    def draw_primitives(self):
+        """
+        Issues the draw call for the model, once the VAO, shader and textures are bound.
+        :return: None
+        """
+
+        # check whether the data is stored as vertex array or index array
+        if self.mesh.faces is not None:
+            # draw the data in the buffer using the index array of the level of detail
+            count, offset = self.lod_ranges[self.lod]
+            glDrawElements(self.primitive, count, GL_UNSIGNED_INT, ctypes.c_void_p(offset))
+            self.scene.count_triangles(self.lod, count // self.mesh.faces.shape[1])
+        else:
+            # draw the data in the buffer using the vertex array ordering only.
+            glDrawArrays(self.primitive, 0, self.mesh.vertices.shape[0])
 
     def vbo__del__(self):
         """
@@ -214,7 +382,7 @@ class DrawModelFromMesh(BaseModel):
     Base class for all models, inherit from this to create new models
     '''
 
-    def __init__(self, scene, M, mesh, name=None, shader=None, visible=True):
+    def __init__(self, scene, M, mesh, name=None, shader=None, visible=True, static=False, vertex_format=None):
         """
         Initialises the model data and stores the scene reference.
         :param scene: the scene object
@@ -223,9 +391,15 @@ class DrawModelFromMesh(BaseModel):
         :param name: the name of the model
         :param shader: the shader program to use for rendering this model
         :param visible: whether the model is visible or not
+        :param static: [optional] whether the model is drawn by a StaticBatch, in which case its mesh is not
+        uploaded and its shader is compiled by the batch
+        :param vertex_format: [optional] a VertexFormat to store the vertex attributes in one interleaved buffer
         """
 
-        BaseModel.__init__(self, scene=scene, M=M, mesh=mesh, visible=visible)
+        BaseModel.__init__(self, scene=scene, M=M, mesh=mesh, visible=visible, vertex_format=vertex_format)
+
+        # static models are merged in a StaticBatch, see staticBatch.py
+        self.static = static
 
         # store the name of the model
         if name is not None:
@@ -242,8 +416,140 @@ class DrawModelFromMesh(BaseModel):
         else:
             print('(E) Error in DrawModelFromObjFile.__init__(): index array must have 3 (triangles) or 4 (quads) columns, found {}!'.format(self.indices.shape[1]))
 
+        # the batch draws static models from its own buffers
+        if self.static:
+            self.shader = shader
+            return
+
         self.bind()
 
         # if a shader is provided, we bind it
         if shader is not None:
             self.bind_shader(shader)
+
+
+class InstancedModel(DrawModelFromMesh):
+    '''
+    Class for drawing many copies of the same mesh in a single draw call. The mesh is uploaded once, and the
+    model matrix of each instance is stored in an instance buffer read once per instance (glVertexAttribDivisor).
+    Use with a shader reading the instance_M and instance_MiT attributes, e.g. InstancedPhongShader.
+    '''
+
+    def __init__(self, scene, instances, mesh, name=None, shader=None, visible=True, vertex_format=None):
+        """
+        Initialises the model data and stores the scene reference.
+        :param scene: the scene object
+        :param instances: the list of model matrices, one for each instance
+        :param mesh: the mesh object to draw
+        :param name: the name of the model
+        :param shader: the shader program to use for rendering this model
+        :param visible: whether the model is visible or not
+        :param vertex_format: [optional] a VertexFormat to store the vertex attributes in one interleaved buffer
+        """
+
+        # the model matrices of all instances, updated with set_instances()
+        self.instances = np.array(instances, dtype='f')
+
+        # the bounding volumes of all instances together, updated with set_instances()
+        self.bounds = None
+
+        # the model matrix M is applied on top of the instance matrices
+        DrawModelFromMesh.__init__(self, scene=scene, M=poseMatrix(), mesh=mesh, name=name, shader=shader, visible=visible,
+                                   vertex_format=vertex_format)
+
+    def bind(self):
+        """
+        Stores the vertex data in VBOs like BaseModel.bind(), and adds the instance buffers.
+        A mat4 attribute takes 4 consecutive locations (one per column) and a mat3 attribute 3 locations.
+        :return: None
+        """
+
+        BaseModel.bind(self)
+
+        render_state.bind_vertex_array(self.vao)
+
+        location = len(self.attributes)
+        for name, columns in [('instance_M', 4), ('instance_MiT', 3)]:
+            self.attributes[name] = location
+            self.vbos[name] = glGenBuffers(1)
+            glBindBuffer(GL_ARRAY_BUFFER, self.vbos[name])
+
+            # each column is a vector attribute, advanced once per instance instead of once per vertex
+            for column in range(columns):
+                glEnableVertexAttribArray(location + column)
+                glVertexAttribPointer(index=location + column, size=columns, type=GL_FLOAT, normalized=False,
+                                      stride=4 * columns * columns, pointer=ctypes.c_void_p(4 * columns * column))
+                glVertexAttribDivisor(location + column, 1)
+
+            location += columns
+
+        render_state.bind_vertex_array(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        self.set_instances(self.instances)
+
+    def set_instances(self, instances):
+        """
+        Uploads the model matrices of the instances to the GPU.
+        :param instances: the list of model matrices, one for each instance
+        :return: None
+        """
+
+        self.instances = np.array(instances, dtype='f').reshape(-1, 4, 4)
+
+        # quantised vertex positions are mapped back to model coordinates by each instance matrix
+        instances = self.instances
+        if self.vertex_transform is not None:
+            instances = np.matmul(instances, self.vertex_transform)
+
+        # the inverse-transpose of the model matrices, used to transform the normals
+        MiT = np.linalg.inv(instances[:, :3, :3]).transpose(0, 2, 1)
+
+        # GLSL matrices are stored column by column, so we upload the transpose of the numpy matrices
+        for name, data in [('instance_M', instances), ('instance_MiT', MiT)]:
+            glBindBuffer(GL_ARRAY_BUFFER, self.vbos[name])
+            glBufferData(GL_ARRAY_BUFFER, np.ascontiguousarray(data.transpose(0, 2, 1), dtype='f'), GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        # the box containing the boxes of all instances, and a sphere containing their spheres
+        self.bounds = None
+        n = self.instances.shape[0]
+        if self.mesh.bounds is not None and n > 0:
+            boxes, spheres = transformBounds(
+                np.repeat(self.mesh.bounds[None], n, axis=0), np.repeat(self.mesh.sphere[None], n, axis=0), self.instances)
+            box = np.array([boxes[:, 0].min(axis=0), boxes[:, 1].max(axis=0)])
+            center = box.mean(axis=0)
+            radius = (np.linalg.norm(spheres[:, :3] - center, axis=1) + spheres[:, 3]).max()
+            self.bounds = box, np.append(center, radius)
+
+    def model_matrix(self, Mp=poseMatrix()):
+        """
+        Returns the model matrix shared by all instances, the quantised positions are mapped back by the
+        instance matrices (see set_instances()).
+        :param Mp: The model matrix of the parent object, for composite objects.
+        :return: the model matrix
+        """
+        return np.matmul(Mp, self.M)
+
+    def local_bounds(self):
+        """
+        Returns the bounding volumes of all instances together, before the model matrix is applied.
+        :return: a tuple (box, sphere), or None if there is no instance
+        """
+        return self.bounds
+
+    def draw_primitives(self):
+        """
+        Draws all instances in a single call.
+        :return: None
+        """
+
+        if self.instances.shape[0] == 0:
+            return
+
+        if self.mesh.faces is not None:
+            count, offset = self.lod_ranges[self.lod]
+            glDrawElementsInstanced(self.primitive, count, GL_UNSIGNED_INT, ctypes.c_void_p(offset), self.instances.shape[0])
+            self.scene.count_triangles(self.lod, count // self.mesh.faces.shape[1] * self.instances.shape[0])
+        else:
+            glDrawArraysInstanced(self.primitive, 0, self.mesh.vertices.shape[0], self.instances.shape[0])
@@ -4,11 +4,33 @@ from OpenGL.GL import *
 from matutils import *
 
 from mesh import Mesh
-from BaseModel import DrawModelFromMesh
-from shaders import BaseShaderProgram,PhongShader
+from BaseModel import DrawModelFromMesh, PASS_OVERLAY
+from shaders import BaseShaderProgram,PhongShader,render_state
 from texture import Texture
 from framebuffer import Framebuffer
 
+# the number of cascades of the shadow maps, and the most the shaders handle
+CASCADES = 3
+MAX_CASCADES = 4
+
+# the size in texels of each cascade
+SHADOW_MAP_SIZE = 1024
+
+# the distance from the camera up to which shadows are drawn
+SHADOW_DISTANCE = 60.0
+
+# the distance towards the light from the slice of a cascade within which models cast shadows in the cascade
+SHADOW_CASTER_DISTANCE = 50.0
+
+# the blend between the logarithmic (1) and uniform (0) split of the cascades
+CASCADE_SPLIT_LAMBDA = 0.75
+
+# the size in texels of the map of the static casters kept by the cached shadow maps, covering all casters
+STATIC_SHADOW_MAP_SIZE = 4096
+
+# the margin around the casters covered by the map of the static casters
+STATIC_SHADOW_MARGIN = 5.0
+
 
 def normalize(v):
     return v / np.linalg.norm(v)
@@ -43,33 +65,49 @@ class ShowTextureShader(BaseShaderProgram):
 
 
 class ShadowMappingShader(PhongShader):
+    """
+    Phong shading with the shadows of a CascadedShadowMap. The fragment shader picks the first cascade whose split
+    distance is beyond the depth of the fragment, and looks it up with the matrix of that cascade.
+    """
     def __init__(self, shadow_map=None):
         PhongShader.__init__(self, name='shadow_mapping')
         self.add_uniform('shadow_map')
-        #self.add_uniform('old_map')
-        self.add_uniform('shadow_map_matrix')
+        self.add_uniform('cascades')
+        self.add_uniform('cascade_splits')
+        for i in range(MAX_CASCADES):
+            self.add_uniform('shadow_map_matrices[{}]'.format(i))
         self.shadow_map = shadow_map
 
     def bind(self, model, M):
         PhongShader.bind(self, model, M)
         self.uniforms['shadow_map'].bind(1)
-        #self.uniforms['old_map'].bind(2)
 
-        glActiveTexture(GL_TEXTURE1)
-        self.shadow_map.bind()
+        render_state.bind_texture(1, self.shadow_map)
 
-        #glActiveTexture(GL_TEXTURE2)
-        #self.shadow_map.bind()
+        # the shadow map matrices take the positions in view coordinates, as given to the fragment shader
+        VsT = np.linalg.inv(model.scene.camera.V)
+        for i, matrix in enumerate(self.shadow_map.matrices):
+            self.uniforms['shadow_map_matrices[{}]'.format(i)].bind(np.matmul(matrix, VsT))
 
-        glActiveTexture(GL_TEXTURE0)
+        # the models drawn in the shadow map itself do not sample it
+        cascades = 0 if model.scene.shadow_pass else self.shadow_map.cascades
+        self.uniforms['cascades'].bind_int(cascades)
+        self.uniforms['cascade_splits'].bind_vector(self.shadow_map.splits)
 
-        # setup the shadow map matrix
-        VsT = np.linalg.inv(model.scene.camera.V)
-        self.SM = np.matmul(self.shadow_map.V, VsT)
-        self.SM = np.matmul(self.shadow_map.P, self.SM)
-        self.SM = np.matmul(translationMatrix([1, 1, 1]), self.SM)
-        self.SM = np.matmul(scaleMatrix(0.5), self.SM)
-        self.uniforms['shadow_map_matrix'].bind(self.SM)
+
+class ShowCascadeShader(BaseShaderProgram):
+    """
+    Draws one cascade of a CascadedShadowMap on the screen, see ShowTexture.
+    """
+    def __init__(self):
+        BaseShaderProgram.__init__(self, name='show_cascade')
+        self.add_uniform('sampler')
+        self.add_uniform('layer')
+
+    def bind(self, model, M):
+        BaseShaderProgram.bind(self, model, M)
+        self.uniforms['sampler'].bind_int(0)
+        self.uniforms['layer'].bind_int(model.mesh.textures[0].shown)
 
 
 class ShowTexture(DrawModelFromMesh):
@@ -77,11 +115,12 @@ class ShowTexture(DrawModelFromMesh):
     Class for drawing the cube faces flattened on the screen (for debugging purposes)
     '''
 
-    def __init__(self, scene, texture=None):
+    def __init__(self, scene, texture=None, shader=None):
         '''
         Initialises the
         :param scene: The scene object.
         :param cube: [optional] if not None, the cubemap texture to draw (can be set at a later stage using the set() method)
+        :param shader: [optional] the shader drawing the texture, ShowCascadeShader for a CascadedShadowMap
         '''
 
         vertices = np.array([
@@ -113,27 +152,56 @@ class ShowTexture(DrawModelFromMesh):
             mesh.textures.append(texture)
 
         # Finishes initialising the mesh
-        DrawModelFromMesh.__init__(self, scene=scene, M=poseMatrix(position=[0, 0, 1]), mesh=mesh, shader=ShowTextureShader(), visible=False)
+        DrawModelFromMesh.__init__(self, scene=scene, M=poseMatrix(position=[0, 0, 1]), mesh=mesh, shader=ShowTextureShader() if shader is None else shader, visible=False)
+
+        # drawn on top of the scene
+        self.render_pass = PASS_OVERLAY
 
 
-class ShadowMap(Texture):
+class CascadedShadowMap(Texture):
     """
-    Class for drawing the shadow map.
+    Shadow map split in cascades along the view frustum of the camera, the near cascades covering a small part of
+    the scene at a high resolution and the far ones a larger part at a lower resolution. The cascades are the
+    layers of a depth texture array, each one rendered with an orthographic projection from the light fitted to
+    the bounding sphere of its slice of the frustum, so that its size does not change when the camera turns and
+    the shadows do not shimmer. The models are culled against the volume of each cascade, extended towards the
+    light to keep the casters between the light and the slice.
+    The light is treated as directional, shining from its position towards the target.
+    In cached mode, the models which never moved are drawn once in a larger map seen from the light and covering
+    all casters, which does not depend on the camera. It is drawn again only when the light moves (see
+    LightSource.update()) or a static model moves. The cascades then share the orientation and depth range of this
+    map and are aligned on its texels, so that each frame the part of the static map under a cascade is copied to
+    it with a blit, and only the models which have moved at least once, like the animated raptor, are drawn on top.
     """
-    def __init__(self, light=None, width=1000, height=1000):
+    def __init__(self, light=None, width=SHADOW_MAP_SIZE, height=SHADOW_MAP_SIZE, cascades=CASCADES, distance=SHADOW_DISTANCE, cached=False):
+        """
+        Creates the depth texture array and the framebuffers of the cascades.
+        :param light: [optional] the LightSource casting the shadows
+        :param width: [optional] the width of each cascade, in texels
+        :param height: [optional] the height of each cascade, in texels
+        :param cascades: [optional] the number of cascades, up to MAX_CASCADES
+        :param distance: [optional] the distance from the camera up to which shadows are drawn
+        :param cached: [optional] whether to keep the shadows of the static models between frames
+        """
+        if not 1 <= cascades <= MAX_CASCADES:
+            raise ValueError('Expected between 1 and {} cascades, got {}'.format(MAX_CASCADES, cascades))
 
         # we save the light source
         self.light = light
 
-        # copy and modify the code here
         self.name = 'shadow'
         self.format = GL_DEPTH_COMPONENT
         self.type = GL_FLOAT
         self.wrap = GL_CLAMP_TO_EDGE
         self.sample = GL_LINEAR
-        self.target = GL_TEXTURE_2D
+        self.target = GL_TEXTURE_2D_ARRAY
         self.width = width
         self.height = height
+        self.cascades = cascades
+        self.distance = distance
+
+        # the cascade drawn by ShowTexture
+        self.shown = 0
 
         # create the texture
         self.textureid = glGenTextures(1)
@@ -142,41 +210,344 @@ class ShadowMap(Texture):
 
         # initialise the texture memory
         self.bind()
-        glTexImage2D(self.target, 0, self.format, self.width, self.height, 0, self.format, self.type, None)
+        glTexImage3D(self.target, 0, GL_DEPTH_COMPONENT24, self.width, self.height, self.cascades, 0, self.format, self.type, None)
         self.unbind()
 
         self.set_wrap_parameter(self.wrap)
         self.set_sampling_parameter(self.sample)
         self.set_shadow_comparison()
 
-        self.fbo = Framebuffer(attachment=GL_DEPTH_ATTACHMENT, texture=self)
+        # one framebuffer per cascade, rendering to its layer of the texture
+        self.fbos = []
+        for i in range(self.cascades):
+            fbo = Framebuffer(attachment=GL_DEPTH_ATTACHMENT)
+            fbo.prepare_layer(self, i)
+            self.fbos.append(fbo)
+
+        self.cached = cached
+        if self.cached:
+            # the depth of the static models seen from the light, only copied to the cascades
+            self.static = glGenTextures(1)
+            glBindTexture(GL_TEXTURE_2D, self.static)
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_DEPTH_COMPONENT24, STATIC_SHADOW_MAP_SIZE, STATIC_SHADOW_MAP_SIZE, 0, self.format, self.type, None)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            glBindTexture(GL_TEXTURE_2D, 0)
+
+            self.static_fbo = Framebuffer(attachment=GL_DEPTH_ATTACHMENT)
+            self.static_fbo.bind()
+            glFramebufferTexture2D(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_TEXTURE_2D, self.static, 0)
+            glDrawBuffer(GL_NONE)
+            glReadBuffer(GL_NONE)
+            self.static_fbo.unbind()
+
+        # the light view the static map was drawn with, None if it must be drawn again
+        self.static_key = None
+
+        # the corner of the static map in the plane of the light, the size of its texels, and its depth range
+        self.static_origin = np.zeros(2)
+        self.static_texel = 1.0
+        self.static_depth = (0.0, 1.0)
+
+        # the ids of the models which have moved, drawn in each frame rather than in the static map
+        self.dynamic = set()
+
+        # whether the static map was drawn in the last frame
+        self.static_renders = 0
+
+        # the far distance of each cascade from the camera, padded to a vec4 for the shaders
+        self.splits = np.zeros(MAX_CASCADES, dtype=np.float32)
+
+        # for each cascade, the matrix from world coordinates to its texture coordinates and depth
+        self.matrices = [np.identity(4) for _ in range(self.cascades)]
+
+        # the timestamps before and after each cascade, read one frame later so as not to wait for the GPU; they
+        # are used instead of GL_TIME_ELAPSED queries, which cannot be nested in one measuring the whole frame
+        self.queries = np.atleast_1d(glGenQueries(2 * self.cascades)).reshape(self.cascades, 2)
+        self.queried = [False] * self.cascades
+
+        # the draws and the milliseconds of each cascade in the last frame
+        self.draws = [0] * self.cascades
+        self.times = [0.0] * self.cascades
+
+    def invalidate(self):
+        """
+        Draws the static models again at the next frame.
+        :return: None
+        """
+        self.static_key = None
+
+    def update_dynamic(self, scene, casters):
+        """
+        Finds the models moved since the last frame. The casters moving for the first time are no longer static, and
+        the static shadows are drawn again; the models already dynamic move freely. Other models, like the pieces
+        of a static batch, change the static shadows each time they move.
+        :param scene: the scene
+        :param casters: the models casting shadows
+        :return: None
+        """
+        casters = {id(model) for model in casters}
+        for model, previous in scene.moved_models:
+            if id(model) not in self.dynamic:
+                self.invalidate()
+                if id(model) in casters:
+                    self.dynamic.add(id(model))
+
+    def split_distances(self, near, far):
+        """
+        Computes the distances from the camera where the cascades end, blending a uniform and a logarithmic split
+        of the range so that the near cascades are smaller.
+        :param near: the near distance of the camera
+        :param far: the distance up to which shadows are drawn
+        :return: an array of the far distance of each cascade
+        """
+        i = np.arange(1, self.cascades + 1) / self.cascades
+        logarithmic = near * (far / near) ** i
+        uniform = near + (far - near) * i
+        return CASCADE_SPLIT_LAMBDA * logarithmic + (1 - CASCADE_SPLIT_LAMBDA) * uniform
 
-        self.V = None
+    def fit_cascade(self, corners, light_view):
+        """
+        Computes the view and projection of a cascade, fitted to the bounding sphere of a slice of the frustum of
+        the camera. The centre of the sphere is snapped to the texels of the cascade, or to those of the static map
+        in cached mode, which also gives the depth range.
+        :param corners: the 8 corners of the slice in world coordinates
+        :param light_view: the view matrix from the light to the target
+        :return: the view and projection matrices of the cascade
+        """
+        centre = corners.mean(axis=0)
+        radius = np.linalg.norm(corners - centre, axis=1).max()
+        centre = np.dot(light_view, np.append(centre, 1.0))[:3]
+
+        if self.cached:
+            # a whole number of texels of the static map, so that the cascade covers a rectangle of its texels
+            texel = self.static_texel
+            radius = np.ceil(radius / texel) * texel
+            centre[:2] = self.static_origin + np.round((centre[:2] - self.static_origin) / texel) * texel
+            centre[2] = 0.0
+            near, far = self.static_depth
+        else:
+            # the size is rounded up so that it does not change with the rounding errors as the camera turns
+            radius = np.ceil(radius * 16.0) / 16.0
+
+            # the centre only moves by whole texels in the plane of the cascade
+            texel = 2.0 * radius / np.array([self.width, self.height])
+            centre[:2] = np.floor(centre[:2] / texel) * texel
+
+            # the casters up to SHADOW_CASTER_DISTANCE towards the light are kept
+            near = -radius - SHADOW_CASTER_DISTANCE
+            far = radius
+
+        V = np.matmul(translationMatrix(-centre), light_view)
+        return V, self.light_projection(radius, near, far)
+
+    def light_projection(self, radius, near, far):
+        """
+        Returns an orthographic projection along the direction of the light.
+        :param radius: the half size of the square covered
+        :param near: the near distance along the light direction
+        :param far: the far distance along the light direction
+        :return: the 4x4 projection matrix
+        """
+        return np.array([
+            [1.0 / radius, 0., 0., 0.],
+            [0., 1.0 / radius, 0., 0.],
+            [0., 0., -2.0 / (far - near), -(far + near) / (far - near)],
+            [0., 0., 0., 1.],
+        ])
+
+    def render_static(self, scene, casters, light_view):
+        """
+        Draws the static casters in the static map, fitted to the bounds of all casters seen from the light.
+        :param scene: the scene
+        :param casters: the models casting shadows
+        :param light_view: the view matrix from the light to the target
+        :return: None
+        """
+        bounded = [(model, model.local_bounds()) for model in casters]
+        bounded = [(model, bounds) for model, bounds in bounded if bounds is not None]
+        if len(bounded) == 0:
+            return
+
+        # the boxes of the casters in the frame of the light
+        boxes, spheres = transformBounds(
+            np.array([bounds[0] for model, bounds in bounded]),
+            np.array([bounds[1] for model, bounds in bounded]),
+            np.array([np.matmul(light_view, model.M) for model, bounds in bounded]))
+        low = boxes[:, 0].min(axis=0) - STATIC_SHADOW_MARGIN
+        high = boxes[:, 1].max(axis=0) + STATIC_SHADOW_MARGIN
+
+        # the light looks along -z
+        size = max(high[0] - low[0], high[1] - low[1])
+        self.static_origin = low[:2]
+        self.static_texel = size / STATIC_SHADOW_MAP_SIZE
+        self.static_depth = (-high[2], -low[2])
+
+        centre = np.array([low[0] + size / 2, low[1] + size / 2, 0.0])
+        scene.P = self.light_projection(size / 2, *self.static_depth)
+        scene.camera.V = np.matmul(translationMatrix(-centre), light_view)
+        scene.update_frame_uniforms()
+
+        glViewport(0, 0, STATIC_SHADOW_MAP_SIZE, STATIC_SHADOW_MAP_SIZE)
+        self.static_fbo.bind()
+        glClear(GL_DEPTH_BUFFER_BIT)
+        scene.draw_models([model for model in casters if id(model) not in self.dynamic])
+        self.static_fbo.unbind()
+        glViewport(0, 0, self.width, self.height)
+
+    def read_times(self):
+        """
+        Reads the GPU time of the cascades rendered in the previous frame, when available.
+        :return: None
+        """
+        available = np.zeros(1, dtype=np.int32)
+        # PyOpenGL has no array type for the unsigned 64 bit results, the signed ones hold the timestamps as well
+        start = np.zeros(1, dtype=np.int64)
+        end = np.zeros(1, dtype=np.int64)
+        for i, (start_query, end_query) in enumerate(self.queries):
+            if not self.queried[i]:
+                continue
+            glGetQueryObjectiv(end_query, GL_QUERY_RESULT_AVAILABLE, available)
+            if available[0]:
+                glGetQueryObjecti64v(start_query, GL_QUERY_RESULT, start)
+                glGetQueryObjecti64v(end_query, GL_QUERY_RESULT, end)
+                self.times[i] = round(int(end[0] - start[0]) / 1e6, 3)
+                self.queried[i] = False
 
     def render(self, scene, target=[0, 0, 0]):
         """
-        Render the shadow map.
+        Render the cascades of the shadow map for the current camera.
         :param scene: The scene object.
-        :param target: The target to look at.
+        :param target: The point the light shines towards.
         :return: None
         """
-        # backup the view matrix and replace with the new one
-        #self.P = scene.P
-        if self.light is not None:
-            self.P = frustumMatrix(-1.0, +1.0, -1.0, +1.0, 1.0, 20.0)
-            self.V = lookAt(np.array(self.light.position), np.array(target))
-            scene.camera.V = self.V
-
-            # update the viewport for the image size
-            glViewport(0, 0, self.width, self.height)
-
-            self.fbo.bind()
-            scene.draw_shadow_map()
-            self.fbo.unbind()
-
-            # reset the viewport to the windows size
-            glViewport(0, 0, scene.window_size[0], scene.window_size[1])
-
-            # restore the view matrix
-            scene.camera.V = None
-            scene.camera.update()
+        if self.light is None:
+            return
+
+        self.read_times()
+
+        casters = scene.shadow_casters()
+        if self.cached:
+            self.update_dynamic(scene, casters)
+        self.static_renders = 0
+
+        # the near and far distances of the perspective projection of the scene
+        near = scene.P[2, 3] / (scene.P[2, 2] - 1.0)
+        far = min(scene.P[2, 3] / (scene.P[2, 2] + 1.0), self.distance)
+        ends = self.split_distances(near, far)
+        self.splits[:self.cascades] = ends
+
+        # the corners of the frustum of the camera on the near and far planes, in world coordinates
+        PVi = np.linalg.inv(np.matmul(scene.P, scene.camera.V))
+        ndc = np.array([[x, y, z, 1.0] for z in [-1.0, 1.0] for y in [-1.0, 1.0] for x in [-1.0, 1.0]])
+        points = np.dot(ndc, PVi.T)
+        points = points[:, :3] / points[:, 3:]
+        near_corners, far_corners = points[:4], points[4:]
+        full_far = scene.P[2, 3] / (scene.P[2, 2] + 1.0)
+
+        light_view = lookAt(np.array(self.light.position), np.array(target))
+        bias = np.matmul(scaleMatrix(0.5), translationMatrix([1, 1, 1]))
+
+        # backup the projection matrix, the view matrix is restored from the camera
+        Pscene = scene.P
+        scene.shadow_pass = True
+
+        # the static map does not depend on the camera, only on the light and the static models
+        if self.cached and self.static_key != light_view.tobytes():
+            self.render_static(scene, casters, light_view)
+            self.static_key = light_view.tobytes()
+            self.static_renders = 1
+
+        # update the viewport for the image size
+        glViewport(0, 0, self.width, self.height)
+
+        start = near
+        for i, end in enumerate(ends):
+            # the slice of the frustum between the two distances, along the rays through its corners
+            corners = np.concatenate([
+                near_corners + (far_corners - near_corners) * (d - near) / (full_far - near) for d in [start, end]
+            ])
+            V, P = self.fit_cascade(corners, light_view)
+            self.matrices[i] = np.matmul(bias, np.matmul(P, V))
+            start = end
+
+            # the models outside of the cascade are culled by the scene
+            scene.P = P
+            scene.camera.V = V
+            scene.update_frame_uniforms()
+
+            draws = scene.render_queue.draws
+            glQueryCounter(self.queries[i][0], GL_TIMESTAMP)
+            if self.cached:
+                self.render_cached(scene, i, casters, light_view, V, P)
+            else:
+                self.fbos[i].bind()
+                glClear(GL_DEPTH_BUFFER_BIT)
+                scene.draw_models(casters)
+                self.fbos[i].unbind()
+            glQueryCounter(self.queries[i][1], GL_TIMESTAMP)
+            self.queried[i] = True
+            self.draws[i] = scene.render_queue.draws - draws
+
+        scene.shadow_pass = False
+
+        # reset the viewport to the windows size
+        glViewport(0, 0, scene.window_size[0], scene.window_size[1])
+
+        # restore the projection and view matrices
+        scene.P = Pscene
+        scene.camera.V = None
+        scene.camera.update()
+        scene.update_frame_uniforms()
+
+    def render_cached(self, scene, cascade, casters, light_view, V, P):
+        """
+        Renders a cascade from the static map, copying the texels under the cascade and drawing the moving models
+        on top.
+        :param scene: the scene
+        :param cascade: the index of the cascade
+        :param casters: the models casting shadows
+        :param light_view: the view matrix from the light to the target
+        :param V: the view matrix of the cascade
+        :param P: the projection matrix of the cascade
+        :return: None
+        """
+        self.fbos[cascade].bind()
+        glClear(GL_DEPTH_BUFFER_BIT)
+
+        # the rectangle of texels of the static map under the cascade, a whole number of them per side
+        texel = self.static_texel
+        radius = 1.0 / P[0, 0]
+        centre = light_view[:2, 3] - V[:2, 3]
+        size = int(round(2.0 * radius / texel))
+        corner = np.round((centre - radius - self.static_origin) / texel).astype(int)
+
+        # only the part of the rectangle inside the static map is copied, the rest of the cascade stays cleared
+        low = np.clip(corner, 0, STATIC_SHADOW_MAP_SIZE)
+        high = np.clip(corner + size, 0, STATIC_SHADOW_MAP_SIZE)
+        if np.all(high > low):
+            scale = np.array([self.width, self.height]) / size
+            target_low = np.round((low - corner) * scale).astype(int)
+            target_high = np.round((high - corner) * scale).astype(int)
+
+            glBindFramebuffer(GL_READ_FRAMEBUFFER, self.static_fbo.fbo)
+            glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self.fbos[cascade].fbo)
+            glBlitFramebuffer(low[0], low[1], high[0], high[1], target_low[0], target_low[1], target_high[0], target_high[1],
+                              GL_DEPTH_BUFFER_BIT, GL_NEAREST)
+
+        self.fbos[cascade].bind()
+        scene.draw_models([model for model in casters if id(model) in self.dynamic])
+        self.fbos[cascade].unbind()
+
+    def stats(self):
+        """
+        Returns the statistics of the last frame for each cascade.
+        :return: a dictionary of the draws and the GPU time in milliseconds of each cascade
+        """
+        stats = {}
+        for i in range(self.cascades):
+            stats['shadow draws cascade {}'.format(i)] = self.draws[i]
+            stats['shadow time cascade {} (ms)'.format(i)] = self.times[i]
+        if self.cached:
+            stats['shadow static map drawn'] = self.static_renders
+        return stats
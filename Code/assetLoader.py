@@ -0,0 +1,259 @@
+# Description: This file contains the AssetLoader class, which loads the meshes and images of a scene in parallel.
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from OpenGL.GL import GL_RGBA
+
+from blender import load_obj_file
+from cubeMap import CUBE_FACE_FILES
+from mesh import Mesh
+from meshCache import MeshCache, MESH_ARRAYS
+from texture import ImageWrapper, material_sampling, pending_images
+
+# the arrays in the shared memory blocks start on multiples of this number of bytes
+ALIGNMENT = 64
+
+
+def load_mesh_arrays(file_name, options):
+    """
+    Loads the meshes of a file in a worker process, and copies their arrays into a shared memory block so that
+    they are not pickled. The textures are not loaded, as the worker has no OpenGL context.
+    :param file_name: the name of the file
+    :param options: the options given to load_obj_file()
+    :return: a dictionary with the name of the shared memory block, the layout of the arrays in it, and the
+    description of the meshes and their materials
+    """
+    meshes = load_obj_file(file_name, load_textures=False, **options)
+
+    # meshes from the same file often share their material, so we only send each one once
+    materials = []
+    descriptions = []
+    arrays = []
+    for i, mesh in enumerate(meshes):
+        if not any(mesh.material is m for m in materials):
+            materials.append(mesh.material)
+        material = next(j for j, m in enumerate(materials) if m is mesh.material)
+        descriptions.append({'name': mesh.name, 'material': material, 'lods': len(mesh.lods)})
+
+        arrays += [(i, name, getattr(mesh, name)) for name in MESH_ARRAYS if getattr(mesh, name) is not None]
+        arrays += [(i, 'lod{}'.format(level), faces) for level, faces in enumerate(mesh.lods, start=1)]
+
+    layout = []
+    size = 0
+    for i, name, data in arrays:
+        layout.append((i, name, data.dtype.str, data.shape, size))
+        size += (data.nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+    # the block stays registered with the resource tracker shared with the main process, which unlinks it once it
+    # has read the arrays (see unpack_meshes() and release_meshes()), or at exit if they are never read
+    memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        for (i, name, data), (_, _, dtype, shape, offset) in zip(arrays, layout):
+            np.ndarray(shape, dtype=dtype, buffer=memory.buf, offset=offset)[...] = data
+    except BaseException:
+        memory.close()
+        memory.unlink()
+        raise
+    memory.close()
+
+    cache = MeshCache()
+    return {
+        'memory': memory.name,
+        'layout': layout,
+        'materials': [cache.save_material(material) for material in materials],
+        'meshes': descriptions,
+    }
+
+
+def unpack_meshes(result):
+    """
+    Creates the meshes loaded by a worker process, reading their arrays from the shared memory block and
+    releasing it. This loads the textures, so it must be called from the thread of the OpenGL context.
+    :param result: the dictionary returned by load_mesh_arrays()
+    :return: a list of Mesh objects
+    """
+    memory = shared_memory.SharedMemory(name=result['memory'])
+    try:
+        arrays = [{} for _ in result['meshes']]
+        for i, name, dtype, shape, offset in result['layout']:
+            arrays[i][name] = np.ndarray(shape, dtype=dtype, buffer=memory.buf, offset=offset).copy()
+    finally:
+        memory.close()
+        memory.unlink()
+
+    cache = MeshCache()
+    materials = [cache.load_material(material) for material in result['materials']]
+
+    meshes = []
+    for description, mesh_arrays in zip(result['meshes'], arrays):
+        mesh = Mesh(
+            vertices=mesh_arrays.get('vertices'),
+            faces=mesh_arrays.get('faces'),
+            normals=mesh_arrays.get('normals'),
+            textureCoords=mesh_arrays.get('textureCoords'),
+            material=materials[description['material']]
+        )
+        mesh.name = description['name']
+        mesh.tangents = mesh_arrays.get('tangents')
+        mesh.binormals = mesh_arrays.get('binormals')
+        mesh.lods = [mesh_arrays['lod{}'.format(level)] for level in range(1, description['lods'] + 1)]
+        meshes.append(mesh)
+
+    return meshes
+
+
+def release_meshes(result):
+    """
+    Releases the shared memory block of meshes loaded by a worker process which are not needed.
+    :param result: the dictionary returned by load_mesh_arrays()
+    :return: None
+    """
+    try:
+        memory = shared_memory.SharedMemory(name=result['memory'])
+    except FileNotFoundError:
+        return
+    memory.close()
+    memory.unlink()
+
+
+def decode_image(name):
+    """
+    Loads an image file and converts it to the pixel format of the textures, in a thread of the asset loader. The
+    mipmap levels are prepared too when the textures of the materials are mipmapped on the CPU.
+    :param name: the name of the image file in the textures folder
+    :return: an ImageWrapper object
+    """
+    image = ImageWrapper(name)
+    image.data(GL_RGBA)
+    if material_sampling.get('mipmaps') == 'cpu':
+        image.mipmaps(GL_RGBA)
+    return image
+
+
+class AssetLoader:
+    """
+    Loads the assets of a scene in the background while the scene is being set up. The meshes are parsed and
+    prepared (normals, optimisation, levels of detail) in a pool of processes, and their arrays come back through
+    shared memory. The images are decoded in a pool of threads, and picked up by the Texture and CubeMap objects
+    created for them. Only the upload to OpenGL is done by the thread of the OpenGL context.
+    Request all assets first, then get the meshes with load_meshes() in any order.
+    """
+    def __init__(self, parallel=True, processes=None, threads=None):
+        """
+        Initialises the loader.
+        :param parallel: [optional] whether to load the assets in parallel, otherwise they are loaded when needed
+        :param processes: [optional] the number of processes loading meshes, by default the number of CPUs
+        :param threads: [optional] the number of threads decoding images
+        """
+        self.parallel = parallel
+
+        # the meshes being loaded, indexed by file name and options
+        self.requests = {}
+
+        # the keys of the requests whose material images are being decoded, see poll()
+        self.polled = set()
+
+        if self.parallel:
+            # the workers are started from scratch, as the OpenGL context of this process must not be copied
+            self.processes = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+            self.threads = ThreadPoolExecutor(max_workers=threads)
+
+    def key(self, file_name, options):
+        return file_name, tuple(sorted(options.items()))
+
+    def request_meshes(self, file_name, **options):
+        """
+        Starts loading the meshes of a file. The images of their materials are decoded as soon as they are known.
+        :param file_name: the name of the file
+        :param options: [optional] the options given to load_obj_file()
+        :return: None
+        """
+        key = self.key(file_name, options)
+        if not self.parallel or key in self.requests:
+            return
+
+        self.poll()
+        self.requests[key] = self.processes.submit(load_mesh_arrays, file_name, options)
+
+    def poll(self):
+        """
+        Starts decoding the textures of the materials of the meshes loaded so far. The futures are checked here
+        rather than in callbacks, as these run in the threads of the executor while the Texture objects read
+        pending_images in the thread of the OpenGL context.
+        :return: None
+        """
+        for key, future in self.requests.items():
+            if key not in self.polled and future.done():
+                self.polled.add(key)
+                self.request_material_images(future)
+
+    def request_material_images(self, future):
+        """
+        Starts decoding the textures of the materials loaded by a worker process.
+        :param future: the future of load_mesh_arrays()
+        :return: None
+        """
+        if future.cancelled() or future.exception() is not None:
+            return
+        for material in future.result()['materials']:
+            if material.get('texture') is not None:
+                self.request_image(material['texture'])
+
+    def request_image(self, name):
+        """
+        Starts decoding an image file, which is then used by the next texture loading it.
+        :param name: the name of the image file in the textures folder
+        :return: None
+        """
+        if self.parallel and name not in pending_images:
+            pending_images[name] = self.threads.submit(decode_image, name)
+
+    def request_cube_map(self, name, files=CUBE_FACE_FILES):
+        """
+        Starts decoding the images of the faces of a cube map.
+        :param name: the name of the folder containing the faces
+        :param files: [optional] the file name of each face
+        :return: None
+        """
+        for file_name in files.values():
+            self.request_image('{}/{}'.format(name, file_name))
+
+    def load_meshes(self, file_name, **options):
+        """
+        Returns the meshes of a file, waiting for them if they were requested, or loading them now otherwise.
+        :param file_name: the name of the file
+        :param options: [optional] the options given to load_obj_file()
+        :return: a list of Mesh objects
+        """
+        self.poll()
+        key = self.key(file_name, options)
+        future = self.requests.pop(key, None)
+        if future is None:
+            return load_obj_file(file_name, **options)
+
+        # the textures are needed now, they may not have been requested by poll() yet
+        if key not in self.polled:
+            self.request_material_images(future)
+        self.polled.discard(key)
+        return unpack_meshes(future.result())
+
+    def close(self):
+        """
+        Stops the workers, once all requested meshes have been loaded, releasing the shared memory of those which
+        were never used.
+        :return: None
+        """
+        if self.parallel:
+            try:
+                for future in self.requests.values():
+                    if future.exception() is None:
+                        release_meshes(future.result())
+            finally:
+                self.requests = {}
+                self.polled = set()
+                self.processes.shutdown()
+                self.threads.shutdown()
@@ -1,92 +1,33 @@
 # import numpy as np
 import numpy as np
 
+import mmap
+import os
+import re
+
 from material import Material, MaterialLibrary
 from mesh import Mesh
+from meshCache import MeshCache
+from meshOptimiser import optimise_mesh
+from meshSimplifier import generate_lods, LOD_RATIOS
 
 # This file contains functions for loading Blender3D object files.
 
-def process_line(line):
-	"""
-	Function for reading the Blender3D object file, line by line.
-	:param line: one line from the file
-	:return: a tuple containing the label and the data
-	"""
-    
-	label = None
-	# split the line
-	fields = line.split()
-	if len(fields) == 0:
-		return None
-
-    # check the first field
-	# if it is a comment, we skip it
-	if fields[0] == '#':
-		label = 'comment'
-		return (label, fields[1:])
-
-    # if it is a vertex, we expect 3 entries
-	elif fields[0] == 'v':
-		label = 'vertex'
-		if len(fields) != 4:
-			print('(E) Error, 3 entries expected for vertex')
-			return None
-
-    # if it is a vertex texture, we expect 2 entries
-	elif fields[0] == 'vt':
-		label = 'vertex texture'
-		if len(fields) != 3:
-			print('(E) Error, 2 entries expected for vertex texture')
-			return None
-
-	# added for vector normals
-	# should be 3 entries	
-	elif fields[0] == 'vn':
-		label = 'normal'
-		if len(fields) != 4:
-			print('(E) Error, 3 entries expected for normal')
-			return None
-
-    # if it is a material library, we expect 1 entry
-	elif fields[0] == 'mtllib':
-		label = 'material library'
-		if len(fields) != 2:
-			print('(E) Error, material library file name missing')
-			return None
-		else:
-			return (label, fields[1])
-    
-	# if it is a material, we expect 1 entry
-	elif fields[0] == 'usemtl':
-		label = 'material'
-		if len(fields) != 2:
-			print('(E) Error, material file name missing')
-			return None
-		else:
-			return (label, fields[1])
-    
-	# if it is a face, we expect 3 or 4 entries
-	elif fields[0] == 'f':
-		label = 'face'
-		if len(fields) != 4 and len(fields) != 5:
-			print('(E) Error, 3 or 4 entries expected for faces\n{}'.format(line))
-			return None
-
-
-		# multiple formats for faces lines, eg
-		# f 586/1 1860/2 1781/3
-		# f vi/ti/ni
-		# where vi is the vertex index
-		# ti is the texture index
-		# ni is the normal index (optional)
-		return ( label, [ [np.uint32(i) for i in v.split('/')] for v in fields[1:] ] )
-
-	else:
-		print('(E) Unknown line: {}'.format(fields))
-		return None
+# patterns extracting every record of one type from a Blender3D object file in a single pass,
+# the group captures the data following the record prefix.
+OBJ_RECORDS = {
+	'vertex': re.compile(rb'^v[ \t]+([^\r\n]*)', re.M),
+	'vertex texture': re.compile(rb'^vt[ \t]+([^\r\n]*)', re.M),
+	'face': re.compile(rb'^f[ \t]+([^\r\n]*)', re.M),
+	'material library': re.compile(rb'^mtllib[ \t]+([^\r\n]*)', re.M),
+	'material': re.compile(rb'^usemtl[ \t]+([^\r\n]*)', re.M),
+}
 
-	return (label, [float(token) for token in fields[1:]])
+# files larger than this are read in chunks by read_obj_file_streaming(), unless load_obj_file() is told otherwise
+STREAMING_SIZE = 64 << 20
 
+# the number of bytes read at once by read_obj_file_streaming()
+CHUNK_SIZE = 8 << 20
 
 def load_material_library(file_name):
 	"""
@@ -138,89 +79,321 @@ def load_material_library(file_name):
 	return library
 
 
-def load_obj_file(file_name):
+def parse_records(records, width, dtype, label):
+	"""
+	Function for converting a list of records of the same type to a numpy array in a single bulk call.
+	:param records: list of byte strings, one per record, without the record prefix
+	:param width: the number of entries expected in each record
+	:param dtype: the type of the output array
+	:param label: the label of the records, for error reporting
+	:return: an array of shape (number of records, width)
+	"""
+	data = np.fromstring(b' '.join(records), dtype=dtype, sep=' ')
+
+	if data.size != width * len(records):
+		print('(E) Error, {} entries expected for each {}'.format(width, label))
+		raise ValueError('Malformed {} record(s) in Blender file'.format(label))
+
+	return data.reshape(-1, width)
+
+
+def parse_faces(records):
+	"""
+	Function for converting the face records of a Blender3D object file to an array of triangles in bulk.
+	All faces must use the same index format: v, v/t, v//n or v/t/n (missing indices are set to 0).
+	Quads are converted into pairs of triangles, faces with other numbers of entries are skipped.
+	:param records: list of byte strings, one per face, without the 'f' prefix
+	:return: a tuple (faces, index) with faces an array of shape (triangles, 3, indices per corner) and index
+	the number of the record each triangle comes from
+	"""
+	corners = [record.split() for record in records]
+	ncorners = np.fromiter(map(len, corners), dtype=np.int64, count=len(corners))
+
+	valid = (ncorners == 3) | (ncorners == 4)
+	for r in np.flatnonzero(~valid):
+		print('(E) Error, 3 or 4 entries expected for faces\n{}'.format(records[r].decode()))
+
+	# flatten all corners in one string of integers, e.g. b'586/1 1860/2' -> b'586 1 1860 2'
+	tokens = [token for face, ok in zip(corners, valid) if ok for token in face]
+	if len(tokens) == 0:
+		return np.zeros((0, 3, 1), dtype=np.uint32), np.zeros(0, dtype=np.int64)
+
+	width = tokens[0].count(b'/') + 1
+	text = b' '.join(tokens).replace(b'//', b'/0/').replace(b'/', b' ')
+	indices = parse_records([text], width * len(tokens), np.uint32, 'face').reshape(-1, width)
+
+	# each face with n corners is split in a fan of n-2 triangles starting at its first corner,
+	# i.e. [0, 1, 2] for triangles and [0, 1, 2], [0, 2, 3] for quads.
+	ncorners = ncorners[valid]
+	ntriangles = ncorners - 2
+	first = np.cumsum(ncorners) - ncorners
+	face = np.repeat(np.arange(ncorners.shape[0]), ntriangles)
+	offset = np.arange(face.shape[0]) - np.repeat(np.cumsum(ntriangles) - ntriangles, ntriangles)
+	start = first[face]
+
+	triangles = np.stack([start, start + offset + 1, start + offset + 2], axis=1)
+
+	return indices[triangles], np.flatnonzero(valid)[face]
+
+
+def load_obj_file(file_name, cache=True, split_seams=False, optimise=True, lods=0, streaming=None, load_textures=True):
 	"""
 	Function for loading a Blender3D object file.
+	If the binary mesh cache holds an up to date copy of the meshes, the file is not parsed at all.
 	:param file_name: the name of the file
+	:param cache: whether to use (and update) the binary mesh cache
+	:param split_seams: [optional] duplicate the vertices used with several texture coordinates,
+	see split_texture_seams()
+	:param optimise: [optional] weld the duplicate vertices and reorder the triangles and vertices for the GPU
+	caches, see optimise_mesh(). The cache stores the optimised meshes.
+	:param lods: [optional] the number of simplified levels of detail computed for each mesh (at most 3),
+	see generate_lods(). The cache stores the levels with the meshes.
+	:param streaming: [optional] whether to read the file in chunks with read_obj_file_streaming(), to limit the
+	memory used by large files. By default, the files larger than STREAMING_SIZE are streamed.
+	:param load_textures: [optional] whether to load the textures of the materials, which needs an OpenGL context
 	:return: a list of Mesh objects
 	"""
 
+	# the loading options change the meshes, so they are part of the cache key
+	options = {'split_seams': split_seams, 'optimise': optimise, 'lods': lods}
+
+	if cache:
+		mesh_cache = MeshCache()
+		meshes = mesh_cache.load(file_name, options, load_textures=load_textures)
+		if meshes is not None:
+			return meshes
+
+	if streaming is None:
+		streaming = os.path.getsize(file_name) > STREAMING_SIZE
+
+	if streaming:
+		meshes, libraries = read_obj_file_streaming(file_name, split_seams=split_seams, load_textures=load_textures)
+	else:
+		meshes, libraries = read_obj_file(file_name, split_seams=split_seams, load_textures=load_textures)
+
+	if optimise:
+		for mesh in meshes:
+			optimise_mesh(mesh)
+
+	if lods > 0:
+		for mesh in meshes:
+			generate_lods(mesh, LOD_RATIOS[:lods])
+
+	if cache:
+		mesh_cache.save(file_name, meshes, dependencies=libraries, options=options)
+
+	return meshes
+
+
+def read_obj_file(file_name, split_seams=False, load_textures=True):
+	"""
+	Function for parsing a Blender3D object file.
+	The file is memory mapped and each type of record (v, vt, f, usemtl) is extracted in one pass,
+	then converted to numpy arrays in bulk.
+	:param file_name: the name of the file
+	:param split_seams: [optional] duplicate the vertices used with several texture coordinates
+	:param load_textures: [optional] whether to load the textures of the materials
+	:return: a tuple with the list of Mesh objects and the list of material library files used
+	"""
+
 	print('Loading mesh(es) from Blender file: {}'.format(file_name))
 
-	vlist = []	# list of vertices
-	tlist = []	# list of texture vectors
-	flist = []	# list of polygonal faces
-	mlist = []	# list of material names
+	libraries = []
 
-    # list of line numbers for error reporting
-	lnlist = []
-	mesh_id = 0
-	mesh_list = []
+	# open the file
+	with open(file_name, 'rb') as objfile, mmap.mmap(objfile.fileno(), 0, access=mmap.ACCESS_READ) as data:
 
-	# current material object
-	material = None
+		for name in OBJ_RECORDS['material library'].findall(data):
+			libraries.append('models/{}'.format(name.decode().strip()))
+			library = load_material_library(libraries[-1])
 
-    # open the file
-	with open(file_name) as objfile:
-		line_nb = 0 # count line number for easier error locating
-
-		# loop over all lines in the file
-		for line in objfile:
-			# process the line
-			data = process_line(line)
-
-			line_nb += 1 # increment line
-
-			# skip empty lines
-			if data is None:
-				continue
-            
-			# check the label
-			elif data[0] == 'vertex':
-				vlist.append(data[1])
-
-			elif data[0] == 'normal':
-				vlist.append(data[1])
-
-			elif data[0] == 'vertex texture':
-				tlist.append(data[1])
-
-			elif data[0] == 'face':
-				if len(data[1]) == 3:
-					flist.append(data[1])
-					mesh_list.append(mesh_id)
-					mlist.append(material)
-					lnlist.append(line_nb)
-				else:
-					# converts quads into pairs of  triangles
-					face1 = [data[1][0], data[1][1], data[1][2]]
-					flist.append(face1)
-					mesh_list.append(mesh_id)
-					mlist.append(material)
-					lnlist.append(line_nb)
-
-					face2 = [data[1][0], data[1][2], data[1][3]]
-					flist.append(face2)
-					mesh_list.append(mesh_id)
-					mlist.append(material)
-					lnlist.append(line_nb)
-
-			elif data[0] == 'material library':
-				library = load_material_library('models/{}'.format(data[1]))
-
-			# material indicate a new mesh in the file, so we store the previous one if not empty and start
-			# a new one.
-			elif data[0] == 'material':
-				material = library.names[data[1]]
-				mesh_id += 1
-				print('[l.{}] Loading mesh with material: {}'.format(line_nb, data[1]))
-
-	print('File read. Found {} vertices and {} faces.'.format(len(vlist), len(flist)))
-
-	return create_meshes_from_blender(vlist, flist, mlist, tlist, library, mesh_list, lnlist)
-
-
-def create_meshes_from_blender(vlist, flist, mlist, tlist, library, mesh_list, lnlist):
+		varray = parse_records(OBJ_RECORDS['vertex'].findall(data), 3, 'f', 'vertex')
+		tarray = parse_records(OBJ_RECORDS['vertex texture'].findall(data), 2, 'f', 'vertex texture')
+
+		faces = [(m.start(), m.group(1)) for m in OBJ_RECORDS['face'].finditer(data)]
+		materials = [(m.start(), m.group(1)) for m in OBJ_RECORDS['material'].finditer(data)]
+
+		# offsets of all line breaks, to recover line numbers for error reporting
+		newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+
+	flist, face_records = parse_faces([record for _, record in faces])
+	face_offsets = np.array([offset for offset, _ in faces], dtype=np.int64)[face_records]
+	material_offsets = np.array([offset for offset, _ in materials], dtype=np.int64)
+
+	# list of line numbers for error reporting
+	lnlist = np.searchsorted(newlines, face_offsets) + 1
+
+	# material indicate a new mesh in the file, so each face belongs to the mesh of the last material
+	# declared before it.
+	material_ids = [None]
+	for offset, name in materials:
+		name = name.decode().strip()
+		material_ids.append(library.names[name])
+		print('[l.{}] Loading mesh with material: {}'.format(np.searchsorted(newlines, offset) + 1, name))
+
+	mesh_list = np.searchsorted(material_offsets, face_offsets)
+	mlist = [material_ids[m] for m in mesh_list]
+
+	print('File read. Found {} vertices and {} faces.'.format(varray.shape[0], flist.shape[0]))
+
+	return create_meshes_from_blender(varray, flist, mlist, tarray, library, mesh_list, lnlist, split_seams, load_textures), libraries
+
+
+class GrowableArray:
+	"""
+	An array to which rows are appended in place. The rows are stored in a preallocated buffer whose capacity
+	doubles when it is full, so that appending n rows costs O(n) in total.
+	"""
+	def __init__(self, shape, dtype, capacity=1024):
+		"""
+		Initialises an empty array.
+		:param shape: the shape of each row, e.g. (3,) for vertices
+		:param dtype: the type of the array
+		:param capacity: [optional] the number of rows preallocated
+		"""
+		self.data = np.empty((capacity,) + tuple(shape), dtype=dtype)
+		self.size = 0
+
+	def reserve(self, capacity):
+		"""
+		Grows the buffer to hold at least a number of rows.
+		:param capacity: the number of rows
+		:return: None
+		"""
+		if capacity > self.data.shape[0]:
+			data = np.empty((capacity,) + self.data.shape[1:], dtype=self.data.dtype)
+			data[:self.size] = self.data[:self.size]
+			self.data = data
+
+	def append(self, rows):
+		"""
+		Appends rows at the end of the array.
+		:param rows: an array of rows
+		:return: None
+		"""
+		n = rows.shape[0]
+		if self.size + n > self.data.shape[0]:
+			self.reserve(max(2 * self.data.shape[0], self.size + n))
+		self.data[self.size:self.size + n] = rows
+		self.size += n
+
+	def view(self):
+		"""
+		Returns the rows appended so far, as a view of the buffer valid until the next append.
+		:return: an array
+		"""
+		return self.data[:self.size]
+
+
+def read_obj_file_streaming(file_name, split_seams=False, chunk_size=CHUNK_SIZE, load_textures=True):
+	"""
+	Function for parsing a Blender3D object file in chunks, so that the memory used stays close to the size of the
+	meshes instead of the size of the file. Each chunk is parsed in bulk like in read_obj_file(), the vertices are
+	appended to growable arrays, and the mesh of each material group is created as soon as the next usemtl record
+	closes it. The faces must use vertices declared before them, which is what Blender writes.
+	:param file_name: the name of the file
+	:param split_seams: [optional] duplicate the vertices used with several texture coordinates
+	:param chunk_size: [optional] the number of bytes read at once
+	:param load_textures: [optional] whether to load the textures of the materials
+	:return: a tuple with the list of Mesh objects and the list of material library files used
+	"""
+
+	print('Streaming mesh(es) from Blender file: {}'.format(file_name))
+
+	file_size = os.path.getsize(file_name)
+
+	libraries = []
+	library = MaterialLibrary()
+	meshes = []
+
+	vertices = GrowableArray((3,), 'f')
+	textures = GrowableArray((2,), 'f')
+
+	# the faces and material of the group being read
+	group = {'faces': None, 'material': None}
+
+	def close_group():
+		faces = group['faces']
+		if faces is None or faces.size == 0:
+			return
+
+		material = group['material']
+		if material is None:
+			print('(W) Faces declared before any material, using the default material')
+			library.add_material(Material('default'))
+			material = group['material'] = len(library.materials) - 1
+
+		print('Creating new mesh %i, %i faces, with material %i: %s' % (len(meshes) + 1, faces.size, material, library.materials[material].name))
+		mesh = create_mesh(vertices.view(), textures.view(), faces.view(), 0, faces.size, library, material, split_seams, load_textures)
+
+		# copy the arrays selected from the growable buffers, which would otherwise be kept alive by the mesh
+		mesh.vertices = np.array(mesh.vertices)
+		if mesh.textureCoords is not None:
+			mesh.textureCoords = np.array(mesh.textureCoords)
+		meshes.append(mesh)
+
+		group['faces'] = None
+
+	def parse_segment(data, start, end):
+		# the records between two usemtl records, or the ends of the chunk
+		for name in OBJ_RECORDS['material library'].findall(data, start, end):
+			libraries.append('models/{}'.format(name.decode().strip()))
+			for material in load_material_library(libraries[-1]).materials:
+				library.add_material(material)
+
+		records = OBJ_RECORDS['vertex'].findall(data, start, end)
+		if len(records) > 0:
+			vertices.append(parse_records(records, 3, 'f', 'vertex'))
+
+		records = OBJ_RECORDS['vertex texture'].findall(data, start, end)
+		if len(records) > 0:
+			textures.append(parse_records(records, 2, 'f', 'vertex texture'))
+
+		records = OBJ_RECORDS['face'].findall(data, start, end)
+		if len(records) > 0:
+			faces, _ = parse_faces(records)
+			if group['faces'] is None:
+				group['faces'] = GrowableArray(faces.shape[1:], np.uint32)
+			elif group['faces'].data.shape[1:] != faces.shape[1:]:
+				raise ValueError('Faces with different index formats in the same mesh')
+			group['faces'].append(faces)
+
+	with open(file_name, 'rb') as objfile:
+		rest = b''
+		while True:
+			block = objfile.read(chunk_size)
+
+			# the last line of the chunk may be incomplete, it is kept for the next chunk
+			data = rest + block
+			if len(block) > 0:
+				cut = data.rfind(b'\n') + 1
+				data, rest = data[:cut], data[cut:]
+
+			start = 0
+			for match in OBJ_RECORDS['material'].finditer(data):
+				parse_segment(data, start, match.start())
+				close_group()
+				group['material'] = library.names[match.group(1).decode().strip()]
+				start = match.end()
+			parse_segment(data, start, len(data))
+
+			# after the first chunk, the arrays are preallocated for the size expected for the whole file
+			if objfile.tell() == len(block) and len(block) < file_size:
+				scale = file_size / len(block)
+				vertices.reserve(int(vertices.size * scale * 1.1))
+				textures.reserve(int(textures.size * scale * 1.1))
+
+			if len(block) == 0:
+				break
+
+	close_group()
+
+	print('File read. Found {} vertices and {} mesh(es).'.format(vertices.size, len(meshes)))
+
+	return meshes, libraries
+
+
+def create_meshes_from_blender(vlist, flist, mlist, tlist, library, mesh_list, lnlist, split_seams=False, load_textures=True):
 	"""
 	Function for creating a list of Mesh objects from the data read from a Blender3D object file.
 	:param vlist: list of vertices
@@ -230,50 +403,39 @@ def create_meshes_from_blender(vlist, flist, mlist, tlist, library, mesh_list, l
 	:param library: material library
 	:param mesh_list: list of mesh ids
 	:param lnlist: list of line numbers
+	:param split_seams: [optional] duplicate the vertices used with several texture coordinates
+	:param load_textures: [optional] whether to load the textures of the materials
 	:return: a list of Mesh objects
 	"""
-	fstart = 0
-	mesh_id = 1
 	meshes = []
 
 	# we start by putting all vertices in one array
-	varray = np.array(vlist, dtype='f')
+	varray = np.asarray(vlist, dtype='f')
 
 	# and all texture vectors
-	tarray = np.array(tlist, dtype='f')
-
-	material = mlist[fstart]
-
-    # loop over all faces 
-	for f in range(len(flist)):
-		if mesh_id != mesh_list[f]:  # new mesh is denoted by change in material
-			print('Creating new mesh %i, faces %i-%i, line %i, with material %i: %s' % (mesh_id, fstart, f, lnlist[fstart], mlist[fstart], library.materials[mlist[fstart]].name))
-			try:
-				mesh = create_mesh(varray, tarray, flist, fstart, f, library, material)
-				meshes.append(mesh)
-			except Exception as e:
-				print('(W) could not load mesh!')
-				print(e)
-				raise
-
-			mesh_id = mesh_list[f]
-
-			# start the next mesh
-			fstart = f
-			material = mlist[fstart]
-
-	# add the last mesh
-	try:
-		meshes.append(create_mesh(varray, tarray, flist, fstart, len(flist), library, material))
-	except:
-		print('(W) could not load mesh!')
-		raise
+	tarray = np.asarray(tlist, dtype='f')
+
+	# new mesh is denoted by change in material, so we split the faces wherever the mesh id changes
+	splits = np.flatnonzero(np.diff(mesh_list)) + 1
+	starts = np.concatenate([[0], splits])
+	ends = np.concatenate([splits, [len(flist)]])
+
+	for mesh_id, (fstart, f) in enumerate(zip(starts, ends)):
+		material = mlist[fstart]
+		print('Creating new mesh %i, faces %i-%i, line %i, with material %i: %s' % (mesh_id + 1, fstart, f, lnlist[fstart], material, library.materials[material].name))
+		try:
+			mesh = create_mesh(varray, tarray, flist, fstart, f, library, material, split_seams, load_textures)
+			meshes.append(mesh)
+		except Exception as e:
+			print('(W) could not load mesh!')
+			print(e)
+			raise
 
 	print('--- Created {} mesh(es) from Blender file.'.format(len(meshes)))
 	return meshes
 
 
-def create_mesh(varray, tarray, flist, fstart, f, library, material):
+def create_mesh(varray, tarray, flist, fstart, f, library, material, split_seams=False, load_textures=True):
 	"""
 	Function for creating a Mesh object from the data read from a Blender3D object file.
 	:param varray: array of vertices
@@ -283,6 +445,9 @@ def create_mesh(varray, tarray, flist, fstart, f, library, material):
 	:param f: end index for faces
 	:param library: material library
 	:param material: material name
+	:param split_seams: [optional] duplicate the vertices used with several texture coordinates,
+	see split_texture_seams()
+	:param load_textures: [optional] whether to load the texture of the material
 	:return: a Mesh object
 	"""
 	# select faces for this mesh
@@ -292,39 +457,129 @@ def create_mesh(varray, tarray, flist, fstart, f, library, material):
 	vmax = np.max(farray[:, :, 0].flatten())
 	vmin = np.min(farray[:, :, 0].flatten()) - 1
 
-	# fix blender texture intexing
-	textures = fix_blender_textures(tarray, farray, varray)
-	if textures is not None:
-		textures = textures[vmin:vmax, :]
+	vertices = varray[vmin:vmax, :]
+
+	if split_seams:
+		farray[:, :, 0] -= vmin
+		vertices, faces, textures = split_texture_seams(tarray, farray, vertices)
+	else:
+		faces = farray[:, :, 0] - vmin - 1
+
+		# fix blender texture intexing
+		textures = fix_blender_textures(tarray, farray, varray)
+		if textures is not None:
+			textures = textures[vmin:vmax, :]
 
     # create the mesh
 	return Mesh(
-			vertices=varray[vmin:vmax, :],
-			faces=farray[:, :, 0] - vmin - 1,
+			vertices=vertices,
+			faces=faces,
 			material=library.materials[material],
-			textureCoords=textures
+			textureCoords=textures,
+			load_textures=load_textures
 		)
 
 
+def has_texture_indices(faces):
+	"""
+	Checks whether Blender faces provide texture indices (v/t or v/t/n format).
+	:param faces: Blender faces multiple-index
+	:return: True if there are texture indices
+	"""
+	if faces.shape[2] == 1 or not faces[:, :, 1].any():
+		print('(W) No texture indices provided, setting texture coordinate array as None!')
+		return False
+	return True
+
+
 def fix_blender_textures(textures, faces, vertices):
 	"""
 	Corrects the indexing of textures in Blender file for OpenGL.
 	Blender allows for multiple indexing of vertices and textures, which is not supported by OpenGL.
-	This function ensures that indexing is consistent.
+	This function ensures that indexing is consistent. When a vertex is used with several texture coordinates,
+	the one of its last occurrence in the faces is kept.
 	:param textures: Original Blender texture UV values
 	:param faces: Blender faces multiple-index
 	:return: a new texture array indexed according to vertices.
 	"""
 	# (OpenGL, unlike Blender, does not allow for multiple indexing!)
 
-	if faces.shape[2] == 1:
-		print('(W) No texture indices provided, setting texture coordinate array as None!')
+	if not has_texture_indices(faces):
 		return None
 
 	new_textures = np.zeros((vertices.shape[0], 2), dtype='f')
 
-	for f in range(faces.shape[0]):
-		for j in range(faces.shape[1]):
-			new_textures[faces[f, j, 0] - 1, :] = textures[faces[f, j, 1] - 1, :]
+	vertex_indices = faces[:, :, 0].ravel().astype(np.intp) - 1
+	texture_indices = faces[:, :, 1].ravel().astype(np.intp) - 1
+
+	# keep only the last occurrence of each vertex, so the result does not depend on the order of the scatter
+	_, last = np.unique(vertex_indices[::-1], return_index=True)
+	last = vertex_indices.shape[0] - 1 - last
+
+	new_textures[vertex_indices[last], :] = textures[texture_indices[last], :]
 
 	return new_textures
+
+
+def split_texture_seams(textures, faces, vertices):
+	"""
+	Corrects the indexing of textures in Blender file for OpenGL, like fix_blender_textures(), but duplicates
+	the vertices used with different texture coordinates (e.g. along texture seams) instead of keeping only one of them.
+	Each vertex keeps its index for the first of its texture coordinates, the duplicates are appended at the end.
+	:param textures: Original Blender texture UV values
+	:param faces: Blender faces multiple-index, with vertex indices starting at 1 in the vertices array
+	:param vertices: the vertex array
+	:return: a tuple (vertices, faces, textures) with faces the vertex indices of each face, starting at 0
+	"""
+	vertex_indices = faces[:, :, 0].ravel().astype(np.int64) - 1
+
+	if not has_texture_indices(faces):
+		return vertices, vertex_indices.reshape(faces.shape[:2]).astype(np.uint32), None
+
+	# texture indices pointing to the same UV values are merged, so they do not create duplicates
+	uv_values, uv_indices = np.unique(textures, axis=0, return_inverse=True)
+	uv_indices = uv_indices.ravel()[faces[:, :, 1].ravel().astype(np.intp) - 1]
+
+	# each distinct (vertex, UV) pair becomes one output vertex
+	pairs, corners = np.unique(vertex_indices * uv_values.shape[0] + uv_indices, return_inverse=True)
+	pair_vertex = pairs // uv_values.shape[0]
+	pair_uv = pairs % uv_values.shape[0]
+
+	# pairs are sorted by vertex, the first pair of each vertex keeps the original vertex index
+	first = np.ones(pairs.shape[0], dtype=bool)
+	first[1:] = pair_vertex[1:] != pair_vertex[:-1]
+	index = np.where(first, pair_vertex, vertices.shape[0] + np.cumsum(~first) - 1)
+
+	new_vertices = np.concatenate([vertices, vertices[pair_vertex[~first]]])
+	new_textures = np.zeros((new_vertices.shape[0], 2), dtype='f')
+	new_textures[index, :] = uv_values[pair_uv, :]
+
+	if np.count_nonzero(~first) > 0:
+		print('Split texture seams: {} vertices duplicated'.format(np.count_nonzero(~first)))
+
+	return new_vertices, index[corners.ravel()].reshape(faces.shape[:2]).astype(np.uint32), new_textures
+
+
+if __name__ == '__main__':
+	# benchmark the texture re-indexing on the shipped models: python blender.py
+	import contextlib
+	import glob
+	import io
+	import timeit
+
+	print('{:35s} {:>9s} {:>9s} {:>14s} {:>9s}'.format('model', 'vertices', 'fix (ms)', 'split (ms)', 'split +v'))
+	for name in sorted(glob.glob('models/*.obj') + glob.glob('models/*.OBJ')):
+		with open(name, 'rb') as objfile:
+			data = objfile.read()
+
+		# silence the parsing and splitting messages
+		with contextlib.redirect_stdout(io.StringIO()):
+			varray = parse_records(OBJ_RECORDS['vertex'].findall(data), 3, 'f', 'vertex')
+			tarray = parse_records(OBJ_RECORDS['vertex texture'].findall(data), 2, 'f', 'vertex texture')
+			farray, _ = parse_faces(OBJ_RECORDS['face'].findall(data))
+
+			fix = min(timeit.repeat(lambda: fix_blender_textures(tarray, farray, varray), number=1, repeat=5))
+			split = min(timeit.repeat(lambda: split_texture_seams(tarray, farray, varray), number=1, repeat=5))
+			duplicates = split_texture_seams(tarray, farray, varray)[0].shape[0] - varray.shape[0]
+
+		print('{:35s} {:9d} {:9.2f} {:14.2f} {:9d}'.format(name, varray.shape[0], 1000*fix, 1000*split, duplicates))
@@ -0,0 +1,378 @@
+# Description: This file contains the BVH class, a bounding volume hierarchy over the models of a scene.
+
+import numpy as np
+
+from matutils import *
+
+# maximum number of models in a leaf of the hierarchy
+LEAF_SIZE = 4
+
+
+class BVH:
+    """
+    A bounding volume hierarchy over the world-space bounds of models, used to find the models in a view frustum,
+    along a ray or near a point without testing all of them. The tree is stored in arrays: each node covers
+    a contiguous range of self.order, the list of model indices sorted so that the models of each subtree
+    are next to each other. Models only need to provide local_bounds() and a model matrix M, like BaseModel.
+    """
+    def __init__(self, models=[], leaf_size=LEAF_SIZE):
+        """
+        Initialises the hierarchy. The tree is built on the first query.
+        :param models: [optional] the list of models to add
+        :param leaf_size: [optional] the maximum number of models in a leaf
+        """
+        self.leaf_size = leaf_size
+
+        # all models added, and the models without bounds which are returned by all frustum queries
+        self.models = list(models)
+        self.unbounded = []
+
+        # the models in the tree and their world bounds
+        self.items = []
+        self.index = {}
+        self.boxes = np.zeros((0, 2, 3))
+        self.spheres = np.zeros((0, 4))
+
+        # the tree must be rebuilt before the next query
+        self.dirty = True
+
+    def __len__(self):
+        return len(self.models)
+
+    def add(self, model):
+        """
+        Adds a model. The tree is rebuilt on the next query.
+        :param model: the model to add
+        :return: None
+        """
+        self.models.append(model)
+        self.dirty = True
+
+    def add_models(self, models):
+        """
+        Adds a list of models. The tree is rebuilt on the next query.
+        :param models: the list of models to add
+        :return: None
+        """
+        self.models += models
+        self.dirty = True
+
+    def remove(self, model):
+        """
+        Removes a model. The tree is rebuilt on the next query.
+        :param model: the model to remove
+        :return: None
+        """
+        self.models.remove(model)
+        self.dirty = True
+
+    def world_bounds(self, models):
+        """
+        Computes the world bounds of a list of models with bounds, all at once.
+        :param models: the list of models
+        :return: the arrays of boxes (n, 2, 3) and spheres (n, 4)
+        """
+        bounds = [model.local_bounds() for model in models]
+        return transformBounds(
+            np.array([box for box, sphere in bounds]).reshape(-1, 2, 3),
+            np.array([sphere for box, sphere in bounds]).reshape(-1, 4),
+            np.array([model.M for model in models]).reshape(-1, 4, 4)
+        )
+
+    def build(self):
+        """
+        Builds the tree from scratch, splitting the models of each node in two halves along the longest axis
+        of the box containing their centers.
+        :return: None
+        """
+        self.items = [model for model in self.models if model.local_bounds() is not None]
+        self.unbounded = [model for model in self.models if model.local_bounds() is None]
+        self.index = {id(model): i for i, model in enumerate(self.items)}
+        self.boxes, self.spheres = self.world_bounds(self.items)
+
+        n = len(self.items)
+        centers = self.boxes.mean(axis=1)
+        self.order = np.arange(n)
+
+        starts, ends, lefts, rights, parents, depths = [], [], [], [], [], []
+
+        # nodes are created depth first, so that the children of a node always come after it
+        stack = [(0, n, -1, 0)] if n > 0 else []
+        while len(stack) > 0:
+            start, end, parent, depth = stack.pop()
+            node = len(starts)
+            starts.append(start)
+            ends.append(end)
+            lefts.append(-1)
+            rights.append(-1)
+            parents.append(parent)
+            depths.append(depth)
+
+            if parent >= 0:
+                if lefts[parent] == -1:
+                    lefts[parent] = node
+                else:
+                    rights[parent] = node
+
+            if end - start > self.leaf_size:
+                indices = self.order[start:end]
+                axis = np.argmax(np.ptp(centers[indices], axis=0))
+                middle = (end - start) // 2
+                self.order[start:end] = indices[np.argpartition(centers[indices, axis], middle)]
+
+                # the left child is popped first
+                stack.append((start + middle, end, node, depth + 1))
+                stack.append((start, start + middle, node, depth + 1))
+
+        self.starts = np.array(starts, dtype=np.intp)
+        self.ends = np.array(ends, dtype=np.intp)
+        self.lefts = np.array(lefts, dtype=np.intp)
+        self.rights = np.array(rights, dtype=np.intp)
+        self.parents = np.array(parents, dtype=np.intp)
+        self.leaves = self.lefts == -1
+
+        # the leaves tile self.order, sorting them by start gives the ranges for np.minimum.reduceat
+        self.leaf_nodes = np.flatnonzero(self.leaves)
+        self.leaf_nodes = self.leaf_nodes[np.argsort(self.starts[self.leaf_nodes])]
+
+        # the leaf containing each model, to refit the tree from a moved model
+        self.leaf_of = np.zeros(n, dtype=np.intp)
+        for node in self.leaf_nodes:
+            self.leaf_of[self.order[self.starts[node]:self.ends[node]]] = node
+
+        # the inner nodes grouped by depth, deepest first, to refit a whole level at once
+        depths = np.array(depths, dtype=np.intp)
+        inner = np.flatnonzero(~self.leaves)
+        self.levels = [inner[depths[inner] == depth] for depth in range(depths.max(initial=0), -1, -1)]
+
+        self.node_boxes = np.zeros((len(starts), 2, 3))
+        self.dirty = False
+        self.refit_nodes()
+
+    def refit_nodes(self):
+        """
+        Recomputes the boxes of all nodes from the boxes of the models, without changing the tree.
+        :return: None
+        """
+        if len(self.items) == 0:
+            return
+
+        boxes = self.boxes[self.order]
+        starts = self.starts[self.leaf_nodes]
+        self.node_boxes[self.leaf_nodes, 0] = np.minimum.reduceat(boxes[:, 0], starts, axis=0)
+        self.node_boxes[self.leaf_nodes, 1] = np.maximum.reduceat(boxes[:, 1], starts, axis=0)
+
+        for level in self.levels:
+            left = self.node_boxes[self.lefts[level]]
+            right = self.node_boxes[self.rights[level]]
+            self.node_boxes[level, 0] = np.minimum(left[:, 0], right[:, 0])
+            self.node_boxes[level, 1] = np.maximum(left[:, 1], right[:, 1])
+
+    def refit(self, models=None):
+        """
+        Updates the tree after models moved. Only the boxes are updated, so the tree becomes less efficient if the
+        models move far from their neighbours; call build() again in this case.
+        :param models: [optional] the models that moved, by default all models
+        :return: None
+        """
+        if self.dirty:
+            self.build()
+            return
+
+        if models is None:
+            self.boxes, self.spheres = self.world_bounds(self.items)
+            self.refit_nodes()
+            return
+
+        indices = [self.index[id(model)] for model in models if id(model) in self.index]
+        if len(indices) == 0:
+            return
+
+        self.boxes[indices], self.spheres[indices] = self.world_bounds([self.items[i] for i in indices])
+
+        # update the nodes from the leaf of each model up to the root
+        for i in indices:
+            node = self.leaf_of[i]
+            box = self.boxes[self.order[self.starts[node]:self.ends[node]]]
+            self.node_boxes[node] = box[:, 0].min(axis=0), box[:, 1].max(axis=0)
+            node = self.parents[node]
+            while node >= 0:
+                left = self.node_boxes[self.lefts[node]]
+                right = self.node_boxes[self.rights[node]]
+                self.node_boxes[node] = np.minimum(left[0], right[0]), np.maximum(left[1], right[1])
+                node = self.parents[node]
+
+    def traverse(self, overlaps, contains=None):
+        """
+        Finds the models whose node overlaps a volume, testing all the nodes of a level of the tree at once.
+        :param overlaps: a function taking an array of boxes (n, 2, 3) and returning a boolean array, False
+        for the boxes that are entirely outside the volume
+        :param contains: [optional] a function returning True for the boxes entirely inside the volume,
+        whose models are accepted without testing the children
+        :return: a tuple (indices of the models inside the volume, indices of the models to test individually)
+        """
+        if self.dirty:
+            self.build()
+
+        inside = []
+        candidates = []
+
+        frontier = np.zeros(1 if len(self.items) > 0 else 0, dtype=np.intp)
+        while frontier.size > 0:
+            boxes = self.node_boxes[frontier]
+            frontier = frontier[overlaps(boxes)]
+
+            if contains is not None:
+                full = contains(self.node_boxes[frontier])
+                inside += [self.order[self.starts[node]:self.ends[node]] for node in frontier[full]]
+                frontier = frontier[~full]
+
+            leaves = self.leaves[frontier]
+            candidates += [self.order[self.starts[node]:self.ends[node]] for node in frontier[leaves]]
+
+            inner = frontier[~leaves]
+            frontier = np.concatenate([self.lefts[inner], self.rights[inner]])
+
+        return np.concatenate(inside + [np.zeros(0, dtype=np.intp)]), \
+            np.concatenate(candidates + [np.zeros(0, dtype=np.intp)])
+
+    def query_frustum(self, planes):
+        """
+        Finds the models at least partly inside a view frustum.
+        :param planes: the 6x4 array of frustum planes, see frustumPlanes()
+        :return: the list of models inside the frustum, followed by the models without bounds
+        """
+        normals = planes[:, :3]
+
+        def corners(boxes, farthest):
+            # the corner of each box farthest along (or against) the normal of each plane, and its distance
+            select = (normals >= 0) == farthest
+            corner = np.where(select, boxes[:, None, 1], boxes[:, None, 0])
+            return (corner * normals).sum(axis=2) + planes[:, 3]
+
+        inside, candidates = self.traverse(
+            lambda boxes: (corners(boxes, True) >= 0).all(axis=1),
+            lambda boxes: (corners(boxes, False) >= 0).all(axis=1)
+        )
+        candidates = candidates[inFrustum(planes, self.boxes[candidates], self.spheres[candidates])]
+
+        return [self.items[i] for i in np.sort(np.concatenate([inside, candidates]))] + self.unbounded
+
+    def query_ray(self, origin, direction, max_distance=np.inf):
+        """
+        Finds the models whose bounding box is hit by a ray.
+        :param origin: the origin of the ray
+        :param direction: the direction of the ray
+        :param max_distance: [optional] the maximum distance along the ray, in units of the direction length
+        :return: a list of tuples (distance, model), sorted from the nearest to the farthest
+        """
+        origin = np.asarray(origin, dtype=np.float64)
+        with np.errstate(divide='ignore'):
+            inverse = 1.0 / np.asarray(direction, dtype=np.float64)
+
+        def intervals(boxes):
+            # slab test: the ray is inside the box between the largest entry and the smallest exit distances
+            # fmin/fmax ignore the NaN obtained for a ray parallel to a face and starting on it
+            with np.errstate(invalid='ignore'):
+                t0 = (boxes[:, 0] - origin) * inverse
+                t1 = (boxes[:, 1] - origin) * inverse
+            entry = np.fmax(np.fmin(t0, t1).max(axis=1), 0.0)
+            leave = np.fmin(np.fmax(t0, t1).min(axis=1), max_distance)
+            return entry, leave
+
+        def overlaps(boxes):
+            entry, leave = intervals(boxes)
+            return entry <= leave
+
+        inside, candidates = self.traverse(overlaps)
+        entry, leave = intervals(self.boxes[candidates])
+        hits = entry <= leave
+
+        return sorted(zip(entry[hits], [self.items[i] for i in candidates[hits]]), key=lambda hit: hit[0])
+
+    def query_sphere(self, center, radius):
+        """
+        Finds the models whose bounding volumes intersect a sphere.
+        :param center: the center of the sphere
+        :param radius: the radius of the sphere
+        :return: the list of models
+        """
+        center = np.asarray(center, dtype=np.float64)
+
+        def overlaps(boxes):
+            # distance from the center to the closest point of each box
+            closest = np.clip(center, boxes[:, 0], boxes[:, 1])
+            return ((closest - center)**2).sum(axis=1) <= radius**2
+
+        inside, candidates = self.traverse(overlaps)
+        spheres = self.spheres[candidates]
+        near = np.linalg.norm(spheres[:, :3] - center, axis=1) <= radius + spheres[:, 3]
+        candidates = candidates[near & overlaps(self.boxes[candidates])]
+
+        return [self.items[i] for i in np.sort(candidates)]
+
+
+if __name__ == '__main__':
+    # benchmark the hierarchy against testing all models: python bvh.py
+    import timeit
+
+    class BenchmarkModel:
+        """
+        A model with a unit cube as bounds, without any OpenGL data.
+        """
+        def __init__(self, M):
+            self.M = M
+
+        def local_bounds(self):
+            return np.array([[-1., -1., -1.], [1., 1., 1.]]), np.array([0., 0., 0., np.sqrt(3.)])
+
+    def best(function, number):
+        return 1000 * min(timeit.repeat(function, number=number, repeat=5)) / number
+
+    rng = np.random.default_rng(0)
+
+    # a camera looking at the center of the park from its edge, with the projection of the scene
+    PV = np.matmul(frustumMatrix(-1.0, 1.0, -1.0, 1.0, 1.0, 100.0), translationMatrix([0, 0, -100]))
+    planes = frustumPlanes(PV)
+
+    print('{:>9s} {:>10s} {:>10s} {:>12s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s}'.format(
+        'models', 'build', 'refit', 'refit one', 'frustum', 'flat', 'ray', 'flat', 'sphere'))
+    for n in [100, 1000, 10000]:
+        # models spread on the ground of a park whose area grows with their number
+        size = 10 * np.sqrt(n)
+        models = [
+            BenchmarkModel(poseMatrix(position=[x, 0, z]))
+            for x, z in rng.uniform(-size / 2, size / 2, (n, 2))
+        ]
+        bvh = BVH(models)
+
+        build = best(bvh.build, 1)
+        refit = best(bvh.refit, 1)
+        refit_one = best(lambda: bvh.refit(models[:1]), 100)
+        frustum = best(lambda: bvh.query_frustum(planes), 10)
+
+        def flat_frustum():
+            boxes, spheres = bvh.world_bounds(models)
+            return [model for model, inside in zip(models, inFrustum(planes, boxes, spheres)) if inside]
+
+        flat = best(flat_frustum, 10)
+        assert len(flat_frustum()) == len(bvh.query_frustum(planes))
+
+        origin, direction = [-size, 0.5, 0.3], [1, 0, 0]
+        ray = best(lambda: bvh.query_ray(origin, direction), 10)
+
+        def flat_ray():
+            boxes, spheres = bvh.world_bounds(models)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t0 = (boxes[:, 0] - origin) / direction
+                t1 = (boxes[:, 1] - origin) / direction
+            return np.fmax(np.fmin(t0, t1).max(axis=1), 0) <= np.fmax(t0, t1).min(axis=1)
+
+        flat_ray_time = best(flat_ray, 10)
+        assert np.count_nonzero(flat_ray()) == len(bvh.query_ray(origin, direction))
+
+        sphere = best(lambda: bvh.query_sphere([0, 0, 0], 10), 10)
+
+        print('{:9d} {:10.3f} {:10.3f} {:12.3f} {:10.3f} {:10.3f} {:10.3f} {:10.3f} {:10.3f}'.format(
+            n, build, refit, refit_one, frustum, flat, ray, flat_ray_time, sphere))
+    print('(times in ms, "flat" tests the world bounds of all models like Scene.cull without a hierarchy)')
@@ -2,10 +2,20 @@
 
 from texture import *
 from mesh import Mesh
-from BaseModel import DrawModelFromMesh
+from BaseModel import DrawModelFromMesh, PASS_OVERLAY
 from matutils import *
 from shaders import *
 
+# the file of each face of a cube map loaded from a folder
+CUBE_FACE_FILES = {
+    GL_TEXTURE_CUBE_MAP_NEGATIVE_X: 'left.bmp',
+    GL_TEXTURE_CUBE_MAP_POSITIVE_Z: 'back.bmp',
+    GL_TEXTURE_CUBE_MAP_POSITIVE_X: 'right.bmp',
+    GL_TEXTURE_CUBE_MAP_NEGATIVE_Z: 'front.bmp',
+    GL_TEXTURE_CUBE_MAP_POSITIVE_Y: 'bottom.bmp',
+    GL_TEXTURE_CUBE_MAP_NEGATIVE_Y: 'top.bmp',
+}
+
 
 class FlattenedCubeShader(BaseShaderProgram):
     """
@@ -119,6 +129,9 @@ class FlattenCubeMap(DrawModelFromMesh):
         # Finishes initialising the mesh
         DrawModelFromMesh.__init__(self, scene=scene, M=poseMatrix(position=[0,0,+1]), mesh=mesh, shader=FlattenedCubeShader(), visible=False)
 
+        # drawn on top of the scene
+        self.render_pass = PASS_OVERLAY
+
     def set(self, cube):
         """
         Set the cube map texture to draw.
@@ -153,14 +166,7 @@ class CubeMap(Texture):
         self.target = GL_TEXTURE_CUBE_MAP # we set the texture target as a cube map
 
         # This dictionary contains the file name for each face, if loading from disk (otherwise ignored)
-        self.files = {
-            GL_TEXTURE_CUBE_MAP_NEGATIVE_X: 'left.bmp',
-            GL_TEXTURE_CUBE_MAP_POSITIVE_Z: 'back.bmp',
-            GL_TEXTURE_CUBE_MAP_POSITIVE_X: 'right.bmp',
-            GL_TEXTURE_CUBE_MAP_NEGATIVE_Z: 'front.bmp',
-            GL_TEXTURE_CUBE_MAP_POSITIVE_Y: 'bottom.bmp',
-            GL_TEXTURE_CUBE_MAP_NEGATIVE_Y: 'top.bmp',
-        }
+        self.files = dict(CUBE_FACE_FILES)
 
         # generate the texture.
         self.textureid = glGenTextures(1)
@@ -197,7 +203,7 @@ class CubeMap(Texture):
 
         for (key, value) in self.files.items():
             print('Loading texture: texture/{}/{}'.format(name, value))
-            img = ImageWrapper('{}/{}'.format(name, value))
+            img = load_image('{}/{}'.format(name, value))
 
             # convert the python image object to a plain byte array for passsing to OpenGL
             glTexImage2D(key, 0, self.format, img.width(), img.height(), 0, self.format, self.type, img.data(self.format))
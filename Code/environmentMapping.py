@@ -11,6 +11,10 @@ from shaders import *
 
 from framebuffer import Framebuffer
 
+from refreshScheduler import RefreshScheduler, FACES
+
+import time
+
 
 class EnvironmentShader(BaseShaderProgram):
     """
@@ -24,9 +28,7 @@ class EnvironmentShader(BaseShaderProgram):
         """
         BaseShaderProgram.__init__(self, name=name)
         self.add_uniform('sampler_cube')
-        self.add_uniform('VM')
-        self.add_uniform('VMiT')
-        self.add_uniform('VT')
+        self.add_uniform('MiT')
 
         self.map = map
 
@@ -38,37 +40,56 @@ class EnvironmentShader(BaseShaderProgram):
         :return: None
         """
 
-        glUseProgram(self.program)
+        render_state.use_program(self.program)
         if self.map is not None:
             unit = len(model.mesh.textures)
-            glActiveTexture(GL_TEXTURE0)
-            self.map.bind()
+            render_state.bind_texture(0, self.map)
             self.uniforms['sampler_cube'].bind(0)
 
-        P = model.scene.P  # get projection matrix from the scene
-        V = model.scene.camera.V  # get view matrix from the camera
-
-        # set the PVM matrix uniform
-        self.uniforms['PVM'].bind(np.matmul(P, np.matmul(V, M)))
+        # set the model matrix uniforms, the view and projection matrices are in the FrameData block
+        self.uniforms['M'].bind(M)
+        self.uniforms['MiT'].bind(np.linalg.inv(M[:3, :3]).transpose())
 
-        # set the PVM matrix uniform
-        self.uniforms['VM'].bind(np.matmul(V, M))
 
-        # set the PVM matrix uniform
-        self.uniforms['VMiT'].bind(np.linalg.inv(np.matmul(V, M))[:3, :3].transpose())
+# the faces of a cube map in the order of its layers, gl_Layer selecting the face in this order
+CUBE_FACES = [
+    GL_TEXTURE_CUBE_MAP_POSITIVE_X,
+    GL_TEXTURE_CUBE_MAP_NEGATIVE_X,
+    GL_TEXTURE_CUBE_MAP_POSITIVE_Y,
+    GL_TEXTURE_CUBE_MAP_NEGATIVE_Y,
+    GL_TEXTURE_CUBE_MAP_POSITIVE_Z,
+    GL_TEXTURE_CUBE_MAP_NEGATIVE_Z,
+]
 
-        self.uniforms['VT'].bind(V.transpose()[:3, :3])
+# the rotation of the view rendering each face of a cube map
+CUBE_FACE_ROTATIONS = {
+    GL_TEXTURE_CUBE_MAP_NEGATIVE_X: rotationMatrixY(-np.pi/2.0),
+    GL_TEXTURE_CUBE_MAP_POSITIVE_X: rotationMatrixY(+np.pi/2.0),
+    GL_TEXTURE_CUBE_MAP_NEGATIVE_Y: rotationMatrixX(+np.pi/2.0),
+    GL_TEXTURE_CUBE_MAP_POSITIVE_Y: rotationMatrixX(-np.pi/2.0),
+    GL_TEXTURE_CUBE_MAP_NEGATIVE_Z: rotationMatrixY(-np.pi),
+    GL_TEXTURE_CUBE_MAP_POSITIVE_Z: poseMatrix(),
+}
 
 
 class EnvironmentMappingTexture(CubeMap):
     """
-    This class implements a cube map for environment mapping
+    This class implements a cube map for environment mapping. By default the scene is rendered in the six faces in a
+    single pass: the whole cube map is attached to one framebuffer as a layered target, and each model is drawn once
+    with the layered variant of its shader (see BaseShaderProgram.layered_variant()), whose geometry shader sends each
+    triangle to the faces where the model is visible. Otherwise, or without geometry shaders, the scene is drawn
+    once per face.
+    The faces rendered at each frame are chosen by a RefreshScheduler: the layered pass is used when all faces are
+    refreshed at once, and the faces are rendered one by one otherwise.
     """
-    def __init__(self, width=200, height=200):
+    def __init__(self, width=200, height=200, layered=True, scheduler=None, position=[0., 0., 0.]):
         """
         Initialize the cube map
         :param width: width of the cube map
         :param height: height of the cube map
+        :param layered: [optional] whether to render the six faces in a single pass
+        :param scheduler: [optional] the RefreshScheduler choosing the faces to render, by default all faces every frame
+        :param position: [optional] the position of the centre of the cube map in the scene
         """
 
         CubeMap.__init__(self)
@@ -78,36 +99,74 @@ class EnvironmentMappingTexture(CubeMap):
         self.width = width
         self.height = height
 
-        # create the texture object
-        self.fbos = {
-            GL_TEXTURE_CUBE_MAP_NEGATIVE_X: Framebuffer(),
-            GL_TEXTURE_CUBE_MAP_POSITIVE_X: Framebuffer(),
-            GL_TEXTURE_CUBE_MAP_NEGATIVE_Y: Framebuffer(),
-            GL_TEXTURE_CUBE_MAP_POSITIVE_Y: Framebuffer(),
-            GL_TEXTURE_CUBE_MAP_NEGATIVE_Z: Framebuffer(),
-            GL_TEXTURE_CUBE_MAP_POSITIVE_Z: Framebuffer()
-        }
-
-        t = 0.0
-        self.views = {
-            GL_TEXTURE_CUBE_MAP_NEGATIVE_X: np.matmul(translationMatrix([0, 0, t]), rotationMatrixY(-np.pi/2.0)),
-            GL_TEXTURE_CUBE_MAP_POSITIVE_X: np.matmul(translationMatrix([0, 0, t]), rotationMatrixY(+np.pi/2.0)),
-            GL_TEXTURE_CUBE_MAP_NEGATIVE_Y: np.matmul(translationMatrix([0, 0, t]), rotationMatrixX(+np.pi/2.0)),
-            GL_TEXTURE_CUBE_MAP_POSITIVE_Y: np.matmul(translationMatrix([0, 0, t]), rotationMatrixX(-np.pi/2.0)),
-            GL_TEXTURE_CUBE_MAP_NEGATIVE_Z: np.matmul(translationMatrix([0, 0, t]), rotationMatrixY(-np.pi)),
-            GL_TEXTURE_CUBE_MAP_POSITIVE_Z: translationMatrix([0, 0, t]),
-        }
+        self.scheduler = scheduler if scheduler is not None else RefreshScheduler(policy='continuous')
+
+        # the projection of each face
+        self.P = frustumMatrix(-1.0, +1.0, -1.0, +1.0, 1.0, 20.0)
+
+        # the rotation of the view of each face, the views also move the centre of the cube map to the origin
+        self.rotations = CUBE_FACE_ROTATIONS
+        self.set_position(position)
 
         self.bind()
         # set the texture parameters
-        for (face, fbo) in self.fbos.items():
+        for face in CUBE_FACES:
             glTexImage2D(face, 0, self.format, width, height, 0, self.format, self.type, None)
-            fbo.prepare(self, face)
         self.unbind()
 
+        # the depth buffer of the faces, so that the models hide each other in the reflections
+        self.depth = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_CUBE_MAP, self.depth)
+        for face in CUBE_FACES:
+            glTexImage2D(face, 0, GL_DEPTH_COMPONENT24, width, height, 0, GL_DEPTH_COMPONENT, GL_FLOAT, None)
+        glTexParameteri(GL_TEXTURE_CUBE_MAP, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_CUBE_MAP, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glBindTexture(GL_TEXTURE_CUBE_MAP, 0)
+
+        # layered framebuffers need OpenGL 3.2
+        self.layered = layered and bool(glFramebufferTexture)
+        if layered and not self.layered:
+            print('(W) Warning: layered rendering is not supported, rendering the environment map face by face')
+
+        if self.layered:
+            self.fbo = Framebuffer()
+            self.fbo.prepare_layered(self)
+            self.fbo.bind()
+            glFramebufferTexture(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, self.depth, 0)
+            self.fbo.unbind()
+
+            # the uniform buffer holding the projection times the view of each face, read by the geometry shaders
+            self.faces_buffer = glGenBuffers(1)
+            data = np.concatenate([np.transpose(np.matmul(self.P, self.rotations[face])).flatten() for face in CUBE_FACES])
+            glBindBuffer(GL_UNIFORM_BUFFER, self.faces_buffer)
+            data = data.astype(np.float32)
+            glBufferData(GL_UNIFORM_BUFFER, data.nbytes, data, GL_STATIC_DRAW)
+            glBindBuffer(GL_UNIFORM_BUFFER, 0)
+
+        # one framebuffer per face, to render the faces one by one
+        self.fbos = {face: Framebuffer() for face in CUBE_FACES}
+        for face, fbo in self.fbos.items():
+            fbo.prepare(self, face)
+            fbo.bind()
+            glFramebufferTexture2D(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, face, self.depth, 0)
+            fbo.unbind()
+
+    def set_position(self, position):
+        """
+        Moves the centre of the cube map. The faces are refreshed according to the policy of the scheduler.
+        :param position: the position of the centre in the scene
+        :return: None
+        """
+        self.position = np.array(position, dtype=np.float64)
+        T = translationMatrix(-self.position)
+        self.views = {face: np.matmul(R, T) for face, R in self.rotations.items()}
+
+        # the frustum of each face, in the order of the layers, to find the faces in which the models are visible
+        self.planes = [frustumPlanes(np.matmul(self.P, self.views[face])) for face in CUBE_FACES]
+
     def update(self, scene):
         """
-        Update the cube map
+        Update the faces of the cube map chosen by the scheduler
         :param scene: the scene to render
         :return: None
         """
@@ -115,30 +174,96 @@ class EnvironmentMappingTexture(CubeMap):
         if self.done:
             return
 
-        self.bind()
-        
-        # save the viewport
+        models = scene.reflected_models()
+        faces = self.scheduler.select(self.position, self.planes, scene.moved_models, models)
+        if len(faces) == 0:
+            return
+
+        # save the projection matrix, and set the projection matrix for the cube map
         Pscene = scene.P
-        
-        # set the projection matrix for the cube map
-        scene.P = frustumMatrix(-1.0, +1.0, -1.0, +1.0, 1.0, 20.0)
+        scene.P = self.P
 
         glViewport(0, 0, self.width, self.height)
-        
-        # render the scene to the cube map
-        for (face, fbo) in self.fbos.items():
-            fbo.bind()
-            #scene.camera.V = np.identity(4)
-            scene.camera.V = self.views[face]
-
-            scene.draw_reflections()
 
-            scene.camera.update()
-            fbo.unbind()
+        # render the scene to the cube map, in one pass if all faces are refreshed
+        spent = 0.0
+        if self.layered and len(faces) == FACES and self.scheduler.fits(spent, FACES):
+            start = time.perf_counter()
+            self.render_layered(scene, models)
+            self.scheduler.record(faces, 1000 * (time.perf_counter() - start))
+        else:
+            for face in faces:
+                if not self.scheduler.fits(spent):
+                    break
+                start = time.perf_counter()
+                self.render_face(scene, models, face)
+                elapsed = 1000 * (time.perf_counter() - start)
+                self.scheduler.record([face], elapsed)
+                spent += elapsed
 
         # reset the viewport
         glViewport(0, 0, scene.window_size[0], scene.window_size[1])
 
         scene.P = Pscene
+        scene.camera.update()
+        scene.update_frame_uniforms()
 
-        self.unbind()
+    def render_face(self, scene, models, face):
+        """
+        Renders the scene in one face of the cube map.
+        :param scene: the scene to render
+        :param models: the models to draw
+        :param face: the index of the face, in the order of CUBE_FACES
+        :return: None
+        """
+        fbo = self.fbos[CUBE_FACES[face]]
+        fbo.bind()
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+        scene.camera.V = self.views[CUBE_FACES[face]]
+        scene.update_frame_uniforms()
+        scene.draw_models(models)
+
+        fbo.unbind()
+
+    def render_layered(self, scene, models):
+        """
+        Renders the scene in all the faces of the cube map in a single pass. The models are culled against the
+        frustum of each face on the CPU, and the geometry shaders only send each triangle to the faces where its
+        model is visible.
+        :param scene: the scene to render
+        :param models: the models to draw
+        :return: None
+        """
+        # the geometry shaders only take triangles
+        skipped = [model for model in models if model.primitive != GL_TRIANGLES]
+        if len(skipped) > 0:
+            print('(W) Warning: {} models not made of triangles are not drawn in the environment map'.format(len(skipped)))
+            models = [model for model in models if model.primitive == GL_TRIANGLES]
+
+        # the faces in which each model is visible
+        for model in models:
+            model.face_mask = 0
+        for bit, face in enumerate(CUBE_FACES):
+            scene.camera.V = self.views[face]
+            for model in scene.cull(models):
+                model.face_mask |= 1 << bit
+
+        # the vertex shaders work in the frame of the centre of the cube map without projection, the geometry
+        # shaders then rotate and project the triangles in each face
+        V = translationMatrix(-self.position)
+        scene.camera.V = V
+        scene.frame_uniforms.update(np.identity(4), V, scene.light)
+        glBindBufferBase(GL_UNIFORM_BUFFER, CUBE_FACES_BINDING, self.faces_buffer)
+
+        self.fbo.bind()
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+        scene.layered = True
+        for model in models:
+            if model.face_mask != 0:
+                scene.render_queue.add(model, V)
+        scene.render_queue.submit()
+        scene.layered = False
+
+        self.fbo.unbind()
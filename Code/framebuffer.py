@@ -56,4 +56,39 @@ class Framebuffer:
             glDrawBuffer(GL_NONE)
             glReadBuffer(GL_NONE)
 
-        self.unbind()
\ No newline at end of file
+        self.unbind()
+
+    def prepare_layered(self, texture, level=0):
+        """
+        Prepare the Framebuffer by linking its output to all the layers of a texture, e.g. the six faces of a cube
+        map. The layer written by each primitive is then selected by gl_Layer in the geometry shader.
+        :param texture: The texture object to render to
+        :param level: The mipmap level (ignore)
+        :return: None
+        """
+
+        self.bind()
+        glFramebufferTexture(GL_FRAMEBUFFER, self.attachment, texture.textureid, level)
+        if self.attachment == GL_DEPTH_ATTACHMENT:
+            glDrawBuffer(GL_NONE)
+            glReadBuffer(GL_NONE)
+
+        self.unbind()
+
+    def prepare_layer(self, texture, layer, level=0):
+        """
+        Prepare the Framebuffer by linking its output to one layer of a texture array, e.g. one face of a cube map
+        array, whose layers are the faces of each cube map in turn.
+        :param texture: The texture object to render to
+        :param layer: The index of the layer
+        :param level: The mipmap level (ignore)
+        :return: None
+        """
+
+        self.bind()
+        glFramebufferTextureLayer(GL_FRAMEBUFFER, self.attachment, texture.textureid, level, layer)
+        if self.attachment == GL_DEPTH_ATTACHMENT:
+            glDrawBuffer(GL_NONE)
+            glReadBuffer(GL_NONE)
+
+        self.unbind()
@@ -1,5 +1,8 @@
 # Desc: This file contains the main code for the Jurassic Park scene.
 
+import sys
+import time
+
 import pygame
 
 # import the scene class
@@ -8,9 +11,9 @@ from scene import Scene
 
 from lightSource import LightSource
 
-from blender import load_obj_file
+from assetLoader import AssetLoader
 
-from BaseModel import DrawModelFromMesh
+from BaseModel import DrawModelFromMesh, InstancedModel
 
 from shaders import *
 
@@ -22,17 +25,76 @@ from skyBox import *
 
 from environmentMapping import *
 
+from refreshScheduler import POLICIES, RefreshScheduler
+
+from reflectionProbes import ProbeShader, ReflectionProbes
+
+from staticBatch import StaticBatch
+
+from vertexFormat import PACKED_FORMAT
+
+from texture import SAMPLING_PRESETS, material_sampling, texture_streamer
+
 import numpy as np
 
+# the maximum number of bytes of the streamed textures uploaded per frame
+TEXTURE_STREAMING_BUDGET = 1 << 20
+
+# the maximum anisotropy of the sampling of the textures of the models
+MATERIAL_ANISOTROPY = 8.0
+
+# the time in milliseconds the faces of the environment map can take per frame
+ENVIRONMENT_REFRESH_BUDGET = 2.0
+
+# the reflection probes placed across the park, one above each quarter of the roads
+PROBE_POSITIONS = [[-8., -18., -12.], [10., -18., -12.], [-8., -18., 8.], [10., -18., 8.]]
+
+# the time in milliseconds the faces of the reflection probes can take per frame once they are baked
+PROBE_REFRESH_BUDGET = 2.0
+
+# the number of frames drawn with each sampling preset by benchmark_sampling()
+BENCHMARK_FRAMES = 300
+
 class JurassicScene(Scene):
     """
     This class implements the Jurassic Park scene.
     """
-    def __init__(self):
+    def __init__(self, program_cache=False, vertex_format=None, parallel_loading=True, stream_textures=True, mipmaps='cpu', reflection_probes=True, cached_shadows=True):
         """
         Initialises the scene.
+        :param program_cache: [optional] whether to store the compiled shader programs on disk to speed up the next runs
+        :param vertex_format: [optional] the VertexFormat of the models loaded from files, see vertexFormat.py
+        :param parallel_loading: [optional] whether to load the models and images in background workers, see assetLoader.py
+        :param stream_textures: [optional] whether to upload the textures of the models over several frames, see TextureStreamer
+        :param mipmaps: [optional] how to build the mipmaps of the textures of the models, 'cpu', 'gpu' or None, see Texture
+        :param reflection_probes: [optional] whether the reflective models in the park reflect the nearest probes rather than the environment map, see ReflectionProbes
+        :param cached_shadows: [optional] whether to keep the shadows of the static models between frames, see CascadedShadowMap
         """
+        start = time.perf_counter()
+
+        # the textures of the models are sampled with trilinear, anisotropic filtering, so that the distant city does
+        # not alias; this is set first as the asset loader prepares the mipmaps
+        material_sampling.update(sample=GL_LINEAR, mipmaps=mipmaps, anisotropy=MATERIAL_ANISOTROPY)
+
+        # all assets are requested before the window is created, so that the workers start as early as possible
+        assets = AssetLoader(parallel=parallel_loading)
+        for file_name in ['models/city.obj', 'models/postbox.obj', 'models/car.obj', 'models/tank.obj',
+                          'models/tank2.obj', 'models/3Roads.obj']:
+            assets.request_meshes(file_name)
+        assets.request_meshes('models/TRIKERATOPS_CAGE_MODEL.obj', lods=3)
+        assets.request_meshes('models/RAPTOR_CAGE_MODEL.obj', lods=3)
+        assets.request_cube_map('skybox/london')
+        assets.request_image('triceratops_diffuse.bmp')
+
         Scene.__init__(self)
+        self.start_time = start
+
+        if program_cache:
+            programs.enable_binary_cache()
+
+        # the models show a placeholder until their texture is uploaded, a slice of it each frame
+        if stream_textures:
+            texture_streamer.enable(budget=TEXTURE_STREAMING_BUDGET)
 
         # create the light source
         self.light = LightSource(self, position=[0., 8., 3.])
@@ -40,8 +102,10 @@ class JurassicScene(Scene):
         self.shaders='phong'
 
         # for shadow map rendering
-        self.shadows = ShadowMap(light=self.light)
-        self.show_shadow_map = ShowTexture(self, self.shadows)
+        # the shadows are received by the models of the park and the roads, see ShadowMappingShader
+        # the shadows of the models which never move are only drawn again when the light, the camera or a model moves
+        self.shadows = CascadedShadowMap(light=self.light, cached=cached_shadows)
+        self.show_shadow_map = ShowTexture(self, self.shadows, shader=ShowCascadeShader())
 
         # load the models
         # draw a skybox
@@ -49,30 +113,41 @@ class JurassicScene(Scene):
 
         self.show_light = DrawModelFromMesh(scene=self, M=poseMatrix(position=self.light.position, scale=0.2), mesh=Sphere(material=Material(Ka=[10,10,10])), shader=FlatShader())
 
-        self.environment = EnvironmentMappingTexture(width=400, height=400)
+        # the faces of the environment map are only drawn again when a model visible in them moves, within a budget
+        self.environment = EnvironmentMappingTexture(
+            width=400, height=400, scheduler=RefreshScheduler(policy='on_change', budget=ENVIRONMENT_REFRESH_BUDGET))
 
         self.sphere = DrawModelFromMesh(scene=self, M=poseMatrix(), mesh=Sphere(), shader=EnvironmentShader(map=self.environment))
 
+        # the probes are baked once all textures are uploaded, then only refreshed when a model moves nearby
+        self.probes = None
+        self.probes_baked = False
+        if reflection_probes:
+            self.probes = ReflectionProbes(PROBE_POSITIONS, policy='on_change', budget=PROBE_REFRESH_BUDGET)
+
         # triceratops
-        city = load_obj_file('models/city.obj')
-        self.city = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([7,-23,17]), scaleMatrix([0.02,0.08,0.02])), mesh=city[0], shader=PhongShader())
+        city = assets.load_meshes('models/city.obj')
+        self.city = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([7,-23,17]), scaleMatrix([0.02,0.08,0.02])), mesh=city[0], shader=ShadowMappingShader(shadow_map=self.shadows), vertex_format=vertex_format)
 
-        triceratops = load_obj_file('models/TRIKERATOPS_CAGE_MODEL.obj')
-        self.triceratops = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([0,-20,1.5]), scaleMatrix([0.4,0.4,0.4])), mesh=triceratops[0], shader=PhongShader())
+        # the scanned animals are simplified into levels of detail, drawn when they are small on screen
+        triceratops = assets.load_meshes('models/TRIKERATOPS_CAGE_MODEL.obj', lods=3)
+        self.triceratops = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([0,-20,1.5]), scaleMatrix([0.4,0.4,0.4])), mesh=triceratops[0], shader=ShadowMappingShader(shadow_map=self.shadows), vertex_format=vertex_format)
 
-        box = load_obj_file('models/postbox.obj')
-        self.box = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([-4,-20, 4]), scaleMatrix([10, 10, 10])), mesh=box[0], shader=PhongShader())
-        self.box2 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([-4,-20, -6]), scaleMatrix([10, 10, 10])), mesh=box[0], shader=PhongShader())
-        self.box3 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([8,-20, 4]), scaleMatrix([10, 10, 10])), mesh=box[0], shader=PhongShader())
-        self.box4 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([9,-20, -15]), scaleMatrix([10, 10, 10])), mesh=box[0], shader=PhongShader())
+        box = assets.load_meshes('models/postbox.obj')
+        self.boxes = InstancedModel(scene=self, instances=[
+            np.matmul(translationMatrix([-4,-20, 4]), scaleMatrix([10, 10, 10])),
+            np.matmul(translationMatrix([-4,-20, -6]), scaleMatrix([10, 10, 10])),
+            np.matmul(translationMatrix([8,-20, 4]), scaleMatrix([10, 10, 10])),
+            np.matmul(translationMatrix([9,-20, -15]), scaleMatrix([10, 10, 10])),
+        ], mesh=box[0], shader=InstancedPhongShader(), vertex_format=vertex_format)
 
-        car = load_obj_file('models/car.obj')
-        self.car = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([-12,-20, 5]), scaleMatrix([0.4, 0.4, 0.4])), mesh=car[0], shader=PhongShader())
+        car = assets.load_meshes('models/car.obj')
+        self.car = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([-12,-20, 5]), scaleMatrix([0.4, 0.4, 0.4])), mesh=car[0], shader=ShadowMappingShader(shadow_map=self.shadows), vertex_format=vertex_format)
 
-        tank = load_obj_file('models/tank.obj')
-        self.tank = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([-12,-20, 2]), scaleMatrix([0.015, 0.015, 0.015])), rotationMatrixY(1.5708)), mesh=tank[0], shader=PhongShader())
-        tank2 = load_obj_file('models/tank2.obj')
-        self.tank2 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([4,-20, -12]), scaleMatrix([0.015, 0.015, 0.015])), rotationMatrixY(4)), mesh=tank2[0], shader=PhongShader())
+        tank = assets.load_meshes('models/tank.obj')
+        self.tank = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([-12,-20, 2]), scaleMatrix([0.015, 0.015, 0.015])), rotationMatrixY(1.5708)), mesh=tank[0], shader=ShadowMappingShader(shadow_map=self.shadows), vertex_format=vertex_format)
+        tank2 = assets.load_meshes('models/tank2.obj')
+        self.tank2 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([4,-20, -12]), scaleMatrix([0.015, 0.015, 0.015])), rotationMatrixY(4)), mesh=tank2[0], shader=ShadowMappingShader(shadow_map=self.shadows), vertex_format=vertex_format)
 
         # Set the initial and target positions for the raptor
         self.raptor_start_position = np.array([-14,-20, -17])
@@ -81,72 +156,85 @@ class JurassicScene(Scene):
         self.lerp_factor = 0.0  # Initial interpolation factor
         self.total_rotation = 0.0  # Track the total rotation applied to the raptor
 
-        raptor = load_obj_file('models/RAPTOR_CAGE_MODEL.obj')
-        self.raptor = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([-14,-20, -17]), scaleMatrix([1, 1, 1])), mesh=raptor[0], shader=PhongShader())
-        self.raptor2 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([9,-20, 15]), scaleMatrix([1, 1, 1])), rotationMatrixY(4.71239)), mesh=raptor[0], shader=PhongShader())
-        self.raptor3 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([17,-20, -9]), scaleMatrix([1, 1, 1])), mesh=raptor[0], shader=EnvironmentShader(map=self.environment))
-
-        # road pieces
-        r1 = load_obj_file('models/3Roads.obj')
-        self.r1 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([-1.7,-20, -7]), scaleMatrix([0.8, 0.8, 0.8])), mesh=r1[0], shader=PhongShader())
-        self.r2 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([-1.7,-20, -4]), scaleMatrix([0.8, 0.8, 0.8])), mesh=r1[0], shader=PhongShader())
-        self.r3 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([-1.7,-20, -1]), scaleMatrix([0.8, 0.8, 0.8])), mesh=r1[0], shader=PhongShader())
-        self.r4 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([-1.7,-20, 2]), scaleMatrix([0.8, 0.8, 0.8])), mesh=r1[0], shader=PhongShader())
-        self.r5 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([-1.7,-20, 5]), scaleMatrix([0.8, 0.8, 0.8])), mesh=r1[0], shader=PhongShader())
-        self.r6 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([-1.7,-20, 8]), scaleMatrix([0.8, 0.8, 0.8])), mesh=r1[0], shader=PhongShader())
-        self.r7 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([-1.7,-20, 11]), scaleMatrix([0.8, 0.8, 0.8])), mesh=r1[0], shader=PhongShader())
-
-        self.r8 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([-4.7,-20, 2]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r9 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([-7.7,-20, 2]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r10 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([-10.7,-20, 2]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r11 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([-13.7,-20, 2]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r12 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([-15.7,-20, 2]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r13 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([1.5,-20, 2]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r14 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([4.5,-20, 2]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r15 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([7.5,-20, 2]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r16 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([10.5,-20, 2]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-
-        self.r17 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([10.5,-20, -7]), scaleMatrix([0.8, 0.8, 0.8])), mesh=r1[0], shader=PhongShader())
-        self.r18 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([10.5,-20, -4]), scaleMatrix([0.8, 0.8, 0.8])), mesh=r1[0], shader=PhongShader())
-        self.r19 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([10.5,-20, -1]), scaleMatrix([0.8, 0.8, 0.8])), mesh=r1[0], shader=PhongShader())
-
-        self.r20 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([10.5,-20, -9]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r21 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([13.5,-20, -9]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r22 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([16.5,-20, -9]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        
-        self.r23 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([1.5,-20, 12]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r24 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([4.5,-20, 12]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r25 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([7.5,-20, 12]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r26 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([-1.5,-20, 12]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        
-        self.r27 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([9,-20, 12]), scaleMatrix([0.8, 0.8, 0.8])), mesh=r1[0], shader=PhongShader())
-        self.r28 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([9,-20, 15]), scaleMatrix([0.8, 0.8, 0.8])), mesh=r1[0], shader=PhongShader())
-        self.r29 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([9,-20, 17]), scaleMatrix([0.8, 0.8, 0.8])), mesh=r1[0], shader=PhongShader())
-
-        self.r30 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([-1.7,-20, -8]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r31 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([-4.7,-20, -8]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r32 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([-7.7,-20, -8]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r33 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([-10.7,-20, -8]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r34 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([-13.7,-20, -8]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-
-        self.r35 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([-4.7,-20, -17]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r36 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([-7.7,-20, -17]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r37 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([-10.7,-20, -17]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r38 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([-13.7,-20, -17]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r39 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([-15.7,-20, -17]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r40 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([1.5,-20, -17]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r41 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([4.5,-20, -17]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r42 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([7.5,-20, -17]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r43 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([10.5,-20, -17]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-        self.r44 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([-1.7,-20, -17]), scaleMatrix([0.8, 0.8, 0.8])), rotationMatrixY(1.5708)), mesh=r1[0], shader=PhongShader())
-
-        self.r45 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([-12,-20, -14]), scaleMatrix([0.8, 0.8, 0.8])), mesh=r1[0], shader=PhongShader())
-        self.r46 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([-12,-20, -11]), scaleMatrix([0.8, 0.8, 0.8])), mesh=r1[0], shader=PhongShader())
+        raptor = assets.load_meshes('models/RAPTOR_CAGE_MODEL.obj', lods=3)
+        self.raptor = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([-14,-20, -17]), scaleMatrix([1, 1, 1])), mesh=raptor[0], shader=ShadowMappingShader(shadow_map=self.shadows), vertex_format=vertex_format)
+        self.raptor2 = DrawModelFromMesh(scene=self, M=np.matmul(np.matmul(translationMatrix([9,-20, 15]), scaleMatrix([1, 1, 1])), rotationMatrixY(4.71239)), mesh=raptor[0], shader=ShadowMappingShader(shadow_map=self.shadows), vertex_format=vertex_format)
+        reflection = EnvironmentShader(map=self.environment) if self.probes is None else ProbeShader(probes=self.probes)
+        self.raptor3 = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([17,-20, -9]), scaleMatrix([1, 1, 1])), mesh=raptor[0], shader=reflection, vertex_format=vertex_format)
+
+        # road pieces, which never move: they are merged in world coordinates and drawn with one call per chunk
+        # each piece is given by its position and whether it is turned to run along the x axis
+        roads = [
+            ([-1.7, -20, -7], False),
+            ([-1.7, -20, -4], False),
+            ([-1.7, -20, -1], False),
+            ([-1.7, -20, 2], False),
+            ([-1.7, -20, 5], False),
+            ([-1.7, -20, 8], False),
+            ([-1.7, -20, 11], False),
+            ([-4.7, -20, 2], True),
+            ([-7.7, -20, 2], True),
+            ([-10.7, -20, 2], True),
+            ([-13.7, -20, 2], True),
+            ([-15.7, -20, 2], True),
+            ([1.5, -20, 2], True),
+            ([4.5, -20, 2], True),
+            ([7.5, -20, 2], True),
+            ([10.5, -20, 2], True),
+            ([10.5, -20, -7], False),
+            ([10.5, -20, -4], False),
+            ([10.5, -20, -1], False),
+            ([10.5, -20, -9], True),
+            ([13.5, -20, -9], True),
+            ([16.5, -20, -9], True),
+            ([1.5, -20, 12], True),
+            ([4.5, -20, 12], True),
+            ([7.5, -20, 12], True),
+            ([-1.5, -20, 12], True),
+            ([9, -20, 12], False),
+            ([9, -20, 15], False),
+            ([9, -20, 17], False),
+            ([-1.7, -20, -8], True),
+            ([-4.7, -20, -8], True),
+            ([-7.7, -20, -8], True),
+            ([-10.7, -20, -8], True),
+            ([-13.7, -20, -8], True),
+            ([-4.7, -20, -17], True),
+            ([-7.7, -20, -17], True),
+            ([-10.7, -20, -17], True),
+            ([-13.7, -20, -17], True),
+            ([-15.7, -20, -17], True),
+            ([1.5, -20, -17], True),
+            ([4.5, -20, -17], True),
+            ([7.5, -20, -17], True),
+            ([10.5, -20, -17], True),
+            ([-1.7, -20, -17], True),
+            ([-12, -20, -14], False),
+            ([-12, -20, -11], False),
+        ]
+        r1 = assets.load_meshes('models/3Roads.obj')
+        road_shader = ShadowMappingShader(shadow_map=self.shadows)
+        road_pieces = []
+        for position, turned in roads:
+            M = np.matmul(translationMatrix(position), scaleMatrix([0.8, 0.8, 0.8]))
+            if turned:
+                M = np.matmul(M, rotationMatrixY(1.5708))
+            road_pieces.append(DrawModelFromMesh(scene=self, M=M, mesh=r1[0], shader=road_shader, static=True, vertex_format=vertex_format))
+        self.roads = StaticBatch(scene=self, models=road_pieces)
 
         self.flattened_cube = FlattenCubeMap(scene=self, cube=self.environment)
 
         # show the texture to the ticeratops
         self.show_texture = ShowTexture(self, Texture('triceratops_diffuse.bmp'))
+
+        # the models placed in the park, kept in the bounding volume hierarchy of the scene for culling and picking
+        self.park = [
+            self.triceratops, self.city, self.boxes, self.raptor, self.raptor2, self.raptor3,
+            self.car, self.tank, self.tank2,
+        ]
+        self.bvh.add_models(self.park + self.roads.chunks)
+
+        assets.close()
     
     def update_raptor_position(self):
         # Update the raptor's position and rotation
@@ -170,18 +258,23 @@ class JurassicScene(Scene):
             translationMatrix(self.raptor_current_position),
             np.matmul(rotationMatrixY(self.total_rotation), scaleMatrix([1, 1, 1]))
         )
+        self.bvh.refit([self.raptor])
 
-    def draw_shadow_map(self):
+    def shadow_casters(self):
         """
-        Draw the shadow map.
-        :return: None
+        Returns the models drawn in the shadow map: the park and the roads, culled to each cascade.
+        :return: the list of models
         """
+        return self.park + self.roads.chunks + self.models
 
-        # first we need to clear the scene, we also clear the depth buffer to handle occlusions
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-
-        for model in self.models:
-            model.draw()
+    def reflected_models(self):
+        """
+        Returns the models drawn in the environment map: the skybox and the park, except the models reflecting the
+        environment map itself.
+        :return: the list of models
+        """
+        park = [model for model in self.park + self.roads.chunks if not isinstance(model.shader, EnvironmentShader)]
+        return [self.skybox] + park + self.models
 
     def draw_reflections(self):
         """
@@ -189,10 +282,7 @@ class JurassicScene(Scene):
         :return: None
         """
 
-        self.skybox.draw()
-
-        for model in self.models:
-            model.draw()
+        self.draw_models(self.reflected_models())
 
 
     def draw(self, framebuffer=False):
@@ -201,9 +291,17 @@ class JurassicScene(Scene):
         :param framebuffer: Whether to render to a framebuffer or not.
         :return: None
         """
+        self.start_frame()
+
         # Update raptor position
         self.update_raptor_position()
 
+        # merge the static models again if one of them has moved
+        self.roads.update()
+
+        # upload the next slice of the textures being streamed
+        texture_streamer.update()
+
         # first we need to clear the scene, we also clear the depth buffer to handle occlusions
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
@@ -211,93 +309,41 @@ class JurassicScene(Scene):
         if not framebuffer:
             self.camera.update()
 
-        # first, we draw the skybox
-        self.skybox.draw()
+        # send the camera and light data to the shaders
+        self.update_frame_uniforms()
 
         # render the shadows
         self.shadows.render(self)
+        self.stats.update(self.shadows.stats())
+
+        # the skybox is drawn first by the render queue, as it does not write the depth buffer
+        models = [self.skybox]
 
         # when rendering the framebuffer we ignore the reflective object
         if not framebuffer:
 
             self.environment.update(self)
+            self.stats['environment faces refreshed'] = self.environment.scheduler.refreshed
+
+            # the probes would keep the placeholders of the textures being streamed if baked earlier
+            if self.probes is not None:
+                if not self.probes_baked and len(texture_streamer) == 0:
+                    self.probes.bake(self)
+                    self.probes_baked = True
+                else:
+                    self.probes.update(self)
+                self.stats['probe faces refreshed'] = self.probes.refreshed
 
-            self.triceratops.draw()
-            self.city.draw()
-            self.box.draw()
-            self.box2.draw()
-            self.box3.draw()
-            self.box4.draw()
-            self.raptor.draw()
-            self.raptor2.draw()
-            self.raptor3.draw()
-            self.car.draw()
-            self.tank.draw()
-            self.tank2.draw()
-
-            self.r1.draw()
-            self.r2.draw()
-            self.r3.draw()
-            self.r4.draw()
-            self.r5.draw()
-            self.r6.draw()
-            self.r7.draw()
-            self.r8.draw()
-            self.r9.draw()
-            self.r10.draw()
-            self.r11.draw()
-            self.r12.draw()
-            self.r13.draw()
-            self.r14.draw()
-            self.r15.draw()
-            self.r16.draw()
-            self.r17.draw()
-            self.r18.draw()
-            self.r19.draw()
-            self.r20.draw()
-            self.r21.draw()
-            self.r22.draw()
-            self.r23.draw()
-            self.r24.draw()
-            self.r25.draw()
-            self.r26.draw()
-            self.r27.draw()
-            self.r28.draw()
-            self.r29.draw()
-            self.r30.draw()
-            self.r31.draw()
-            self.r32.draw()
-            self.r33.draw()
-            self.r34.draw()
-            self.r35.draw()
-            self.r36.draw()
-            self.r37.draw()
-            self.r38.draw()
-            self.r39.draw()
-            self.r40.draw()
-            self.r41.draw()
-            self.r42.draw()
-            self.r43.draw()
-            self.r44.draw()
-            self.r45.draw()
-            self.r46.draw()
-
-            # if enabled, show flattened cube
-            self.flattened_cube.draw()
-
-            # if enabled, show texture
-            self.show_texture.draw()
-
-            self.show_shadow_map.draw()
-
-        # then we loop over all models in the list and draw them
-        for model in self.models:
-            model.draw()
-
-        self.show_light.draw()
+            # if enabled, show flattened cube, texture and shadow map on top of the scene
+            models += self.park + self.roads.chunks + [self.flattened_cube, self.show_texture, self.show_shadow_map]
+
+        # then we add all models in the list, and draw them sorted by shader, texture and material
+        models += self.models + [self.show_light]
+        self.draw_models(models, main_pass=True)
 
         # flip the two buffers once we are done drawing.
         if not framebuffer:
+            self.end_frame()
             pygame.display.flip()
 
     def keyboard(self, event):
@@ -323,12 +369,18 @@ class JurassicScene(Scene):
                 print('--> showing texture map')
                 self.show_texture.visible = True
 
+        # cycle through the cascades of the shadow map, then hide it
         if event.key == pygame.K_s:
-            if self.show_shadow_map.visible:
-                self.show_shadow_map.visible = False
-            else:
-                print('--> showing shadow map')
+            if not self.show_shadow_map.visible:
+                self.shadows.shown = 0
                 self.show_shadow_map.visible = True
+            elif self.shadows.shown + 1 < self.shadows.cascades:
+                self.shadows.shown += 1
+            else:
+                self.show_shadow_map.visible = False
+
+            if self.show_shadow_map.visible:
+                print('--> showing shadow map cascade {}'.format(self.shadows.shown))
 
         if event.key == pygame.K_1:
             print('--> using Flat shading')
@@ -364,6 +416,12 @@ class JurassicScene(Scene):
             glEnable(GL_CULL_FACE)
             glCullFace(GL_BACK)
 
+        elif event.key == pygame.K_e:
+            scheduler = self.environment.scheduler
+            scheduler.policy = POLICIES[(POLICIES.index(scheduler.policy) + 1) % len(POLICIES)]
+            scheduler.invalidate()
+            print('--> environment map refresh policy: {}'.format(scheduler.policy))
+
         elif event.key == pygame.K_BACKQUOTE:
             if glIsEnabled(GL_DEPTH_TEST):
                 print('--> disable GL_DEPTH_TEST')
@@ -373,9 +431,67 @@ class JurassicScene(Scene):
                 glEnable(GL_DEPTH_TEST)
 
 
-if __name__ == '__main__':
-    # initialises the scene object
-    scene = JurassicScene()
+def benchmark_sampling(scene, frames=BENCHMARK_FRAMES):
+    """
+    Draws the scene with each of the SAMPLING_PRESETS applied to the textures of the models, and prints the mean
+    frame time and GPU time. Sampling the mipmaps reads fewer and closer texels of the large textures on the distant
+    models, which lowers the GPU time when the draws are limited by the texture bandwidth.
+    :param scene: the JurassicScene object
+    :param frames: [optional] the number of frames drawn with each preset
+    :return: a dictionary with the mean frame and GPU times (ms) of each preset
+    """
+    # wait for the streamed textures, so that all presets sample the same images
+    while len(texture_streamer) > 0:
+        pygame.event.pump()
+        scene.draw()
+
+    textures = {id(texture): texture for model in scene.park + scene.roads.chunks for texture in model.mesh.textures}
+    memory = sum(texture.width * texture.height * 4 * (4 / 3 if texture.levels > 1 else 1) for texture in textures.values())
+    print('Benchmark of {} textures, {:.1f} MiB with their mipmaps'.format(len(textures), memory / (1 << 20)))
+
+    query = np.atleast_1d(glGenQueries(1))[0]
+    # PyOpenGL has no array type for the unsigned 64 bit results, so the signed variant is read
+    elapsed = np.zeros(1, dtype=np.int64)
+    results = {}
+    for name, preset in SAMPLING_PRESETS.items():
+        for texture in textures.values():
+            texture.set_sampling_parameter(**preset)
+
+        frame_times = []
+        gpu_times = []
+        for _ in range(frames):
+            pygame.event.pump()
+            glBeginQuery(GL_TIME_ELAPSED, query)
+            scene.draw()
+            glEndQuery(GL_TIME_ELAPSED)
+            glGetQueryObjecti64v(query, GL_QUERY_RESULT, elapsed)
+            gpu_times.append(elapsed[0] / 1e6)
+            frame_times.append(scene.stats['frame time (ms)'])
+
+        # the first frames with a new preset are not measured
+        results[name] = {
+            'frame time (ms)': float(np.mean(frame_times[frames // 10:])),
+            'gpu time (ms)': float(np.mean(gpu_times[frames // 10:])),
+        }
+        print('{:12s} frame {:7.2f} ms, GPU {:7.2f} ms'.format(
+            name, results[name]['frame time (ms)'], results[name]['gpu time (ms)']))
+
+    glDeleteQueries(1, [query])
+    return results
 
-    # starts drawing the scene
-    scene.run()
+
+if __name__ == '__main__':
+    # initialises the scene object, run with --serial to load the assets one after the other and compare the
+    # time to first frame
+    parallel = '--serial' not in sys.argv
+    print('Loading assets {}'.format('in parallel' if parallel else 'serially'))
+
+    # the compiled shader programs are only stored on disk and reused when run with --program-cache
+    program_cache = '--program-cache' in sys.argv
+    scene = JurassicScene(program_cache=program_cache, vertex_format=PACKED_FORMAT, parallel_loading=parallel)
+
+    # starts drawing the scene, or compares the sampling of the textures with --benchmark-sampling
+    if '--benchmark-sampling' in sys.argv:
+        benchmark_sampling(scene)
+    else:
+        scene.run()
@@ -1,5 +1,10 @@
 # Description: Material class and MaterialLibrary class
 
+import itertools
+
+# a counter shared by all materials, so that a version number identifies both the material and its state
+versions = itertools.count(1)
+
 class Material:
     """
     This class represents a material in the scene.
@@ -22,6 +27,18 @@ class Material:
         self.texture = texture
         self.alpha = 1.0
 
+    def __setattr__(self, name, value):
+        """
+        Sets an attribute and gives the material a new version, so that the shaders know
+        they need to upload its uniforms again.
+        :param name: The name of the attribute.
+        :param value: The new value.
+        :return: None
+        """
+        object.__setattr__(self, name, value)
+        if name != 'version':
+            object.__setattr__(self, 'version', next(versions))
+
 class MaterialLibrary:
     """
     This class represents a material library.
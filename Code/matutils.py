@@ -134,6 +134,66 @@ def frustumMatrix(l,r,t,b,n,f):
     )
 
 
+def frustumPlanes(PV):
+    """
+    Returns the planes of the view frustum of a projection-view matrix, with normals pointing inside.
+    :param PV: The product of the projection and view matrices
+    :return: A 6x4 array with one plane (a, b, c, d) per row, such that a*x + b*y + c*z + d is the
+    distance of point (x, y, z) to the plane
+    """
+    # left, right, bottom, top, near and far planes
+    planes = np.array([
+        PV[3] + PV[0], PV[3] - PV[0],
+        PV[3] + PV[1], PV[3] - PV[1],
+        PV[3] + PV[2], PV[3] - PV[2],
+    ])
+    return planes / np.linalg.norm(planes[:, :3], axis=1, keepdims=True)
+
+
+def transformBounds(boxes, spheres, M):
+    """
+    Transforms bounding boxes and spheres, all at once.
+    :param boxes: An array of n boxes, of shape (n, 2, 3) with the min and max corners of each box
+    :param spheres: An array of n spheres, of shape (n, 4) with the center and radius of each sphere
+    :param M: An array of n 4x4 transformation matrices
+    :return: The axis-aligned boxes containing the transformed boxes, and the transformed spheres
+    """
+    A = M[:, :3, :3]
+    t = M[:, :3, 3]
+
+    # transform the center of each box, and project its half size on the axes
+    centers = np.einsum('nij,nj->ni', A, boxes.mean(axis=1)) + t
+    extents = np.einsum('nij,nj->ni', np.abs(A), (boxes[:, 1] - boxes[:, 0]) / 2)
+
+    # the radius of the spheres is scaled by the largest scale factor
+    scales = np.linalg.norm(A, axis=1).max(axis=1)
+    sphere_centers = np.einsum('nij,nj->ni', A, spheres[:, :3]) + t
+
+    return np.stack([centers - extents, centers + extents], axis=1), \
+        np.column_stack([sphere_centers, spheres[:, 3] * scales])
+
+
+def inFrustum(planes, boxes, spheres):
+    """
+    Tests which bounding volumes intersect the view frustum, all at once.
+    :param planes: The 6x4 array of frustum planes, see frustumPlanes()
+    :param boxes: An array of n axis-aligned boxes, of shape (n, 2, 3)
+    :param spheres: An array of n spheres, of shape (n, 4)
+    :return: A boolean array, False for the volumes that are fully outside the frustum
+    """
+    normals = planes[:, :3]
+
+    # a sphere is outside if its center is farther than its radius behind one of the planes
+    distances = spheres[:, :3] @ normals.T + planes[:, 3]
+    inside = (distances >= -spheres[:, 3:]).all(axis=1)
+
+    # a box is outside if its corner farthest along the normal of one of the planes is behind it
+    corners = np.where(normals >= 0, boxes[:, None, 1], boxes[:, None, 0])
+    inside &= ((corners * normals).sum(axis=2) + planes[:, 3] >= 0).all(axis=1)
+
+    return inside
+
+
 # Homogeneous coordinates helpers
 def homog(v):
     """
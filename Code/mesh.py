@@ -3,20 +3,21 @@
 from material import Material
 import numpy as np
 
-from texture import Texture
+from texture import Texture, material_sampling
 
 
 class Mesh:
     """
     This class represents a mesh in the scene.
     """
-    def __init__(self, vertices=None, faces=None, normals=None, textureCoords=None, material=Material()):
+    def __init__(self, vertices=None, faces=None, normals=None, textureCoords=None, material=Material(), load_textures=True):
         '''
         Initialises a mesh object.
         :param vertices: A numpy array containing all vertices
         :param faces: [optional] An int array containing the vertex indices for all faces.
         :param normals: [optional] An array of normal vectors, calculated from the faces if not provided.
         :param material: [optional] An object containing the material information for this object
+        :param load_textures: [optional] whether to load the texture of the material, which needs an OpenGL context
         '''
         self.name = 'Unknown'
         self.vertices = vertices
@@ -28,6 +29,13 @@ class Mesh:
         self.tangents = None
         self.binormals = None
 
+        # bounding volumes in model coordinates, used for culling
+        self.bounds = None
+        self.sphere = None
+
+        # the faces of the simplified levels of detail, indexing the same vertices (see meshSimplifier.py)
+        self.lods = []
+
         # print some information about the mesh
         if vertices is not None:
             print('Creating mesh')
@@ -35,6 +43,8 @@ class Mesh:
             if faces is not None:
                 print('- {} faces'.format(self.faces.shape[0]))
 
+            self.calculate_bounds()
+
         # calculate normals if not provided
         if normals is None:
             if faces is None:
@@ -44,49 +54,77 @@ class Mesh:
         else:
             self.normals = normals
 
-        if material.texture is not None:
+        if material.texture is not None and load_textures:
             # load the texture e.g from a file
-            self.textures.append(Texture(material.texture))
+            self.textures.append(Texture(material.texture, **material_sampling))
 
 
+    def calculate_bounds(self):
+        """
+        Calculates the axis-aligned bounding box of the mesh, and a bounding sphere centred on the box.
+        :return: None
+        """
+        if self.vertices.shape[0] == 0:
+            return
+
+        vertices = np.asarray(self.vertices)
+        self.bounds = np.array([vertices.min(axis=0), vertices.max(axis=0)], dtype=np.float32)
+
+        center = self.bounds.mean(axis=0)
+        radius = np.sqrt(((vertices - center)**2).sum(axis=1).max())
+        self.sphere = np.append(center, radius).astype(np.float32)
+
     def calculate_normals(self):
         """
         Calculates the normals for each vertex in the mesh.
         :return: None
         1. calculate normal for each face using cross product
         2. set each vertex normal as the average of the normals over all faces it belongs to.
+        All faces are processed at once: the corners of each triangle are gathered by indexing the vertex
+        array with the faces, and the face vectors are summed on their vertices with np.bincount.
         """
 
-        self.normals = np.zeros((self.vertices.shape[0], 3), dtype='f')
-        if self.textureCoords is not None:
-            self.tangents = np.zeros((self.vertices.shape[0], 3), dtype='f')
-            self.binormals = np.zeros((self.vertices.shape[0], 3), dtype='f')
-
-        for f in range(self.faces.shape[0]):
-            # first calculate the face normal using the cross product of the triangle's sides
-            a = self.vertices[self.faces[f, 1]] - self.vertices[self.faces[f, 0]]
-            b = self.vertices[self.faces[f, 2]] - self.vertices[self.faces[f, 0]]
-            face_normal = np.cross(a, b)
-
-            # tangent
-            if self.textureCoords is not None:
-                txa = self.textureCoords[self.faces[f, 1], :] - self.textureCoords[self.faces[f, 0], :]
-                txb = self.textureCoords[self.faces[f, 2], :] - self.textureCoords[self.faces[f, 2], :]
-                face_tangent = txb[0]*a - txa[0]*b
-                face_binormal = -txb[1]*a + txa[1]*b
-
-            # blend normal on all 3 vertices
-            for j in range(3):
-                self.normals[self.faces[f, j], :] += face_normal
-                if self.textureCoords is not None:
-                    self.tangents[self.faces[f, j], :] += face_tangent
-                    self.binormals[self.faces[f, j], :] += face_binormal
-
-        # finally we need to normalize the vectors
-        self.normals /= np.linalg.norm(self.normals, axis=1, keepdims=True)
+        faces = self.faces.astype(np.intp)
+
+        # first calculate the face normals using the cross product of the triangles' sides
+        corners = self.vertices[faces]
+        a = corners[:, 1, :] - corners[:, 0, :]
+        b = corners[:, 2, :] - corners[:, 0, :]
+        self.normals = normalize_rows(accumulate_on_vertices(faces, np.cross(a, b), self.vertices.shape[0]))
+
+        # tangent
         if self.textureCoords is not None:
-            self.tangents /= np.linalg.norm(self.tangents, axis=1, keepdims=True)
-            self.binormals /= np.linalg.norm(self.binormals, axis=1, keepdims=True)
+            texture_corners = self.textureCoords[faces]
+            txa = texture_corners[:, 1, :] - texture_corners[:, 0, :]
+            txb = texture_corners[:, 2, :] - texture_corners[:, 0, :]
+            face_tangents = txb[:, [0]]*a - txa[:, [0]]*b
+            face_binormals = -txb[:, [1]]*a + txa[:, [1]]*b
+
+            self.tangents = normalize_rows(accumulate_on_vertices(faces, face_tangents, self.vertices.shape[0]))
+            self.binormals = normalize_rows(accumulate_on_vertices(faces, face_binormals, self.vertices.shape[0]))
+
+
+def accumulate_on_vertices(faces, values, n):
+    """
+    Sums per-face vectors on the vertices of each face.
+    :param faces: an int array of shape (faces, 3) containing the vertex indices for all faces
+    :param values: an array of shape (faces, 3) containing one vector per face
+    :param n: the number of vertices
+    :return: an array of shape (n, 3) containing for each vertex the sum of the vectors of its faces
+    """
+    indices = faces.ravel()
+    values = np.repeat(values, faces.shape[1], axis=0)
+    return np.stack([np.bincount(indices, weights=values[:, c], minlength=n) for c in range(values.shape[1])], axis=1)
+
+
+def normalize_rows(v):
+    """
+    Normalises each row of an array, rows of length zero (e.g. vertices not used by any face) are left to zero.
+    :param v: an array of vectors
+    :return: the normalised vectors, as a float32 array
+    """
+    norm = np.linalg.norm(v, axis=1, keepdims=True)
+    return np.divide(v, norm, out=np.zeros(v.shape, dtype='f'), where=norm > 0, casting='unsafe')
 
 
 class CubeMesh(Mesh):
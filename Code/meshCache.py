@@ -0,0 +1,245 @@
+# Description: This file contains the MeshCache class, which stores parsed meshes on disk in a binary format.
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from material import Material
+from mesh import Mesh
+
+# increment this when the content of the cached meshes changes, so that old cache entries are rebuilt
+CACHE_VERSION = 2
+
+# the per-mesh arrays stored in the cache, each one is saved in its own .npy file
+MESH_ARRAYS = ['vertices', 'faces', 'normals', 'textureCoords', 'tangents', 'binormals']
+
+
+def file_signature(file_name, sha1=True):
+    """
+    Returns the signature used to check whether a source file has changed since it was cached.
+    :param file_name: the name of the file
+    :param sha1: whether to compute the hash of the file content (reads the whole file)
+    :return: a dictionary with the path, size, modification time and (optionally) content hash of the file
+    """
+    stat = os.stat(file_name)
+    signature = {
+        'path': os.path.abspath(file_name),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+    }
+
+    if sha1:
+        digest = hashlib.sha1()
+        with open(file_name, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        signature['sha1'] = digest.hexdigest()
+
+    return signature
+
+
+class MeshCache:
+    """
+    This class stores the meshes loaded from a file on disk, so that the next run can skip parsing
+    the file and computing the normals. Each cached file has its own folder containing a manifest with
+    the signatures of the source files and the materials, and one .npy file per mesh array which is
+    memory mapped when loading.
+    """
+    def __init__(self, folder='cache/meshes'):
+        """
+        Initialises the cache.
+        :param folder: the folder where the cache entries are stored
+        """
+        self.folder = folder
+
+    def entry(self, file_name, options={}):
+        """
+        Returns the folder of the cache entry for a source file.
+        :param file_name: the name of the source file
+        :param options: [optional] the loading options used to create the meshes
+        :return: the path of the entry folder
+        """
+        path = os.path.abspath(file_name)
+        key = hashlib.sha1(json.dumps([path, options], sort_keys=True).encode()).hexdigest()[:12]
+        return os.path.join(self.folder, '{}-{}'.format(os.path.basename(file_name), key))
+
+    def is_valid(self, manifest, options={}):
+        """
+        Checks whether a cache entry is up to date with its source files.
+        A source file whose size and modification time are unchanged is assumed to be unchanged, otherwise
+        its content hash is compared, so that touching a file does not invalidate the cache.
+        :param manifest: the manifest of the cache entry
+        :param options: [optional] the loading options used to create the meshes
+        :return: True if the entry can be used
+        """
+        if manifest.get('version') != CACHE_VERSION or manifest.get('options') != options:
+            return False
+
+        for source in manifest['sources']:
+            if not os.path.isfile(source['path']):
+                return False
+
+            signature = file_signature(source['path'], sha1=False)
+            if signature['size'] != source['size']:
+                return False
+
+            if signature['mtime'] != source['mtime']:
+                if file_signature(source['path'])['sha1'] != source['sha1']:
+                    return False
+                source['mtime'] = signature['mtime']
+
+        return True
+
+    def load(self, file_name, options={}, load_textures=True):
+        """
+        Loads the meshes of a source file from the cache.
+        :param file_name: the name of the source file
+        :param options: [optional] the loading options used to create the meshes
+        :param load_textures: [optional] whether to load the textures of the materials, see Mesh
+        :return: a list of Mesh objects, or None if the file is not cached or the cache entry is stale
+        """
+        entry = self.entry(file_name, options)
+        manifest_file = os.path.join(entry, 'manifest.json')
+
+        if not os.path.isfile(manifest_file):
+            return None
+
+        try:
+            with open(manifest_file) as file:
+                manifest = json.load(file)
+            mtimes = [source['mtime'] for source in manifest['sources']]
+
+            if not self.is_valid(manifest, options):
+                print('(W) Mesh cache for {} is out of date, rebuilding'.format(file_name))
+                return None
+
+            # the source files were only touched, store the new modification times to avoid hashing them again
+            if mtimes != [source['mtime'] for source in manifest['sources']]:
+                self.write_manifest(entry, manifest)
+
+            print('Loading mesh(es) from cache: {}'.format(entry))
+
+            materials = [self.load_material(material) for material in manifest['materials']]
+
+            meshes = []
+            for i, description in enumerate(manifest['meshes']):
+                arrays = {
+                    name: np.load(os.path.join(entry, '{}_{}.npy'.format(i, name)), mmap_mode='r')
+                    for name in description['arrays']
+                }
+
+                mesh = Mesh(
+                    vertices=arrays.get('vertices'),
+                    faces=arrays.get('faces'),
+                    normals=arrays.get('normals'),
+                    textureCoords=arrays.get('textureCoords'),
+                    material=materials[description['material']],
+                    load_textures=load_textures
+                )
+                mesh.name = description['name']
+                mesh.tangents = arrays.get('tangents')
+                mesh.binormals = arrays.get('binormals')
+                mesh.lods = [
+                    np.load(os.path.join(entry, '{}_lod{}.npy'.format(i, level)), mmap_mode='r')
+                    for level in range(1, description.get('lods', 0) + 1)
+                ]
+                meshes.append(mesh)
+
+        except (OSError, ValueError, KeyError) as error:
+            print('(W) Could not read mesh cache for {}: {}'.format(file_name, error))
+            return None
+
+        print('--- Loaded {} mesh(es) from cache.'.format(len(meshes)))
+        return meshes
+
+    def save(self, file_name, meshes, dependencies=[], options={}):
+        """
+        Stores the meshes of a source file in the cache.
+        :param file_name: the name of the source file
+        :param meshes: the list of Mesh objects created from the file
+        :param dependencies: [optional] other files the meshes depend on, e.g. material libraries
+        :param options: [optional] the loading options used to create the meshes
+        :return: None
+        """
+        entry = self.entry(file_name, options)
+        temp = entry + '.tmp'
+
+        try:
+            if os.path.isdir(temp):
+                shutil.rmtree(temp)
+            os.makedirs(temp)
+
+            # meshes from the same file often share their material, so we only store each one once
+            materials = []
+            descriptions = []
+            for i, mesh in enumerate(meshes):
+                if not any(mesh.material is m for m in materials):
+                    materials.append(mesh.material)
+                material = next(j for j, m in enumerate(materials) if m is mesh.material)
+
+                arrays = [name for name in MESH_ARRAYS if getattr(mesh, name) is not None]
+                for name in arrays:
+                    np.save(os.path.join(temp, '{}_{}.npy'.format(i, name)), np.ascontiguousarray(getattr(mesh, name)))
+
+                # the faces of the levels of detail, numbered from 1 as level 0 is the mesh itself
+                for level, faces in enumerate(mesh.lods, start=1):
+                    np.save(os.path.join(temp, '{}_lod{}.npy'.format(i, level)), np.ascontiguousarray(faces))
+
+                descriptions.append({'name': mesh.name, 'material': material, 'arrays': arrays, 'lods': len(mesh.lods)})
+
+            manifest = {
+                'version': CACHE_VERSION,
+                'options': options,
+                'sources': [file_signature(name) for name in [file_name] + list(dependencies)],
+                'materials': [self.save_material(material) for material in materials],
+                'meshes': descriptions,
+            }
+            self.write_manifest(temp, manifest)
+
+            # swap the new entry in place of the old one
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.replace(temp, entry)
+
+        except OSError as error:
+            print('(W) Could not write mesh cache for {}: {}'.format(file_name, error))
+            return
+
+        print('--- Stored {} mesh(es) in cache: {}'.format(len(meshes), entry))
+
+    def write_manifest(self, entry, manifest):
+        """
+        Writes the manifest of a cache entry.
+        :param entry: the folder of the cache entry
+        :param manifest: the manifest dictionary
+        :return: None
+        """
+        with open(os.path.join(entry, 'manifest.json'), 'w') as file:
+            json.dump(manifest, file, indent=1)
+
+    def save_material(self, material):
+        """
+        Converts a material to a dictionary that can be stored in the manifest.
+        :param material: the Material object
+        :return: a dictionary of the material attributes
+        """
+        return {
+            name: value.tolist() if isinstance(value, np.ndarray) else value
+            for name, value in vars(material).items() if name != 'version'
+        }
+
+    def load_material(self, attributes):
+        """
+        Creates a material from the dictionary stored in the manifest.
+        :param attributes: the dictionary of material attributes
+        :return: a Material object
+        """
+        material = Material()
+        for name, value in attributes.items():
+            if name in ['Ka', 'Kd', 'Ks']:
+                value = np.array(value, 'f')
+            setattr(material, name, value)
+        return material
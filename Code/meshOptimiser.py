@@ -0,0 +1,219 @@
+# Description: This file contains the functions optimising the vertex and triangle order of meshes for the GPU.
+
+import numpy as np
+
+# the per-vertex arrays of a mesh, re-indexed together when vertices are welded or reordered
+VERTEX_ARRAYS = ['vertices', 'normals', 'colors', 'textureCoords', 'tangents', 'binormals']
+
+# number of entries of the vertex cache simulated by the triangle ordering, and by the ACMR measure
+CACHE_SIZE = 32
+ACMR_CACHE_SIZE = 16
+
+# default distance under which vertex attributes are considered equal when welding
+WELD_TOLERANCE = 1e-5
+
+# weights of the vertex scores of the triangle ordering (see T. Forsyth, Linear-Speed Vertex Cache Optimisation)
+LAST_TRIANGLE_SCORE = 0.75
+CACHE_DECAY_POWER = 1.5
+VALENCE_BOOST_SCALE = 2.0
+VALENCE_BOOST_POWER = 0.5
+
+
+def acmr(faces, cache_size=ACMR_CACHE_SIZE):
+    """
+    Computes the average cache miss ratio of a triangle list, the number of vertices transformed per triangle
+    with a FIFO post-transform vertex cache. It ranges from 0.5 (ideal, on large regular meshes) to 3.
+    :param faces: an int array of shape (triangles, 3) containing the vertex indices for all faces
+    :param cache_size: [optional] the number of vertices in the cache
+    :return: the average number of cache misses per triangle
+    """
+    if faces.shape[0] == 0:
+        return 0.0
+
+    # the time at which each vertex entered the cache, it is still there if less than cache_size misses happened since
+    entered = {}
+    misses = 0
+    for index in np.asarray(faces).ravel().tolist():
+        time = entered.get(index)
+        if time is None or misses - time >= cache_size:
+            entered[index] = misses
+            misses += 1
+
+    return misses / faces.shape[0]
+
+
+def weld_vertices(mesh, tolerance=WELD_TOLERANCE):
+    """
+    Merges the vertices of a mesh whose position, normal and texture coordinates are equal within a tolerance.
+    The values are compared after rounding them to a multiple of the tolerance, so that all vertices are welded
+    at once. The other attributes of the merged vertices are taken from the first of them.
+    :param mesh: the Mesh object, modified in place
+    :param tolerance: [optional] the rounding step of the compared attributes
+    :return: the number of vertices removed
+    """
+    keys = [getattr(mesh, name) for name in ['vertices', 'normals', 'textureCoords'] if getattr(mesh, name) is not None]
+    keys = np.round(np.concatenate(keys, axis=1) / tolerance).astype(np.int64)
+
+    _, first, remap = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    removed = mesh.vertices.shape[0] - first.shape[0]
+    if removed == 0:
+        return 0
+
+    # keep the welded vertices in the order of their first occurrence
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.shape[0])
+    reindex(mesh, first[order], rank[remap.ravel()])
+
+    return removed
+
+
+def optimise_triangle_order(faces, nvertices, cache_size=CACHE_SIZE):
+    """
+    Reorders the triangles of a mesh so that consecutive triangles share their vertices, to reuse the vertices in
+    the post-transform cache of the GPU. This is the greedy algorithm of T. Forsyth: each vertex gets a score from
+    its position in a simulated LRU cache and from the number of triangles still using it, and the triangle with
+    the highest score among those using the cached vertices is drawn next.
+    :param faces: an int array of shape (triangles, 3) containing the vertex indices for all faces
+    :param nvertices: the number of vertices
+    :param cache_size: [optional] the number of vertices in the simulated cache
+    :return: the array of triangle indices in drawing order
+    """
+    ntriangles = faces.shape[0]
+    if ntriangles == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    corners = np.asarray(faces, dtype=np.int64).ravel()
+    valence = np.bincount(corners, minlength=nvertices)
+
+    # the triangles using each vertex, the ones not drawn yet are kept at the start of the range of each vertex
+    triangles = (np.argsort(corners, kind='stable') // 3).tolist()
+    starts = (np.cumsum(valence) - valence).tolist()
+    remaining = valence.tolist()
+    faces = np.asarray(faces).tolist()
+
+    def vertex_score(position, count):
+        if count == 0:
+            return -1.0
+        score = 0.0
+        if position >= 0:
+            if position < 3:
+                score = LAST_TRIANGLE_SCORE
+            else:
+                score = (1.0 - (position - 3) / (cache_size - 3)) ** CACHE_DECAY_POWER
+        return score + VALENCE_BOOST_SCALE * count ** -VALENCE_BOOST_POWER
+
+    position = [-1] * nvertices
+    scores = [vertex_score(-1, count) for count in remaining]
+    drawn = [False] * ntriangles
+
+    order = []
+    cache = []
+    best = max(range(ntriangles), key=lambda t: sum(scores[v] for v in faces[t]))
+    next_triangle = 0
+    while len(order) < ntriangles:
+        if best < 0:
+            # no triangle uses a cached vertex, start again from the first triangle not drawn yet
+            while drawn[next_triangle]:
+                next_triangle += 1
+            best = next_triangle
+
+        drawn[best] = True
+        order.append(best)
+        triangle = faces[best]
+
+        # remove the triangle from the triangles left to draw for its vertices
+        for v in triangle:
+            start = starts[v]
+            last = start + remaining[v] - 1
+            i = triangles.index(best, start, last + 1)
+            triangles[i], triangles[last] = triangles[last], triangles[i]
+            remaining[v] -= 1
+
+        # the vertices of the triangle move to the front of the cache, pushing the others back
+        cache = list(dict.fromkeys(triangle)) + [v for v in cache if v not in triangle]
+        for v in cache[cache_size:]:
+            position[v] = -1
+        changed = cache
+        cache = cache[:cache_size]
+        for i, v in enumerate(cache):
+            position[v] = i
+
+        for v in changed:
+            scores[v] = vertex_score(position[v], remaining[v])
+
+        # the next triangle is the best one using a cached vertex
+        best = -1
+        best_score = -1.0
+        for v in changed:
+            for t in triangles[starts[v]:starts[v] + remaining[v]]:
+                a, b, c = faces[t]
+                score = scores[a] + scores[b] + scores[c]
+                if score > best_score and position[v] >= 0:
+                    best = t
+                    best_score = score
+
+    return np.array(order, dtype=np.int64)
+
+
+def optimise_vertex_order(faces, nvertices):
+    """
+    Renumbers the vertices of a mesh in the order in which the triangles first use them, so that the vertex fetches
+    of consecutive triangles read nearby memory. Vertices not used by any triangle are dropped.
+    :param faces: an int array of shape (triangles, 3) containing the vertex indices for all faces
+    :param nvertices: the number of vertices
+    :return: a tuple (order, remap) with order the old index of each new vertex, and remap the new index of each
+    old vertex (-1 for dropped vertices)
+    """
+    corners = np.asarray(faces, dtype=np.int64).ravel()
+    used, first = np.unique(corners, return_index=True)
+    order = used[np.argsort(first)]
+
+    remap = np.full(nvertices, -1, dtype=np.int64)
+    remap[order] = np.arange(order.shape[0])
+    return order, remap
+
+
+def reindex(mesh, order, remap):
+    """
+    Replaces the vertices of a mesh by a selection of them, and updates the faces.
+    :param mesh: the Mesh object, modified in place
+    :param order: the old index of each new vertex
+    :param remap: the new index of each old vertex
+    :return: None
+    """
+    for name in VERTEX_ARRAYS:
+        data = getattr(mesh, name)
+        if data is not None:
+            setattr(mesh, name, np.ascontiguousarray(np.asarray(data)[order]))
+
+    mesh.faces = remap[np.asarray(mesh.faces, dtype=np.int64)].astype(np.uint32)
+
+
+def optimise_mesh(mesh, tolerance=WELD_TOLERANCE, cache_size=CACHE_SIZE):
+    """
+    Prepares a triangle mesh for drawing: welds its duplicate vertices, reorders its triangles for the vertex cache
+    and then its vertices for the vertex fetches. Meshes made of quads are left unchanged.
+    :param mesh: the Mesh object, modified in place
+    :param tolerance: [optional] the rounding step of the attributes compared when welding
+    :param cache_size: [optional] the number of vertices in the cache simulated by the triangle ordering
+    :return: a dictionary with the number of welded vertices and the ACMR before and after the optimisation
+    """
+    if mesh.faces is None or mesh.faces.shape[1] != 3 or mesh.faces.shape[0] == 0:
+        return None
+
+    before = acmr(mesh.faces)
+    welded = weld_vertices(mesh, tolerance)
+
+    triangles = optimise_triangle_order(mesh.faces, mesh.vertices.shape[0], cache_size)
+    mesh.faces = np.asarray(mesh.faces)[triangles]
+
+    order, remap = optimise_vertex_order(mesh.faces, mesh.vertices.shape[0])
+    reindex(mesh, order, remap)
+
+    mesh.calculate_bounds()
+
+    stats = {'welded': welded, 'acmr before': before, 'acmr after': acmr(mesh.faces)}
+    print('Optimised mesh {}: {} vertices welded, ACMR {:.3f} -> {:.3f}'.format(
+        mesh.name, welded, stats['acmr before'], stats['acmr after']))
+    return stats
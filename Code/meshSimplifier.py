@@ -0,0 +1,168 @@
+# Description: This file contains the functions simplifying meshes into levels of detail (LOD).
+
+import heapq
+
+import numpy as np
+
+from meshOptimiser import optimise_triangle_order
+
+# the fraction of the triangles of the mesh kept at each level of detail after the full resolution one
+LOD_RATIOS = [0.5, 0.25, 0.125]
+
+# weight of the planes added along the open edges of the mesh, so that its outline is kept
+BOUNDARY_WEIGHT = 100.0
+
+
+def vertex_quadrics(vertices, faces):
+    """
+    Computes the error quadric of each vertex, the sum of the squared distance matrices to the planes of its faces,
+    weighted by the area of the faces. Open edges, used by a single face, add a plane perpendicular to their face.
+    :param vertices: the array of vertex positions
+    :param faces: an int array of shape (triangles, 3) containing the vertex indices for all faces
+    :return: an array of shape (vertices, 4, 4)
+    """
+    corners = vertices[faces]
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    areas = np.linalg.norm(normals, axis=1)
+    normals = np.divide(normals, areas[:, None], out=np.zeros_like(normals), where=areas[:, None] > 0)
+
+    planes = np.concatenate([normals, -(normals * corners[:, 0]).sum(axis=1, keepdims=True)], axis=1)
+    quadrics = np.zeros((vertices.shape[0], 4, 4))
+    face_quadrics = areas[:, None, None] * planes[:, :, None] * planes[:, None, :]
+    for corner in range(3):
+        np.add.at(quadrics, faces[:, corner], face_quadrics)
+
+    # the edges used by a single face
+    edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+    edge_faces = np.tile(np.arange(faces.shape[0]), 3)
+    _, index, counts = np.unique(np.sort(edges, axis=1), axis=0, return_index=True, return_counts=True)
+    open_edges = index[counts == 1]
+    if open_edges.shape[0] > 0:
+        a = vertices[edges[open_edges, 0]]
+        b = vertices[edges[open_edges, 1]]
+        length = np.linalg.norm(b - a, axis=1)
+        side = np.cross(b - a, normals[edge_faces[open_edges]])
+        norm = np.linalg.norm(side, axis=1, keepdims=True)
+        side = np.divide(side, norm, out=np.zeros_like(side), where=norm > 0)
+        side_planes = np.concatenate([side, -(side * a).sum(axis=1, keepdims=True)], axis=1)
+        side_quadrics = (BOUNDARY_WEIGHT * length**2)[:, None, None] * side_planes[:, :, None] * side_planes[:, None, :]
+        np.add.at(quadrics, edges[open_edges, 0], side_quadrics)
+        np.add.at(quadrics, edges[open_edges, 1], side_quadrics)
+
+    return quadrics
+
+
+def simplify(vertices, faces, targets):
+    """
+    Simplifies a triangle mesh by collapsing its edges in the order of their quadric error (M. Garland and
+    P. Heckbert, Surface Simplification Using Quadric Error Metrics). Each edge is collapsed on one of its two
+    vertices, so that the simplified meshes use a subset of the original vertices and can share its vertex buffer.
+    Collapses which would flip a face are skipped.
+    :param vertices: the array of vertex positions
+    :param faces: an int array of shape (triangles, 3) containing the vertex indices for all faces
+    :param targets: the decreasing numbers of triangles at which the faces are returned
+    :return: the list of face arrays, one per target, indexing the original vertices
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    quadrics = vertex_quadrics(vertices, np.asarray(faces, dtype=np.int64))
+    homogeneous = np.concatenate([vertices, np.ones((vertices.shape[0], 1))], axis=1)
+
+    faces = np.asarray(faces, dtype=np.int64).tolist()
+    alive = [True] * len(faces)
+    nalive = len(faces)
+
+    # the faces of each vertex, and a version of each vertex to detect the outdated entries of the heap
+    vertex_faces = [set() for _ in range(vertices.shape[0])]
+    for f, face in enumerate(faces):
+        for v in face:
+            vertex_faces[v].add(f)
+    version = [0] * vertices.shape[0]
+    removed = [False] * vertices.shape[0]
+
+    def error(Q, v):
+        return float(homogeneous[v] @ Q @ homogeneous[v])
+
+    def push(heap, a, b):
+        # the edge is collapsed on the end point with the lowest error
+        Q = quadrics[a] + quadrics[b]
+        cost_a, cost_b = error(Q, a), error(Q, b)
+        source, target, cost = (a, b, cost_b) if cost_b <= cost_a else (b, a, cost_a)
+        heapq.heappush(heap, (cost, source, target, version[source], version[target]))
+
+    def flips(source, target):
+        # whether moving the source vertex on the target turns one of the remaining faces upside down
+        for f in vertex_faces[source]:
+            face = faces[f]
+            if target in face:
+                continue
+            p = vertices[face]
+            before = np.cross(p[1] - p[0], p[2] - p[0])
+            p[face.index(source)] = vertices[target]
+            after = np.cross(p[1] - p[0], p[2] - p[0])
+            if np.dot(before, after) <= 0.0:
+                return True
+        return False
+
+    heap = []
+    edges = {(min(a, b), max(a, b)) for face in faces for a, b in ((face[0], face[1]), (face[1], face[2]), (face[2], face[0]))}
+    for a, b in edges:
+        push(heap, a, b)
+
+    results = []
+    targets = list(targets)
+    while len(targets) > 0:
+        while nalive > targets[0] and len(heap) > 0:
+            cost, source, target, source_version, target_version = heapq.heappop(heap)
+            if removed[source] or removed[target]:
+                continue
+            if version[source] != source_version or version[target] != target_version:
+                continue
+            if flips(source, target):
+                continue
+
+            # move the faces of the source on the target, the faces using both vertices disappear
+            for f in vertex_faces[source]:
+                face = faces[f]
+                if target in face:
+                    alive[f] = False
+                    nalive -= 1
+                    for v in face:
+                        if v != source:
+                            vertex_faces[v].discard(f)
+                else:
+                    face[face.index(source)] = target
+                    vertex_faces[target].add(f)
+            vertex_faces[source] = set()
+            removed[source] = True
+
+            quadrics[target] += quadrics[source]
+            version[target] += 1
+
+            neighbours = {v for f in vertex_faces[target] for v in faces[f]} - {target}
+            for v in neighbours:
+                push(heap, v, target)
+
+        results.append(np.array([face for face, kept in zip(faces, alive) if kept], dtype=np.uint32).reshape(-1, 3))
+        targets.pop(0)
+
+    return results
+
+
+def generate_lods(mesh, ratios=LOD_RATIOS):
+    """
+    Computes the levels of detail of a triangle mesh, stored in mesh.lods as face arrays indexing the vertices of
+    the mesh. The triangles of each level are reordered for the vertex cache.
+    :param mesh: the Mesh object
+    :param ratios: [optional] the fraction of the triangles of the mesh kept at each level
+    :return: None
+    """
+    if mesh.faces is None or mesh.faces.shape[1] != 3 or mesh.faces.shape[0] == 0:
+        return
+
+    ntriangles = mesh.faces.shape[0]
+    targets = [max(1, int(ntriangles * ratio)) for ratio in ratios]
+    lods = simplify(mesh.vertices, mesh.faces, targets)
+
+    mesh.lods = [lod[optimise_triangle_order(lod, mesh.vertices.shape[0])] for lod in lods]
+    print('Levels of detail of mesh {}: {} triangles'.format(
+        mesh.name, ' -> '.join(str(faces.shape[0]) for faces in [mesh.faces] + mesh.lods)))
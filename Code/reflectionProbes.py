@@ -0,0 +1,304 @@
+# Description: This file contains the ReflectionProbes class, a set of environment maps placed in the scene and stored in a cube map array, and the ProbeShader blending them on reflective models.
+
+import time
+
+from bvh import BVH
+from environmentMapping import CUBE_FACES, CUBE_FACE_ROTATIONS
+from framebuffer import Framebuffer
+from refreshScheduler import RefreshScheduler, FACES
+from shaders import *
+from texture import Texture
+
+# the size in texels of the faces of the probes
+PROBE_SIZE = 128
+
+# the distance from a probe within which models reflect it
+PROBE_RADIUS = 20.0
+
+# the near and far planes of the faces of the probes
+PROBE_NEAR = 0.5
+PROBE_FAR = 100.0
+
+# the number of probes blended on each model
+BLENDED_PROBES = 2
+
+
+class ReflectionProbe:
+    """
+    One probe of a ReflectionProbes object. It has a model matrix and local bounds covering the sphere of influence
+    of the probe, so that the probes are found with a bounding volume hierarchy like the models of a scene.
+    """
+    def __init__(self, position, radius, P, scheduler):
+        """
+        Initialises the probe.
+        :param position: the position of the centre of the probe in the scene
+        :param radius: the distance from the probe within which models reflect it
+        :param P: the projection of the faces
+        :param scheduler: the RefreshScheduler choosing the faces of the probe to render
+        """
+        self.radius = radius
+        self.P = P
+        self.scheduler = scheduler
+        self.set_position(position)
+
+    def set_position(self, position):
+        """
+        Moves the probe, and computes the view and frustum of each face.
+        :param position: the position of the centre of the probe in the scene
+        :return: None
+        """
+        self.position = np.array(position, dtype=np.float64)
+        self.M = translationMatrix(self.position)
+
+        T = translationMatrix(-self.position)
+        self.views = [np.matmul(CUBE_FACE_ROTATIONS[face], T) for face in CUBE_FACES]
+        self.planes = [frustumPlanes(np.matmul(self.P, V)) for V in self.views]
+
+    def local_bounds(self):
+        """
+        Returns the bounding volumes of the sphere of influence of the probe, before the model matrix is applied.
+        :return: a tuple (box, sphere), see BaseModel.local_bounds()
+        """
+        r = self.radius
+        return np.array([[-r, -r, -r], [r, r, r]]), np.array([0., 0., 0., r])
+
+
+class ReflectionProbes(Texture):
+    """
+    Several environment maps placed across the scene, so that reflective models show what is around them instead
+    of what is around a single cube map. The probes are the cube maps of a cube map array texture, face f of probe
+    p being layer 6p+f, and are rendered face by face in the same framebuffer. Each probe has its own
+    RefreshScheduler, and the faces of all probes share the budget of the frame.
+    The probes reflected by each model are chosen on the CPU: the probes whose sphere of influence contains the
+    centre of the model are found in a bounding volume hierarchy, and the two nearest are blended in the shader
+    with weights inversely proportional to their distance. This needs OpenGL 4.0 or ARB_texture_cube_map_array.
+    """
+    def __init__(self, positions, radius=PROBE_RADIUS, size=PROBE_SIZE, policy='on_change', budget=None):
+        """
+        Creates the probes. They are black until baked or rendered by update().
+        :param positions: the list of the positions of the centres of the probes
+        :param radius: [optional] the distance from a probe within which models reflect it
+        :param size: [optional] the size in texels of the faces
+        :param policy: [optional] the refresh policy of the probes, see RefreshScheduler
+        :param budget: [optional] the time in milliseconds the faces of all probes can take per frame
+        """
+        self.name = None
+        self.format = GL_RGBA
+        self.type = GL_UNSIGNED_BYTE
+        self.wrap = GL_CLAMP_TO_EDGE
+        self.sample = GL_LINEAR
+        self.target = GL_TEXTURE_CUBE_MAP_ARRAY
+
+        self.width = size
+        self.height = size
+
+        self.P = frustumMatrix(-PROBE_NEAR, +PROBE_NEAR, -PROBE_NEAR, +PROBE_NEAR, PROBE_NEAR, PROBE_FAR)
+        self.probes = [
+            ReflectionProbe(position, radius, self.P, RefreshScheduler(policy=policy, budget=budget))
+            for position in positions
+        ]
+
+        # the spatial index of the spheres of influence of the probes
+        self.index = BVH(self.probes)
+
+        # for each model, the model matrix and the probes blended on it when it was last drawn, see select()
+        self.selections = {}
+
+        # the probe whose faces are rendered first in the next frame, so that all probes get a share of the budget
+        self.next_probe = 0
+
+        # the number of faces rendered during the current frame
+        self.refreshed = 0
+
+        self.textureid = glGenTextures(1)
+        self.bind()
+        glTexImage3D(self.target, 0, self.format, size, size, FACES * len(self.probes), 0, self.format, self.type, None)
+        glTexParameteri(self.target, GL_TEXTURE_WRAP_S, self.wrap)
+        glTexParameteri(self.target, GL_TEXTURE_WRAP_T, self.wrap)
+        glTexParameteri(self.target, GL_TEXTURE_MAG_FILTER, self.sample)
+        glTexParameteri(self.target, GL_TEXTURE_MIN_FILTER, self.sample)
+        self.unbind()
+
+        # the faces are rendered one at a time, so they share one depth buffer
+        self.depth = glGenRenderbuffers(1)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.depth)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, size, size)
+        glBindRenderbuffer(GL_RENDERBUFFER, 0)
+
+        self.fbo = Framebuffer()
+        self.fbo.bind()
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, self.depth)
+        self.fbo.unbind()
+
+    def move(self, probe, position):
+        """
+        Moves a probe. Its faces are refreshed according to the policy of its scheduler.
+        :param probe: the index of the probe
+        :param position: the new position of its centre
+        :return: None
+        """
+        self.probes[probe].set_position(position)
+        self.index.refit([self.probes[probe]])
+        self.selections = {}
+
+    def invalidate(self):
+        """
+        Marks all faces of all probes to be rendered again.
+        :return: None
+        """
+        for probe in self.probes:
+            probe.scheduler.invalidate()
+
+    def select(self, model, M):
+        """
+        Chooses the probes reflected by a model. The result is kept until the model matrix changes.
+        :param model: the model
+        :param M: the model matrix the model is drawn with
+        :return: a tuple (first, second, weight) with the indices of the two nearest probes and the weight of the
+        nearest one
+        """
+        # the model matrix given by the model is a new array at each draw, so the values are compared
+        selection = self.selections.get(id(model))
+        if selection is not None and np.array_equal(selection[0], M):
+            return selection[1]
+
+        bounds = model.local_bounds()
+        centre = np.zeros(3) if bounds is None else bounds[1][:3]
+        centre = np.dot(M, np.append(centre, 1.0))[:3]
+
+        # the probes whose influence covers the model, or the nearest ones if the model is outside all of them
+        candidates = self.index.query_sphere(centre, 0.0)
+        if len(candidates) == 0:
+            candidates = self.probes
+        distances = sorted((np.linalg.norm(probe.position - centre), i) for i, probe in enumerate(self.probes)
+                           if any(probe is candidate for candidate in candidates))[:BLENDED_PROBES]
+
+        if len(distances) == 1 or distances[0][0] == 0.0:
+            result = (distances[0][1], distances[0][1], 1.0)
+        else:
+            (d0, first), (d1, second) = distances
+            result = (first, second, float(d1 / (d0 + d1)))
+
+        self.selections[id(model)] = (np.array(M), result)
+        return result
+
+    def bake(self, scene):
+        """
+        Renders all faces of all probes, regardless of the budget.
+        :param scene: the scene to render
+        :return: None
+        """
+        self.invalidate()
+        work = [(probe, list(range(FACES))) for probe in self.probes]
+        self.render(scene, self.reflected_models(scene), work, budget=False)
+
+    def update(self, scene):
+        """
+        Renders the faces of the probes chosen by their schedulers, within the budget of the frame.
+        :param scene: the scene to render
+        :return: None
+        """
+        order = self.probes[self.next_probe:] + self.probes[:self.next_probe]
+        self.next_probe = (self.next_probe + 1) % len(self.probes)
+
+        models = self.reflected_models(scene)
+        work = [(probe, probe.scheduler.select(probe.position, probe.planes, scene.moved_models, models))
+                for probe in order]
+        self.render(scene, models, work)
+
+    def reflected_models(self, scene):
+        """
+        Returns the models drawn in the probes: the models reflected by the scene, except those reflecting the
+        probes themselves, which cannot sample the texture being rendered.
+        :param scene: the scene
+        :return: the list of models
+        """
+        return [model for model in scene.reflected_models() if not isinstance(model.shader, ProbeShader)]
+
+    def render(self, scene, models, work, budget=True):
+        """
+        Renders faces of the probes.
+        :param scene: the scene to render
+        :param models: the models to draw
+        :param work: the list of (probe, indices of the faces to render) in priority order
+        :param budget: [optional] whether to stop when the budget of the frame is spent
+        :return: None
+        """
+        self.refreshed = 0
+        if all(len(faces) == 0 for probe, faces in work):
+            return
+
+        # save the projection matrix, and set the projection matrix for the probes
+        Pscene = scene.P
+        scene.P = self.P
+
+        glViewport(0, 0, self.width, self.height)
+
+        spent = 0.0
+        for probe, faces in work:
+            layer = FACES * self.probes.index(probe)
+            for face in faces:
+                if budget and not probe.scheduler.fits(spent):
+                    break
+
+                start = time.perf_counter()
+                self.fbo.prepare_layer(self, layer + face)
+                self.fbo.bind()
+                glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+                scene.camera.V = probe.views[face]
+                scene.update_frame_uniforms()
+                scene.draw_models(models)
+
+                self.fbo.unbind()
+                elapsed = 1000 * (time.perf_counter() - start)
+                probe.scheduler.record([face], elapsed)
+                spent += elapsed
+                self.refreshed += 1
+
+        # reset the viewport
+        glViewport(0, 0, scene.window_size[0], scene.window_size[1])
+
+        scene.P = Pscene
+        scene.camera.update()
+        scene.update_frame_uniforms()
+
+
+class ProbeShader(BaseShaderProgram):
+    """
+    This shader reflects the two reflection probes nearest to the model, see ReflectionProbes.
+    """
+    def __init__(self, name='probe', probes=None):
+        """
+        Initialize the shader
+        :param name: name of the shader
+        :param probes: the ReflectionProbes object
+        """
+        BaseShaderProgram.__init__(self, name=name)
+        self.add_uniform('sampler_probes')
+        self.add_uniform('MiT')
+        self.add_uniform('probe_first')
+        self.add_uniform('probe_second')
+        self.add_uniform('probe_weight')
+
+        self.probes = probes
+
+    def bind(self, model, M):
+        """
+        Bind the shader to the model
+        :param model: the model to bind to
+        :param M: the model matrix
+        :return: None
+        """
+        render_state.use_program(self.program)
+
+        first, second, weight = self.probes.select(model, M)
+        render_state.bind_texture(0, self.probes)
+        self.uniforms['sampler_probes'].bind(0)
+        self.uniforms['probe_first'].bind_int(first)
+        self.uniforms['probe_second'].bind_int(second)
+        self.uniforms['probe_weight'].bind_float(weight)
+
+        # set the model matrix uniforms, the view and projection matrices are in the FrameData block
+        self.uniforms['M'].bind(M)
+        self.uniforms['MiT'].bind(np.linalg.inv(M[:3, :3]).transpose())
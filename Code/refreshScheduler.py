@@ -0,0 +1,143 @@
+# Description: This file contains the RefreshScheduler class, which decides which faces of a cube map to render each frame.
+
+import numpy as np
+
+from matutils import *
+
+# the refresh policies:
+# - 'continuous': all faces are refreshed every frame,
+# - 'round_robin': the next faces_per_frame faces are refreshed every frame, in turn,
+# - 'on_change': a face is refreshed when a model visible in it has moved, or the cube map has moved,
+# - 'on_move': all faces are refreshed when the cube map has moved farther than move_threshold.
+POLICIES = ['continuous', 'round_robin', 'on_change', 'on_move']
+
+# the number of faces of a cube map
+FACES = 6
+
+# weight of the last measure in the running estimate of the time taken by a face
+COST_SMOOTHING = 0.2
+
+
+class RefreshScheduler:
+    """
+    Chooses the faces of a cube map rendered at each frame. The faces are marked dirty by the policy, and the dirty
+    faces are rendered in the order they were marked, at most faces_per_frame of them and within a budget of
+    milliseconds per frame. The time taken by a face is estimated from the previous ones, so the budget is the time
+    the CPU spends submitting the faces; at least one dirty face is rendered each frame so that the cube map always
+    converges. The faces are the layers of the cube map, see CUBE_FACES in environmentMapping.py.
+    """
+    def __init__(self, policy='on_change', faces_per_frame=FACES, budget=None, move_threshold=0.5):
+        """
+        Initialises the scheduler, with all faces dirty.
+        :param policy: [optional] the refresh policy, one of POLICIES
+        :param faces_per_frame: [optional] the maximum number of faces rendered per frame
+        :param budget: [optional] the time in milliseconds the faces can take per frame, None for no limit
+        :param move_threshold: [optional] the distance the cube map must move for its faces to be refreshed
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unknown refresh policy {}, expected one of {}'.format(policy, POLICIES))
+
+        self.policy = policy
+        self.faces_per_frame = faces_per_frame
+        self.budget = budget
+        self.move_threshold = move_threshold
+
+        # the dirty faces, in the order they were marked
+        self.dirty = list(range(FACES))
+
+        # the next face refreshed by the round robin policy
+        self.next_face = 0
+
+        # the position of the cube map when its faces were last all marked
+        self.position = None
+
+        # the estimated time in milliseconds taken by one face
+        self.cost = None
+
+        # the number of faces rendered during the current frame
+        self.refreshed = 0
+
+    def invalidate(self, faces=range(FACES)):
+        """
+        Marks faces to be refreshed.
+        :param faces: [optional] the indices of the faces, all faces by default
+        :return: None
+        """
+        for face in faces:
+            if face not in self.dirty:
+                self.dirty.append(face)
+
+    def model_moved(self, planes, model, previous):
+        """
+        Marks the faces in which a moving model was visible before or after its move.
+        :param planes: the list of the frustum planes of each face, see frustumPlanes()
+        :param model: the model
+        :param previous: the previous model matrix of the model
+        :return: None
+        """
+        bounds = model.local_bounds()
+        if bounds is None:
+            self.invalidate()
+            return
+
+        boxes, spheres = transformBounds(
+            np.array([bounds[0], bounds[0]]), np.array([bounds[1], bounds[1]]), np.array([previous, model.M]))
+        self.invalidate([face for face in range(FACES) if inFrustum(planes[face], boxes, spheres).any()])
+
+    def select(self, position, planes, moved, reflected):
+        """
+        Applies the policy for the current frame, and returns the faces to render in priority order.
+        :param position: the position of the centre of the cube map
+        :param planes: the list of the frustum planes of each face, see frustumPlanes()
+        :param moved: the list of (model, previous model matrix) of the models moved since the last frame
+        :param reflected: the models drawn in the cube map
+        :return: the list of the indices of the faces to render, at most faces_per_frame of them
+        """
+        self.refreshed = 0
+
+        position = np.asarray(position, dtype=np.float64)
+        if self.position is None or np.linalg.norm(position - self.position) > self.move_threshold:
+            if self.position is not None and self.policy in ('on_change', 'on_move'):
+                self.invalidate()
+            self.position = position
+
+        if self.policy == 'continuous':
+            self.invalidate()
+
+        elif self.policy == 'round_robin':
+            self.invalidate((self.next_face + i) % FACES for i in range(self.faces_per_frame))
+            self.next_face = (self.next_face + self.faces_per_frame) % FACES
+
+        elif self.policy == 'on_change':
+            reflected = {id(model) for model in reflected}
+            for model, previous in moved:
+                if id(model) in reflected:
+                    self.model_moved(planes, model, previous)
+
+        return self.dirty[:self.faces_per_frame]
+
+    def fits(self, spent, faces=1):
+        """
+        Checks whether more faces can be rendered in the budget of the frame.
+        :param spent: the time in milliseconds already taken by the faces of this frame
+        :param faces: [optional] the number of faces to render next
+        :return: True if the faces are expected to fit in the budget, always True for the first face of the frame
+        """
+        if self.budget is None or self.cost is None:
+            return True
+        if spent == 0.0 and faces == 1:
+            return True
+        return spent + faces * self.cost <= self.budget
+
+    def record(self, faces, elapsed):
+        """
+        Marks faces as refreshed, and updates the estimate of the time taken by a face.
+        :param faces: the indices of the faces rendered
+        :param elapsed: the time in milliseconds taken by these faces
+        :return: None
+        """
+        self.dirty = [face for face in self.dirty if face not in faces]
+        self.refreshed += len(faces)
+
+        cost = elapsed / max(len(faces), 1)
+        self.cost = cost if self.cost is None else (1 - COST_SMOOTHING) * self.cost + COST_SMOOTHING * cost
@@ -3,6 +3,8 @@
 # pygame is used to create a window on which to draw.
 import pygame
 
+import time
+
 # This imports all openGL functions
 from OpenGL.GL import *
 
@@ -12,12 +14,111 @@ from shaders import *
 # import the camera class
 from camera import Camera
 
+# the streamer uploading the large textures in the background
+from texture import texture_streamer
+
 # and we import a bunch of helper functions
 from matutils import *
 
 # imports the lightsource class
 from lightSource import LightSource
 
+# the render passes of the models
+from BaseModel import PASS_OPAQUE, PASS_BLENDED
+
+# the bounding volume hierarchy used for culling and picking
+from bvh import BVH
+
+# the heights in pixels under which the models switch to their next level of detail, see BaseModel.select_lod()
+LOD_THRESHOLDS = [240, 120, 60]
+
+# number of bits of each field of the render queue sort keys
+KEY_BITS = 16
+KEY_MASK = (1 << KEY_BITS) - 1
+
+
+class RenderQueue:
+    """
+    Collects the models to draw from one viewpoint, and draws them sorted by a key packing their render pass,
+    shader program, textures, material and depth. Models sharing the same state are then drawn one after the
+    other, and the bindings that do not change are skipped by render_state. Opaque models are drawn front to back
+    within each state, to benefit from the depth test, while blended models are drawn back to front.
+    """
+    def __init__(self, max_depth=100.0):
+        """
+        Initialises an empty queue.
+        :param max_depth: the depth at which the depth field of the sort keys is clamped (e.g. the far plane)
+        """
+        self.max_depth = max_depth
+
+        # the items of the current pass, as tuples (key, insertion index, model)
+        self.items = []
+
+        # small indices for the texture sets and materials, so that they fit in the key fields
+        self.texture_sets = {}
+        self.materials = {}
+
+        # number of models drawn during the current frame
+        self.draws = 0
+
+    def index(self, table, value):
+        """
+        Returns the index of a value in a table, adding it if needed.
+        :param table: the dictionary of indices
+        :param value: the value
+        :return: the index of the value
+        """
+        if value not in table:
+            table[value] = len(table) & KEY_MASK
+        return table[value]
+
+    def add(self, model, V):
+        """
+        Adds a model to the queue, if it is visible.
+        :param model: the model to draw
+        :param V: the view matrix, used to compute the depth of the model
+        :return: None
+        """
+        if not model.visible:
+            return
+
+        render_pass = model.render_pass
+        if render_pass == PASS_OPAQUE and model.mesh.material.alpha < 1.0:
+            render_pass = PASS_BLENDED
+
+        program = model.shader.program & KEY_MASK
+        textures = self.index(self.texture_sets, tuple(texture.textureid for texture in model.mesh.textures))
+        material = self.index(self.materials, id(model.mesh.material))
+
+        # the depth of the model origin in front of the camera, quantised to the size of the field
+        depth = -np.dot(V[2], model.M[:, 3])
+        depth = int(np.clip(depth / self.max_depth, 0.0, 1.0) * KEY_MASK)
+
+        state = (program << 2 * KEY_BITS) | (textures << KEY_BITS) | material
+        if render_pass == PASS_BLENDED:
+            # back to front first, sorting by state would break the blending order
+            key = (render_pass << 4 * KEY_BITS) | ((KEY_MASK - depth) << 3 * KEY_BITS) | state
+        else:
+            key = (render_pass << 4 * KEY_BITS) | (state << KEY_BITS) | depth
+
+        self.items.append((key, len(self.items), model))
+
+    def submit(self):
+        """
+        Draws the models in the queue in the order of their keys, and empties the queue.
+        :return: None
+        """
+        # the previous pass, or code outside the queue, may have changed the bindings
+        render_state.reset()
+
+        self.items.sort(key=lambda item: item[:2])
+        for key, index, model in self.items:
+            model.draw()
+
+        self.draws += len(self.items)
+        self.items = []
+
+
 class Scene:
     """
     This class represents a scene, which is a collection of models to draw.
@@ -85,6 +186,48 @@ class Scene:
         # an array the class will maintain to hold a list of models to draw in the scene
         self.models = []
 
+        # the queue sorting the models before drawing them
+        self.render_queue = RenderQueue(max_depth=far)
+
+        # number of models outside the view frustum of the camera during the current frame
+        self.culled = 0
+
+        # the hierarchy of the world bounds of the models, see add_model()
+        self.bvh = BVH()
+
+        # the uniform buffer holding the camera and light data read by all shaders
+        self.frame_uniforms = FrameUniformBuffer()
+
+        # the switch heights of the levels of detail, and the level drawn by all models if forced with the L key
+        self.lod_thresholds = list(LOD_THRESHOLDS)
+        self.forced_lod = None
+
+        # number of triangles drawn at each level of detail in the window during the current frame
+        self.lod_triangles = {}
+
+        # whether the models are drawn from the camera into the window, the only pass choosing the levels of detail
+        self.main_pass = False
+
+        # whether the models are drawn in all the faces of a layered cube map at once, see EnvironmentMappingTexture
+        self.layered = False
+
+        # whether the models are drawn in a shadow map, see CascadedShadowMap
+        self.shadow_pass = False
+
+        # the (model, previous model matrix) of the models moved during the current frame, see model_moved()
+        self.moved_models = []
+
+        # the time at which the current frame started, to measure the frame time
+        self.frame_start = time.perf_counter()
+
+        # the time at which the scene started loading, reset by subclasses loading assets before calling this, and
+        # the time taken until the end of the first frame
+        self.start_time = self.frame_start
+        self.first_frame = None
+
+        # rendering statistics of the last frame, updated by end_frame()
+        self.stats = {}
+
     def add_model(self, model):
         """
         This method adds a model to the scene.
@@ -94,6 +237,7 @@ class Scene:
         
         # and add to the list
         self.models.append(model)
+        self.bvh.add(model)
 
     def add_models_list(self, models_list):
         """
@@ -111,6 +255,8 @@ class Scene:
         :return: None
         '''
 
+        self.start_frame()
+
         # first we need to clear the scene, we also clear the depth buffer to handle occlusions
         if not framebuffer:
             glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
@@ -118,15 +264,193 @@ class Scene:
             # ensure that the camera view matrix is up to date
             self.camera.update()
 
-        # then we loop over all models in the list and draw them
-        for model in self.models:
-            model.draw()
+        # send the camera and light data to the shaders
+        self.update_frame_uniforms()
+
+        # then we draw all models in the list
+        self.draw_models(self.models, main_pass=True)
 
         # draw on a different buffer than the one we display,
         # and flip the two buffers once we are done drawing.
         if not framebuffer:
+            self.end_frame()
             pygame.display.flip()
 
+    def draw_models(self, models, main_pass=False):
+        """
+        Draws a list of models from the current viewpoint through the render queue.
+        :param models: the list of models to draw
+        :param main_pass: [optional] whether the models are drawn from the camera into the window, in which case
+        they choose their level of detail, kept by the other passes of the next frame
+        :return: None
+        """
+        self.main_pass = main_pass
+        for model in self.cull(models):
+            self.render_queue.add(model, self.camera.V)
+        self.render_queue.submit()
+        self.main_pass = False
+
+    def cull(self, models):
+        """
+        Removes the models outside the view frustum of the current projection and view matrices, testing the
+        bounding volumes of all models at once. The culled models are only counted in the main pass. Background and overlay models are not in world coordinates,
+        so they are kept, as well as the models without bounds.
+        Models added to the bounding volume hierarchy are found with a query of the hierarchy.
+        :param models: the list of models
+        :return: the list of visible models which are at least partly inside the view frustum
+        """
+        models = [model for model in models if model.visible]
+        planes = frustumPlanes(np.matmul(self.P, self.camera.V))
+
+        # the models in the hierarchy, and those inside the frustum
+        in_view = set()
+        if len(self.bvh) > 0:
+            in_view = {id(model) for model in self.bvh.query_frustum(planes)}
+
+        tested = []
+        bounds = []
+        culled = 0
+        keep = np.ones(len(models), dtype=bool)
+        for i, model in enumerate(models):
+            if model.render_pass not in (PASS_OPAQUE, PASS_BLENDED):
+                continue
+
+            if id(model) in self.bvh.index:
+                keep[i] = id(model) in in_view
+                culled += int(not keep[i])
+            else:
+                model_bounds = model.local_bounds()
+                if model_bounds is not None:
+                    tested.append(i)
+                    bounds.append(model_bounds)
+
+        # the other models are tested all at once
+        if len(tested) > 0:
+            boxes, spheres = transformBounds(
+                np.array([box for box, sphere in bounds]),
+                np.array([sphere for box, sphere in bounds]),
+                np.array([models[i].M for i in tested])
+            )
+            inside = inFrustum(planes, boxes, spheres)
+            keep[tested] = inside
+            culled += len(tested) - int(np.count_nonzero(inside))
+
+        if self.main_pass:
+            self.culled += culled
+
+        return [model for model, kept in zip(models, keep) if kept]
+
+    def reflected_models(self):
+        """
+        Returns the models drawn in the environment maps of the scene, see EnvironmentMappingTexture.
+        :return: the list of models
+        """
+        return self.models
+
+    def shadow_casters(self):
+        """
+        Returns the models drawn in the shadow maps of the scene, see CascadedShadowMap.
+        :return: the list of models
+        """
+        return self.models
+
+    def model_moved(self, model, previous):
+        """
+        Called when the model matrix of a model changes, so that the environment maps can refresh the faces in which
+        it is visible, see RefreshScheduler.
+        :param model: the model
+        :param previous: the previous model matrix of the model
+        :return: None
+        """
+        self.moved_models.append((model, previous))
+
+    def pick(self, position):
+        """
+        Finds the model under a point of the window, among the models in the bounding volume hierarchy.
+        The models are tested with their bounding boxes, so the result is approximate for sparse shapes.
+        :param position: the (x, y) coordinates of the point in the window, in pixels
+        :return: the nearest visible model whose bounding box is under the point, or None
+        """
+        x = 2.0 * position[0] / self.window_size[0] - 1.0
+        y = 1.0 - 2.0 * position[1] / self.window_size[1]
+
+        # the ray goes from the point on the near plane to the point on the far plane
+        PVi = np.linalg.inv(np.matmul(self.P, self.camera.V))
+        near = unhomog(np.dot(PVi, [x, y, -1.0, 1.0]))
+        far = unhomog(np.dot(PVi, [x, y, 1.0, 1.0]))
+
+        for distance, model in self.bvh.query_ray(near, far - near, max_distance=1.0):
+            if model.visible:
+                return model
+        return None
+
+    def update_frame_uniforms(self):
+        """
+        Writes the current projection and view matrices and the light source in the uniform buffer read by all
+        shaders. This must be called before drawing the models, and again each time P or camera.V change.
+        :return: None
+        """
+        self.frame_uniforms.update(self.P, self.camera.V, self.light)
+
+    def count_triangles(self, lod, triangles):
+        """
+        Adds the triangles of a draw call to the statistics of the frame. Only the triangles drawn in the window are
+        counted, not those of the shadow maps and environment maps.
+        :param lod: the level of detail drawn
+        :param triangles: the number of triangles drawn
+        :return: None
+        """
+        if not self.main_pass:
+            return
+
+        self.lod_triangles[lod] = self.lod_triangles.get(lod, 0) + triangles
+
+    def start_frame(self):
+        """
+        Called at the start of each frame to reset the statistics counted in the main pass of the frame.
+        :return: None
+        """
+        self.culled = 0
+        self.lod_triangles = {}
+
+    def end_frame(self):
+        """
+        Called at the end of each frame to collect the rendering statistics of the frame in self.stats.
+        :return: None
+        """
+        now = time.perf_counter()
+        self.stats['frame time (ms)'] = round(1000 * (now - self.frame_start), 2)
+        self.frame_start = now
+
+        if self.first_frame is None:
+            self.first_frame = round(now - self.start_time, 3)
+            print('Time to first frame: {} s'.format(self.first_frame))
+        self.stats['time to first frame (s)'] = self.first_frame
+
+        uniforms = uniform_cache.end_frame()
+        self.stats['uniform uploads'] = uniforms['uploads']
+        self.stats['uniform uploads avoided'] = uniforms['skipped']
+        self.stats['frame uniform buffer writes'] = self.frame_uniforms.writes
+        self.frame_uniforms.writes = 0
+
+        state = render_state.end_frame()
+        self.stats['draws'] = self.render_queue.draws
+        self.stats['state changes'] = state['changes']
+        self.stats['state changes avoided'] = state['skipped']
+        self.render_queue.draws = 0
+
+        self.stats['texture bytes streamed'] = texture_streamer.end_frame()
+        self.stats['textures streaming'] = len(texture_streamer)
+
+        self.stats['culled'] = self.culled
+
+        self.moved_models = []
+
+        self.stats['forced lod'] = self.forced_lod
+        # all levels are reported, so that the levels no longer drawn show 0 rather than the count of an old frame
+        for lod in range(len(self.lod_thresholds) + 1):
+            self.stats['triangles lod {}'.format(lod)] = self.lod_triangles.get(lod, 0)
+
     def keyboard(self, event):
         """
         Method to process keyboard events. Check Pygame documentation for a list of key events
@@ -136,6 +460,20 @@ class Scene:
         if event.key == pygame.K_q:
             self.running = False
 
+        # print the rendering statistics of the last frame
+        elif event.key == pygame.K_i:
+            print('--> last frame: ' + ', '.join('{}={}'.format(name, value) for name, value in self.stats.items()))
+
+        # cycle through the levels of detail drawn by all models, to compare their frame times
+        elif event.key == pygame.K_l:
+            if self.forced_lod is None:
+                self.forced_lod = 0
+            elif self.forced_lod < len(self.lod_thresholds):
+                self.forced_lod += 1
+            else:
+                self.forced_lod = None
+            print('--> level of detail: {}'.format('automatic' if self.forced_lod is None else self.forced_lod))
+
         # flag to switch wireframe rendering
         elif event.key == pygame.K_0:
             if self.wireframe:
@@ -164,7 +502,11 @@ class Scene:
             # mouse events
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 mods = pygame.key.get_mods()
-                if event.button == 4:
+                if event.button == 2:
+                    model = self.pick(event.pos)
+                    print('--> picked {}'.format(model.name if model is not None else 'nothing'))
+
+                elif event.button == 4:
                     #pass
                     if mods & pygame.KMOD_CTRL:
                         self.light.position *= 1.1
@@ -3,10 +3,17 @@
 # imports all openGL functions
 from OpenGL.GL import *
 from OpenGL.GL import shaders
+from OpenGL.error import GLError
 from matutils import *
 # we will use numpy to store data in arrays
 import numpy as np
 
+import copy
+import ctypes
+import hashlib
+import os
+import re
+
 
 class Uniform:
     """
@@ -20,18 +27,30 @@ class Uniform:
         self.name = name
         self.value = value
         self.location = -1
+        self.program = None
 
-    def link(self, program):
+    def link(self, program, locations=None):
         """
         This function needs to be called after compiling the GLSL program to fetch the location of the uniform
         in the program from its name
         :param program: the GLSL program where the uniform is used
+        :param locations: [optional] a dictionary of the uniform locations already fetched for this program,
+        completed with this uniform if it is not there yet.
         :return: None
         """
+        self.program = program
+
+        if locations is not None and self.name in locations:
+            self.location = locations[self.name]
+            return
+
         self.location = glGetUniformLocation(program=program, name=self.name)
         if self.location == -1:
             print('(E) Warning, no uniform {}'.format(self.name))
 
+        if locations is not None:
+            locations[self.name] = self.location
+
     def bind_matrix(self, M=None, number=1, transpose=True):
         """
         Call this before rendering to bind the Python matrix to the GLSL uniform mat4.
@@ -41,6 +60,8 @@ class Uniform:
         """
         if M is not None:
             self.value = M
+        if not uniform_cache.changed(self.program, self.location, self.value):
+            return
         if self.value.shape[0] == 4 and self.value.shape[1] == 4:
             glUniformMatrix4fv(self.location, number, transpose, self.value)
         elif self.value.shape[0] == 3 and self.value.shape[1] == 3:
@@ -67,24 +88,28 @@ class Uniform:
     def bind_int(self, value=None):
         if value is not None:
             self.value = value
-        glUniform1i(self.location, self.value)
+        if uniform_cache.changed(self.program, self.location, self.value):
+            glUniform1i(self.location, self.value)
 
     def bind_float(self, value=None):
         if value is not None:
             self.value = value
-        glUniform1f(self.location, self.value)
+        if uniform_cache.changed(self.program, self.location, self.value):
+            glUniform1f(self.location, self.value)
 
     def bind_vector(self, value=None):
         if value is not None:
             self.value = value
-        if value.shape[0] == 2:
-            glUniform2fv(self.location, 1, value)
-        elif value.shape[0] == 3:
-            glUniform3fv(self.location, 1, value)
-        elif value.shape[0] == 4:
-            glUniform4fv(self.location, 1, value)
+        if not uniform_cache.changed(self.program, self.location, self.value):
+            return
+        if self.value.shape[0] == 2:
+            glUniform2fv(self.location, 1, self.value)
+        elif self.value.shape[0] == 3:
+            glUniform3fv(self.location, 1, self.value)
+        elif self.value.shape[0] == 4:
+            glUniform4fv(self.location, 1, self.value)
         else:
-            print('(E) Error in Uniform.bind_vector(): Vector should be of dimension 2,3 or 4, found {}'.format(value.shape[0]))
+            print('(E) Error in Uniform.bind_vector(): Vector should be of dimension 2,3 or 4, found {}'.format(self.value.shape[0]))
 
     def set(self, value):
         '''
@@ -93,6 +118,525 @@ class Uniform:
         self.value = value
 
 
+class UniformCache:
+    """
+    Remembers the last value uploaded to each uniform location of each GLSL program, so that binding a uniform
+    to the value it already has does not call OpenGL again. Uniform values belong to the program, not to the
+    shader object, so the cache is shared by all shader objects using the same program.
+    """
+    def __init__(self):
+        """
+        Initialises an empty cache.
+        """
+        # for each (program, location), the bytes of the last value uploaded
+        self.values = {}
+
+        # for each (program, name), the version of the object whose uniforms were last uploaded, see is_current()
+        self.versions = {}
+
+        # statistics for the current frame, and for the last completed frame (see end_frame())
+        self.uploads = 0
+        self.skipped = 0
+        self.last_frame = {'uploads': 0, 'skipped': 0}
+
+    def changed(self, program, location, value):
+        """
+        Checks whether a value needs to be uploaded, and records it as the current value of the uniform if so.
+        :param program: the GLSL program
+        :param location: the location of the uniform in the program
+        :param value: the value to upload
+        :return: True if the value differs from the last one uploaded to this uniform
+        """
+        key = (program, location)
+        data = np.asarray(value).tobytes()
+        if self.values.get(key) == data:
+            self.skipped += 1
+            return False
+
+        self.values[key] = data
+        self.uploads += 1
+        return True
+
+    def is_current(self, program, name, version, count=1):
+        """
+        Checks whether the uniforms of an object (e.g. a material) were last uploaded to the program from the
+        same version of the object, in which case the caller can skip them without building their values.
+        Otherwise the version is recorded and the caller is expected to upload the uniforms.
+        :param program: the GLSL program
+        :param name: the name of the group of uniforms, e.g. 'material'
+        :param version: the version of the object, which changes whenever the object is modified
+        :param count: the number of uniforms in the group, for the statistics
+        :return: True if the uniforms are already up to date
+        """
+        key = (program, name)
+        if self.versions.get(key) == version:
+            self.skipped += count
+            return True
+
+        self.versions[key] = version
+        return False
+
+    def forget(self, program):
+        """
+        Removes all the values stored for a program, e.g. when it is deleted.
+        :param program: the GLSL program
+        :return: None
+        """
+        self.values = {key: value for key, value in self.values.items() if key[0] != program}
+        self.versions = {key: value for key, value in self.versions.items() if key[0] != program}
+
+    def end_frame(self):
+        """
+        Called once per frame to store the statistics of the frame and reset the counters.
+        :return: a dictionary with the number of uniform uploads done and skipped during the frame
+        """
+        self.last_frame = {'uploads': self.uploads, 'skipped': self.skipped}
+        self.uploads = 0
+        self.skipped = 0
+        return self.last_frame
+
+
+# the uniform values shared by all shader objects
+uniform_cache = UniformCache()
+
+
+class RenderState:
+    """
+    Keeps track of the OpenGL objects currently bound (program, vertex array and textures), so that binding
+    an object which is already bound does not call OpenGL again. Code binding these objects without going
+    through this class must call reset() before the tracked state is used again; the render queue of the
+    scene does it at the start of each pass.
+    """
+    def __init__(self):
+        """
+        Initialises the tracker, with an unknown state.
+        """
+        self.reset()
+
+        # statistics for the current frame, and for the last completed frame (see end_frame())
+        self.changes = 0
+        self.skipped = 0
+        self.last_frame = {'changes': 0, 'skipped': 0}
+
+    def reset(self):
+        """
+        Forgets the bound objects, so that the next bindings are all done.
+        :return: None
+        """
+        self.program = None
+        self.vertex_array = None
+        self.active_unit = None
+
+        # for each (texture unit, target), the bound texture
+        self.textures = {}
+
+    def use_program(self, program):
+        """
+        Makes a GLSL program current.
+        :param program: the GLSL program
+        :return: None
+        """
+        if program == self.program:
+            self.skipped += 1
+            return
+
+        glUseProgram(program)
+        self.program = program
+        self.changes += 1
+
+    def bind_vertex_array(self, vao):
+        """
+        Binds a vertex array object.
+        :param vao: the vertex array object, or 0 to unbind it
+        :return: None
+        """
+        if vao == self.vertex_array:
+            self.skipped += 1
+            return
+
+        glBindVertexArray(vao)
+        self.vertex_array = vao
+        self.changes += 1
+
+    def bind_texture(self, unit, texture):
+        """
+        Binds a texture to a texture unit.
+        :param unit: the index of the texture unit
+        :param texture: the Texture object
+        :return: None
+        """
+        key = (unit, texture.target)
+        if self.textures.get(key) == texture.textureid:
+            self.skipped += 1
+            return
+
+        if unit != self.active_unit:
+            glActiveTexture(GL_TEXTURE0 + unit)
+            self.active_unit = unit
+
+        texture.bind()
+        self.textures[key] = texture.textureid
+        self.changes += 1
+
+    def end_frame(self):
+        """
+        Called once per frame to store the statistics of the frame and reset the counters.
+        :return: a dictionary with the number of state changes done and skipped during the frame
+        """
+        self.last_frame = {'changes': self.changes, 'skipped': self.skipped}
+        self.changes = 0
+        self.skipped = 0
+        return self.last_frame
+
+
+# the bindings shared by all shader objects and models
+render_state = RenderState()
+
+
+class ProgramBinaryCache:
+    """
+    Stores linked GLSL programs on disk with glGetProgramBinary, so that later runs can load them with
+    glProgramBinary instead of compiling the shaders. Binaries are only valid for the driver that created them,
+    so the key of each file includes the vendor, renderer and version strings of the driver.
+    """
+    def __init__(self, folder='cache/programs'):
+        """
+        Initialises the cache.
+        :param folder: the folder where the program binaries are stored
+        """
+        self.folder = folder
+
+        # the driver must support at least one binary format
+        self.supported = glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS) > 0
+        if not self.supported:
+            print('(W) The OpenGL driver does not support program binaries, the program binary cache is disabled')
+
+        # the binary formats the driver accepts, stored binaries in another format are compiled again
+        self.formats = set()
+        if self.supported:
+            self.formats = set(int(f) for f in np.atleast_1d(glGetIntegerv(GL_PROGRAM_BINARY_FORMATS)))
+
+        self.driver = '{}|{}|{}'.format(
+            glGetString(GL_VENDOR).decode(), glGetString(GL_RENDERER).decode(), glGetString(GL_VERSION).decode())
+
+        # statistics on the cache use
+        self.loaded = 0
+        self.rejected = 0
+
+    def file_name(self, key):
+        """
+        Returns the file storing the program binary for a program key.
+        :param key: the program key from ProgramRegistry.key()
+        :return: the name of the file
+        """
+        digest = hashlib.sha1(repr((key, self.driver)).encode()).hexdigest()
+        return os.path.join(self.folder, '{}-{}.bin'.format(key[0], digest[:16]))
+
+    def load(self, key):
+        """
+        Creates a program from its stored binary.
+        :param key: the program key from ProgramRegistry.key()
+        :return: the program, or None if there is no binary or the driver rejected it
+        """
+        file_name = self.file_name(key)
+        if not self.supported or not os.path.isfile(file_name):
+            return None
+
+        with open(file_name, 'rb') as file:
+            data = file.read()
+
+        # the file starts with the binary format, and is left truncated if a run stopped while writing it
+        if len(data) <= 4:
+            print('(W) Program binary {} is truncated, compiling the shaders'.format(file_name))
+            self.rejected += 1
+            return None
+
+        binary_format = int(np.frombuffer(data[:4], dtype=np.uint32)[0])
+        if binary_format not in self.formats:
+            print('(W) Program binary {} has a format the driver no longer supports, compiling the shaders'.format(file_name))
+            self.rejected += 1
+            return None
+
+        program = glCreateProgram()
+        try:
+            glProgramBinary(program, binary_format, data[4:], len(data) - 4)
+            linked = glGetProgramiv(program, GL_LINK_STATUS) == GL_TRUE
+        except GLError as error:
+            print('(W) Program binary {} could not be loaded: {}'.format(file_name, error))
+            linked = False
+
+        if not linked:
+            print('(W) Program binary {} rejected by the driver, compiling the shaders'.format(file_name))
+            glDeleteProgram(program)
+            uniform_cache.forget(program)
+            self.rejected += 1
+            return None
+
+        print('Loaded GLSL program binary [{}]'.format(key[0]))
+        self.loaded += 1
+        return program
+
+    def save(self, key, program):
+        """
+        Stores the binary of a linked program. The program must have been linked with the
+        GL_PROGRAM_BINARY_RETRIEVABLE_HINT parameter set.
+        :param key: the program key from ProgramRegistry.key()
+        :param program: the linked program
+        :return: None
+        """
+        if not self.supported:
+            return
+
+        length = glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH)
+        if length == 0:
+            return
+
+        data = np.zeros(length, dtype=np.uint8)
+        size = GLsizei()
+        binary_format = GLenum()
+        glGetProgramBinary(program, length, ctypes.byref(size), ctypes.byref(binary_format), data.ctypes.data_as(ctypes.c_void_p))
+
+        # the binary is written next to its entry and then renamed, so that an entry is never partly written
+        file_name = self.file_name(key)
+        temporary = '{}.{}.tmp'.format(file_name, os.getpid())
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(temporary, 'wb') as file:
+                file.write(np.uint32(binary_format.value).tobytes())
+                file.write(data[:size.value].tobytes())
+            os.replace(temporary, file_name)
+        except OSError as error:
+            print('(W) Could not write program binary for {}: {}'.format(key[0], error))
+
+
+class ProgramRegistry:
+    """
+    Keeps the GLSL programs already compiled and linked, so that shader objects with identical sources and
+    attribute bindings share the same program instead of compiling their own copy. The uniform locations are
+    shared with the program, and the last uploaded uniform values are tracked per program in uniform_cache.
+    """
+    def __init__(self):
+        """
+        Initialises an empty registry.
+        """
+        # for each key, a tuple (program, dictionary of uniform locations)
+        self.programs = {}
+
+        # the on-disk cache of program binaries, if enabled with enable_binary_cache()
+        self.binaries = None
+
+        # statistics on the registry use
+        self.compiled = 0
+        self.reused = 0
+
+    def enable_binary_cache(self, folder='cache/programs'):
+        """
+        Enables the on-disk cache of program binaries, so that programs compiled in a previous run are loaded
+        without compiling their shaders. Needs a current OpenGL context.
+        :param folder: [optional] the folder where the program binaries are stored
+        :return: None
+        """
+        self.binaries = ProgramBinaryCache(folder)
+
+    def key(self, shader, attributes):
+        """
+        Returns the key identifying a program.
+        :param shader: the shader object, providing the name and the GLSL sources
+        :param attributes: the dictionary of attribute locations used when linking
+        :return: a tuple (name, hash of the sources, attribute bindings)
+        """
+        sources = hashlib.sha1()
+        sources.update(shader.vertex_shader_source.encode())
+        sources.update(b'\0')
+        sources.update(shader.fragment_shader_source.encode())
+        if shader.geometry_shader_source is not None:
+            sources.update(b'\0')
+            sources.update(shader.geometry_shader_source.encode())
+        return shader.name, sources.hexdigest(), tuple(sorted(attributes.items()))
+
+    def get(self, shader, attributes):
+        """
+        Returns the program for a shader object, compiling and linking it only if it is not in the registry yet.
+        :param shader: the shader object
+        :param attributes: the dictionary of attribute locations to bind before linking
+        :return: a tuple (program, dictionary of uniform locations)
+        """
+        key = self.key(shader, attributes)
+
+        if key in self.programs:
+            self.reused += 1
+            print('Reusing GLSL program [{}]'.format(shader.name))
+            return self.programs[key]
+
+        program = None
+        if self.binaries is not None:
+            program = self.binaries.load(key)
+
+        # no binary, or the driver rejected it: compile the shaders and (re)write the binary
+        if program is None:
+            self.compiled += 1
+            program = shader.link_program(attributes, retrievable=self.binaries is not None)
+            if self.binaries is not None:
+                self.binaries.save(key, program)
+
+        # programs reading the per-frame data get it from the same binding point
+        block = glGetUniformBlockIndex(program, FRAME_DATA_BLOCK)
+        if block != GL_INVALID_INDEX:
+            glUniformBlockBinding(program, block, FRAME_DATA_BINDING)
+
+        # and the layered programs get the matrices of the cube faces from theirs
+        block = glGetUniformBlockIndex(program, CUBE_FACES_BLOCK)
+        if block != GL_INVALID_INDEX:
+            glUniformBlockBinding(program, block, CUBE_FACES_BINDING)
+
+        self.programs[key] = (program, {})
+
+        return self.programs[key]
+
+
+# the registry shared by all shader objects
+programs = ProgramRegistry()
+
+
+# the name of the uniform block holding the per-frame data in the GLSL code, and the binding point it is read from
+FRAME_DATA_BLOCK = 'FrameData'
+FRAME_DATA_BINDING = 0
+
+# the same for the block holding the matrices of the faces of a cube map rendered in a single pass
+CUBE_FACES_BLOCK = 'CubeFaces'
+CUBE_FACES_BINDING = 1
+
+# the first lines of the sources of the layered shaders, the geometry shader and gl_Layer need GLSL 1.50
+LAYERED_HEADER = '#version 150 compatibility\n#define LAYERED'
+
+# the geometry shader of the layered programs, completed with the outputs of the vertex shader
+LAYERED_GEOMETRY_SHADER = '''#version 150 compatibility
+
+//=== each triangle is drawn in the faces of the cube map selected by face_mask, gl_Layer being the face index
+layout(triangles) in;
+layout(triangle_strip, max_vertices = 18) out;
+
+//=== the projection matrix times the rotation of each face, written once per cube map update
+layout(std140) uniform CubeFaces {
+    mat4 face_PV[6];
+};
+
+//=== per-object uniforms
+uniform int face_mask;  // bit i is set if the bounding volume of the model is inside the frustum of face i
+
+//=== the outputs of the vertex shader, renamed, and passed on to the fragment shader
+{declarations}
+
+// whether the three corners of a triangle are outside the same clipping plane
+bool outside(vec4 a, vec4 b, vec4 c, int axis, float side) {
+    return side * a[axis] > a.w && side * b[axis] > b.w && side * c[axis] > c.w;
+}
+
+void main() {
+    for (int face = 0; face < 6; face++) {
+        if ((face_mask & (1 << face)) == 0) continue;
+
+        // the vertex shader gives the positions in the frame of the cube map, projected here in the face
+        vec4 corners[3];
+        for (int i = 0; i < 3; i++) corners[i] = face_PV[face] * gl_in[i].gl_Position;
+
+        bool culled = false;
+        for (int axis = 0; axis < 3; axis++) {
+            culled = culled || outside(corners[0], corners[1], corners[2], axis, 1.0)
+                            || outside(corners[0], corners[1], corners[2], axis, -1.0);
+        }
+        if (culled) continue;
+
+        for (int i = 0; i < 3; i++) {
+            gl_Layer = face;
+            gl_Position = corners[i];
+{copies}
+            EmitVertex();
+        }
+        EndPrimitive();
+    }
+}
+'''
+
+
+def layered_shader_sources(vertex_shader, fragment_shader):
+    """
+    Creates the sources of the variant of a program drawing each triangle in the six faces of a cube map at once.
+    The vertex shader is run with the identity projection matrix and the view matrix of the centre of the cube map,
+    so that its outputs are the same for all faces, and a geometry shader projects the positions in each face. The
+    outputs of the vertex shader are renamed with a vs_ prefix, and copied by the geometry shader to the inputs of
+    the fragment shader. LAYERED is defined in the vertex and fragment shaders, for the code working after the
+    projection (e.g. the depth of the skybox).
+    :param vertex_shader: the GLSL code of the vertex shader
+    :param fragment_shader: the GLSL code of the fragment shader
+    :return: a tuple with the GLSL codes of the vertex, geometry and fragment shaders
+    """
+    outputs = re.findall(r'^\s*out\s+(\w+)\s+(\w+)\s*;', vertex_shader, flags=re.MULTILINE)
+
+    vertex_shader = re.sub(r'^\s*#\s*version.*$', LAYERED_HEADER, vertex_shader, count=1, flags=re.MULTILINE)
+    for _, name in outputs:
+        vertex_shader = re.sub(r'\b{}\b'.format(name), 'vs_' + name, vertex_shader)
+    fragment_shader = re.sub(r'^\s*#\s*version.*$', LAYERED_HEADER, fragment_shader, count=1, flags=re.MULTILINE)
+
+    declarations = '\n'.join('in {0} vs_{1}[];\nout {0} {1};'.format(type, name) for type, name in outputs)
+    copies = '\n'.join('            {0} = vs_{0}[i];'.format(name) for _, name in outputs)
+    geometry_shader = LAYERED_GEOMETRY_SHADER.replace('{declarations}', declarations).replace('{copies}', copies)
+
+    return vertex_shader, geometry_shader, fragment_shader
+
+
+class FrameUniformBuffer:
+    """
+    A uniform buffer object holding the data shared by all the models drawn from the same viewpoint: the projection
+    and view matrices, and the light source in view coordinates. It is written once per view (the main view,
+    the shadow map and each face of the environment map), instead of sending the same uniforms to each program
+    for each model. The layout matches the std140 FrameData block declared in the GLSL shaders.
+    """
+    def __init__(self):
+        """
+        Creates the buffer and binds it to the FRAME_DATA_BINDING binding point. Needs a current OpenGL context.
+        """
+        # std140 layout: P and V take 16 floats each, and each vec3 is padded to 4 floats
+        self.data = np.zeros(48, dtype=np.float32)
+
+        self.buffer = glGenBuffers(1)
+        glBindBuffer(GL_UNIFORM_BUFFER, self.buffer)
+        glBufferData(GL_UNIFORM_BUFFER, self.data.nbytes, None, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+        glBindBufferBase(GL_UNIFORM_BUFFER, FRAME_DATA_BINDING, self.buffer)
+
+        # number of times the buffer was written, reset every frame by the scene
+        self.writes = 0
+
+    def update(self, P, V, light):
+        """
+        Writes the data for a new view in the buffer.
+        :param P: the projection matrix
+        :param V: the view matrix
+        :param light: the light source of the scene
+        :return: None
+        """
+        # GLSL matrices are stored by columns
+        self.data[0:16] = np.transpose(P).flatten()
+        self.data[16:32] = np.transpose(V).flatten()
+        self.data[32:35] = unhomog(np.dot(V, homog(light.position)))
+        self.data[36:39] = light.Ia
+        self.data[40:43] = light.Id
+        self.data[44:47] = light.Is
+
+        glBindBuffer(GL_UNIFORM_BUFFER, self.buffer)
+        glBufferSubData(GL_UNIFORM_BUFFER, 0, self.data.nbytes, self.data)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+        self.writes += 1
+
+    def delete(self):
+        """
+        Releases the buffer.
+        :return: None
+        """
+        glDeleteBuffers(1, [self.buffer])
+
+
 class BaseShaderProgram:
     """
     This is the base class for loading and compiling the GLSL shaders.
@@ -108,21 +652,33 @@ class BaseShaderProgram:
         self.name = name
         print('Creating shader program: {}'.format(name) )
 
+        # by default, the shader files are found in the folder of the same name
         if name is not None:
-            vertex_shader = 'shaders/{}/vertex_shader.glsl'.format(name)
-            fragment_shader = 'shaders/{}/fragment_shader.glsl'.format(name)
+            if vertex_shader is None:
+                vertex_shader = 'shaders/{}/vertex_shader.glsl'.format(name)
+            if fragment_shader is None:
+                fragment_shader = 'shaders/{}/fragment_shader.glsl'.format(name)
 
         # load the vertex shader GLSL code
         if vertex_shader is None:
             self.vertex_shader_source = '''
                 #version 130
+                #extension GL_ARB_uniform_buffer_object : require
 
                 in vec3 position;   // vertex position
-                uniform mat4 PVM; // the Perspective-View-Model matrix is received as a Uniform
+                layout(std140) uniform FrameData {
+                    mat4 P;         // the projection matrix
+                    mat4 V;         // the view matrix
+                    vec3 light;     // light position in view space
+                    vec3 Ia;        // ambient light properties
+                    vec3 Id;        // diffuse properties of the light source
+                    vec3 Is;        // specular properties of the light source
+                };
+                uniform mat4 M;     // the model matrix is received as a Uniform
 
                 // main function of the shader
                 void main() {
-                    gl_Position = PVM * vec4(position, 1.0f);  // first we transform the position using PVM matrix
+                    gl_Position = P * V * M * vec4(position, 1.0f);  // first we transform the position using the model, view and projection matrices
                 }
             '''
         else:
@@ -144,9 +700,16 @@ class BaseShaderProgram:
                 self.fragment_shader_source = file.read()
             # print(self.fragment_shader_source)
 
+        # only the layered variants have a geometry shader, see layered_variant()
+        self.geometry_shader_source = None
+        self.layered = None
+
+        # the attribute locations the program was linked with, given to compile()
+        self.attributes = None
+
         # in order to simplify extension of the class in the future, we start storing uniforms in a dictionary.
         self.uniforms = {
-            'PVM': Uniform('PVM'),  # project view model matrix
+            'M': Uniform('M'),  # model matrix, the view and projection matrices are in the FrameData block
         }
 
 
@@ -155,34 +718,74 @@ class BaseShaderProgram:
 
     def compile(self, attributes):
         '''
-        Call this function to compile the GLSL codes for both shaders.
+        Call this function to get the compiled GLSL program for both shaders. The program is only compiled the first
+        time, shader objects with the same sources and attributes then reuse it from the registry.
         :return:
         '''
+        self.attributes = attributes
+        self.program, locations = programs.get(self, attributes)
+
+        # tell OpenGL to use this shader program for rendering
+        render_state.use_program(self.program)
+
+        # link all uniforms
+        for uniform in self.uniforms:
+            self.uniforms[uniform].link(self.program, locations)
+
+    def link_program(self, attributes, retrievable=False):
+        '''
+        Compiles the GLSL codes for both shaders and links them in a new program.
+        :param attributes: the dictionary of attribute locations to bind before linking
+        :param retrievable: [optional] whether the program binary will be retrieved with glGetProgramBinary
+        :return: the program
+        '''
         print('Compiling GLSL shaders [{}]...'.format(self.name))
         try:
-            self.program = glCreateProgram()
-            glAttachShader(self.program, shaders.compileShader(self.vertex_shader_source, shaders.GL_VERTEX_SHADER))
-            glAttachShader(self.program, shaders.compileShader(self.fragment_shader_source, shaders.GL_FRAGMENT_SHADER))
+            program = glCreateProgram()
+            glAttachShader(program, shaders.compileShader(self.vertex_shader_source, shaders.GL_VERTEX_SHADER))
+            glAttachShader(program, shaders.compileShader(self.fragment_shader_source, shaders.GL_FRAGMENT_SHADER))
+            if self.geometry_shader_source is not None:
+                glAttachShader(program, shaders.compileShader(self.geometry_shader_source, GL_GEOMETRY_SHADER))
 
         except RuntimeError as error:
             print('(E) An error occured while compiling {} shader:\n {}\n... forwarding exception...'.format(self.name, error)),
             raise error
 
-        self.bindAttributes(attributes)
+        self.bindAttributes(attributes, program)
 
-        glLinkProgram(self.program)
+        if retrievable:
+            glProgramParameteri(program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
 
-        # tell OpenGL to use this shader program for rendering
-        glUseProgram(self.program)
+        glLinkProgram(program)
 
-        # link all uniforms
-        for uniform in self.uniforms:
-            self.uniforms[uniform].link(self.program)
+        return program
 
-    def bindAttributes(self, attributes):
+    def layered_variant(self):
+        '''
+        Returns the variant of this shader drawing in all the faces of a cube map at once (see
+        layered_shader_sources()), created and compiled at the first call. The variant is a copy of this object, so
+        its bind() method is the same, with its own program and uniforms.
+        :return: the shader object of the variant
+        '''
+        if self.layered is None:
+            variant = copy.copy(self)
+            variant.name = '{}_layered'.format(self.name)
+            variant.vertex_shader_source, variant.geometry_shader_source, variant.fragment_shader_source = \
+                layered_shader_sources(self.vertex_shader_source, self.fragment_shader_source)
+            variant.uniforms = {name: Uniform(name, uniform.value) for name, uniform in self.uniforms.items()}
+            variant.add_uniform('face_mask')
+            variant.layered = variant
+            variant.compile(self.attributes)
+            self.layered = variant
+
+        return self.layered
+
+    def bindAttributes(self, attributes, program=None):
         # bind all shader attributes to the correct locations in the VAO
+        if program is None:
+            program = self.program
         for name, location in attributes.items():
-            glBindAttribLocation(self.program, location, name)
+            glBindAttribLocation(program, location, name)
             print('Binding attribute {} to location {}'.format(name, location))
 
     def bind(self, model, M):
@@ -191,33 +794,29 @@ class BaseShaderProgram:
         '''
 
         # tell OpenGL to use this shader program for rendering
-        glUseProgram(self.program)
+        render_state.use_program(self.program)
 
-        P = model.scene.P
-        V = model.scene.camera.V
-
-        # set the PVM matrix uniform
-        self.uniforms['PVM'].bind(np.matmul(P, np.matmul(V, M)))
+        # set the model matrix uniform
+        self.uniforms['M'].bind(M)
 
 
 class PhongShader(BaseShaderProgram):
     '''
     This is the base class for loading and compiling the GLSL shaders.
     '''
-    def __init__(self, name='phong'):
+    def __init__(self, name='phong', vertex_shader=None, fragment_shader=None):
         '''
         Initialises the shaders
         :param vertex_shader: the name of the file containing the vertex shader GLSL code
         :param fragment_shader: the name of the file containing the fragment shader GLSL code
         '''
 
-        BaseShaderProgram.__init__(self, name=name)
+        BaseShaderProgram.__init__(self, name=name, vertex_shader=vertex_shader, fragment_shader=fragment_shader)
 
         # in order to simplify extension of the class in the future, we start storing uniforms in a dictionary.
         self.uniforms = {
-            'PVM': Uniform('PVM'),   # project view model matrix
-            'VM': Uniform('VM'),     # view model matrix (necessary for light computations)
-            'VMiT': Uniform('VMiT'),  # inverse-transpose of the view model matrix (for normal transformation)
+            'M': Uniform('M'),       # model matrix, the view and projection matrices are in the FrameData block
+            'MiT': Uniform('MiT'),   # inverse-transpose of the model matrix (for normal transformation)
             'mode': Uniform('mode',0),  # rendering mode (only for illustration, in general you will want one shader program per mode)
             'alpha': Uniform('alpha', 1.0),
             # rendering mode (only for illustration, in general you will want one shader program per mode)
@@ -225,10 +824,6 @@ class PhongShader(BaseShaderProgram):
             'Kd': Uniform('Kd'),
             'Ks': Uniform('Ks'),
             'Ns': Uniform('Ns'),
-            'light': Uniform('light', np.array([0., 0., 0.], 'f')),
-            'Ia': Uniform('Ia'),
-            'Id': Uniform('Id'),
-            'Is': Uniform('Is'),
             'has_texture': Uniform('has_texture'),
             'textureObject': Uniform('textureObject')
 
@@ -239,20 +834,12 @@ class PhongShader(BaseShaderProgram):
         Call this function to enable this GLSL Program (you can have multiple GLSL programs used during rendering!)
         '''
 
-        P = model.scene.P
-        V = model.scene.camera.V
-
         # tell OpenGL to use this shader program for rendering
-        glUseProgram(self.program)
-
-        # set the PVM matrix uniform
-        self.uniforms['PVM'].bind(np.matmul(P, np.matmul(V, M)))
+        render_state.use_program(self.program)
 
-        # set the PVM matrix uniform
-        self.uniforms['VM'].bind(np.matmul(V, M))
-
-        # set the PVM matrix uniform
-        self.uniforms['VMiT'].bind(np.linalg.inv(np.matmul(V, M))[:3, :3].transpose())
+        # set the model matrix uniforms, the camera and light are in the FrameData block
+        self.uniforms['M'].bind(M)
+        self.uniforms['MiT'].bind(np.linalg.inv(M[:3, :3]).transpose())
 
         # bind the mode to the program
         self.uniforms['mode'].bind(model.scene.mode)
@@ -269,16 +856,10 @@ class PhongShader(BaseShaderProgram):
         # bind material properties
         self.bind_material_uniforms(model.mesh.material)
 
-        # bind the light properties
-        self.bind_light_uniforms(model.scene.light, V)
-
-    def bind_light_uniforms(self, light, V):
-        self.uniforms['light'].bind_vector(unhomog(np.dot(V, homog(light.position))))
-        self.uniforms['Ia'].bind_vector(np.array(light.Ia, 'f'))
-        self.uniforms['Id'].bind_vector(np.array(light.Id, 'f'))
-        self.uniforms['Is'].bind_vector(np.array(light.Is, 'f'))
-
     def bind_material_uniforms(self, material):
+        # skip the material if this program already has its current values
+        if uniform_cache.is_current(self.program, 'material', material.version, count=4):
+            return
         self.uniforms['Ka'].bind_vector(np.array(material.Ka, 'f'))
         self.uniforms['Kd'].bind_vector(np.array(material.Kd, 'f'))
         self.uniforms['Ks'].bind_vector(np.array(material.Ks, 'f'))
@@ -290,10 +871,19 @@ class PhongShader(BaseShaderProgram):
         self.uniforms[name] = Uniform(name)
 
     def unbind(self):
-        glUseProgram(0)
+        render_state.use_program(0)
 
 
 class FlatShader(PhongShader):
     def __init__(self):
         PhongShader.__init__(self, name='flat')
 
+
+class InstancedPhongShader(PhongShader):
+    '''
+    Phong shader for models drawn several times in one call (see InstancedModel). The model matrix of each
+    instance is read from the instance_M attribute, the matrix uniforms are shared by all instances.
+    '''
+    def __init__(self):
+        PhongShader.__init__(self, name='phong_instanced', fragment_shader='shaders/phong/fragment_shader.glsl')
+
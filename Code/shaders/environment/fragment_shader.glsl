@@ -1,4 +1,5 @@
 #version 130
+#extension GL_ARB_uniform_buffer_object : require
 
 in vec3 normal_view_space;
 in vec3 position_view_space;
@@ -6,17 +7,22 @@ in vec3 fragment_texCoord;
 out vec4 final_color;
 
 uniform samplerCube sampler_cube;
-uniform mat4 PVM; 	// the Perspective-View-Model matrix is received as a Uniform
-uniform mat4 VM; 	// the View-Model matrix is received as a Uniform
-uniform mat3 VMiT;  // The inverse-transpose of the view model matrix, used for normals
-uniform mat3 VT;
+//=== per-frame data, shared by all programs and written once per view (see FrameUniformBuffer in shaders.py)
+layout(std140) uniform FrameData {
+    mat4 P;         // the projection matrix
+    mat4 V;         // the view matrix
+    vec3 light;     // light position in view space
+    vec3 Ia;        // ambient light properties
+    vec3 Id;        // diffuse properties of the light source
+    vec3 Is;        // specular properties of the light source
+};
 
 void main(void)
 {
 	vec3 normal_view_space_normalized = normalize(normal_view_space);
 	vec3 reflected = reflect(normalize(-position_view_space), normal_view_space_normalized);
 
-	final_color = texture(sampler_cube, normalize(VT*reflected));
+	final_color = texture(sampler_cube, normalize(transpose(mat3(V))*reflected));
 	//final_color = texture(sampler_cube, normalize(reflected));
 
 
@@ -1,4 +1,5 @@
 # version 130 // required to use OpenGL core standard
+#extension GL_ARB_uniform_buffer_object : require
 
 //=== 'in' attributes are passed on from the vertex shader's 'out' attributes, and interpolated for each fragment
 in vec3 fragment_color;        // the fragment colour
@@ -22,11 +23,15 @@ uniform vec3 Kd;
 uniform vec3 Ks;
 uniform float Ns;
 
-// light source
-uniform vec3 light;
-uniform vec3 Ia;
-uniform vec3 Id;
-uniform vec3 Is;
+//=== per-frame data, shared by all programs and written once per view (see FrameUniformBuffer in shaders.py)
+layout(std140) uniform FrameData {
+    mat4 P;         // the projection matrix
+    mat4 V;         // the view matrix
+    vec3 light;     // light position in view space
+    vec3 Ia;        // ambient light properties
+    vec3 Id;        // diffuse properties of the light source
+    vec3 Is;        // specular properties of the light source
+};
 
 ///=== main shader code
 void main() {
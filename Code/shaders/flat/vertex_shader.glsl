@@ -1,4 +1,5 @@
 #version 130		// required to use OpenGL core standard
+#extension GL_ARB_uniform_buffer_object : require
 
 //=== in attributes are read from the vertex array, one row per instance of the shader
 in vec3 position;	// the position attribute contains the vertex position
@@ -11,23 +12,32 @@ out vec3 fragment_color;        // the output of the shader will be the colour o
 out vec3 position_view_space;   // the position of the vertex in view coordinates
 out vec2 fragment_texCoord;
 
-//=== uniforms
-uniform mat4 PVM; 	// the Perspective-View-Model matrix is received as a Uniform
-uniform mat4 VM; 	// the View-Model matrix is received as a Uniform
-uniform mat3 VMiT;  // The inverse-transpose of the view model matrix, used for normals
+//=== per-frame data, shared by all programs and written once per view (see FrameUniformBuffer in shaders.py)
+layout(std140) uniform FrameData {
+    mat4 P;         // the projection matrix
+    mat4 V;         // the view matrix
+    vec3 light;     // light position in view space
+    vec3 Ia;        // ambient light properties
+    vec3 Id;        // diffuse properties of the light source
+    vec3 Is;        // specular properties of the light source
+};
+
+//=== per-object uniforms
+uniform mat4 M; 	// the model matrix
+uniform mat3 MiT;   // the inverse-transpose of the model matrix, used for normals
 uniform int mode;	// the rendering mode (better to code different shaders!)
 
 void main(){
-    // 1. first, we transform the position using PVM matrix.
+    // 1. first, we transform the position using the model, view and projection matrices.
     // note that gl_Position is a standard output of the
     // vertex shader.
-    gl_Position = PVM * vec4(position, 1.0f);
+    gl_Position = P * V * M * vec4(position, 1.0f);
 
     // 2. calculate vectors used for shading calculations
     // those will be interpolate before being sent to the
     // fragment shader.
-    position_view_space = vec3(VM*vec4(position, 1.0f));
-    //normal_view_space = normalize(VMiT*normal);
+    position_view_space = vec3(V*M*vec4(position, 1.0f));
+    //normal_view_space = normalize(mat3(V)*MiT*normal);
 
     // 3. forward the texture coordinates.
     fragment_texCoord = texCoord;
@@ -0,0 +1,53 @@
+#version 130		// required to use OpenGL core standard
+#extension GL_ARB_uniform_buffer_object : require
+
+//=== in attributes are read from the vertex array, one row per instance of the shader
+in vec3 position;	// the position attribute contains the vertex position
+in vec3 normal;		// store the vertex normal
+in vec3 color; 		// store the vertex colour
+in vec2 texCoord;
+
+//=== per-instance attributes, one row per instance of the model (see glVertexAttribDivisor)
+in mat4 instance_M;     // the model matrix of this instance
+in mat3 instance_MiT;   // the inverse-transpose of the model matrix of this instance (for normal transformation)
+
+//=== out attributes are interpolated on the face, and passed on to the fragment shader
+out vec3 fragment_color;        // the output of the shader will be the colour of the vertex
+out vec3 position_view_space;   // the position of the vertex in view coordinates
+out vec3 normal_view_space;     // the normal of the vertex in view coordinates
+out vec2 fragment_texCoord;
+
+//=== per-frame data, shared by all programs and written once per view (see FrameUniformBuffer in shaders.py)
+layout(std140) uniform FrameData {
+    mat4 P;         // the projection matrix
+    mat4 V;         // the view matrix
+    vec3 light;     // light position in view space
+    vec3 Ia;        // ambient light properties
+    vec3 Id;        // diffuse properties of the light source
+    vec3 Is;        // specular properties of the light source
+};
+
+//=== per-object uniforms, the model matrix is the one shared by all instances
+uniform mat4 M; 	// the model matrix
+uniform mat3 MiT;   // the inverse-transpose of the model matrix, used for normals
+uniform int mode;	// the rendering mode (better to code different shaders!)
+
+
+void main() {
+    // 1. first, we transform the position using the instance matrix then the model, view and projection matrices.
+    // note that gl_Position is a standard output of the
+    // vertex shader.
+    gl_Position = P * V * M * instance_M * vec4(position, 1.0f);
+
+    // 2. calculate vectors used for shading calculations
+    // those will be interpolate before being sent to the
+    // fragment shader.
+    position_view_space = vec3(V * M * instance_M * vec4(position,1.0f));
+    normal_view_space = normalize(mat3(V) * MiT * instance_MiT * normal);   // V is a rigid transform
+
+    // 3. forward the texture coordinates.
+    fragment_texCoord = texCoord;
+
+    // 4. for now, we just pass on the color from the data array
+    fragment_color = color;
+}
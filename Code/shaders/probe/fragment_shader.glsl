@@ -0,0 +1,36 @@
+#version 130
+#extension GL_ARB_uniform_buffer_object : require
+#extension GL_ARB_texture_cube_map_array : require
+
+in vec3 normal_view_space;
+in vec3 position_view_space;
+out vec4 final_color;
+
+//=== the cube maps of all reflection probes, and the two probes blended on this model (see ReflectionProbes)
+uniform samplerCubeArray sampler_probes;
+uniform int probe_first;    // the index of the nearest probe
+uniform int probe_second;   // the index of the second nearest probe
+uniform float probe_weight; // the weight of the nearest probe
+
+//=== per-frame data, shared by all programs and written once per view (see FrameUniformBuffer in shaders.py)
+layout(std140) uniform FrameData {
+    mat4 P;         // the projection matrix
+    mat4 V;         // the view matrix
+    vec3 light;     // light position in view space
+    vec3 Ia;        // ambient light properties
+    vec3 Id;        // diffuse properties of the light source
+    vec3 Is;        // specular properties of the light source
+};
+
+void main(void)
+{
+	vec3 normal_view_space_normalized = normalize(normal_view_space);
+	vec3 reflected = reflect(normalize(-position_view_space), normal_view_space_normalized);
+
+	// the cube maps are aligned with the axes of the scene
+	vec3 direction = normalize(transpose(mat3(V))*reflected);
+
+	vec4 first = texture(sampler_probes, vec4(direction, probe_first));
+	vec4 second = texture(sampler_probes, vec4(direction, probe_second));
+	final_color = mix(second, first, probe_weight);
+}
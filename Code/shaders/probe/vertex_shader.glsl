@@ -0,0 +1,32 @@
+#version 130
+#extension GL_ARB_uniform_buffer_object : require
+
+//=== in attributes are read from the vertex array, one row per instance of the shader
+in vec3 position;	// the position attribute contains the vertex position
+in vec3 normal;		// store the vertex normal
+
+//=== out attributes are interpolated on the face, and passed on to the fragment shader
+out vec3 position_view_space;   // the position of the vertex in view coordinates
+out vec3 normal_view_space;     // the normal of the vertex in view coordinates
+
+//=== per-frame data, shared by all programs and written once per view (see FrameUniformBuffer in shaders.py)
+layout(std140) uniform FrameData {
+    mat4 P;         // the projection matrix
+    mat4 V;         // the view matrix
+    vec3 light;     // light position in view space
+    vec3 Ia;        // ambient light properties
+    vec3 Id;        // diffuse properties of the light source
+    vec3 Is;        // specular properties of the light source
+};
+
+//=== per-object uniforms
+uniform mat4 M; 	// the model matrix
+uniform mat3 MiT;   // the inverse-transpose of the model matrix, used for normals
+
+void main(void)
+{
+    gl_Position = P * V * M * vec4(position, 1.0f);
+
+    position_view_space = vec3( V * M * vec4(position, 1.0f) );
+    normal_view_space = normalize(mat3(V)*MiT*normal);   // V is a rigid transform
+}
@@ -1,4 +1,5 @@
 # version 130 // required to use OpenGL core standard
+#extension GL_ARB_uniform_buffer_object : require
 
 //=== 'in' attributes are passed on from the vertex shader's 'out' attributes, and interpolated for each fragment
 in vec3 fragment_color;        // the fragment colour
@@ -13,12 +14,14 @@ out vec4 final_color;
 uniform int mode;	// the rendering mode (better to code different shaders!)
 uniform int has_texture;
 uniform sampler2D textureObject; // texture object
-uniform sampler2DShadow shadow_map;
+uniform sampler2DArrayShadow shadow_map;   // the cascades of the shadow map, one per layer
 //uniform sampler2D old_map;
 
-// shadow map matrix
-// this shadow map matrix times the fragment shader position allows looking up the depth in the shadow map texture
-uniform mat4 shadow_map_matrix;
+// shadow map matrices
+// the shadow map matrix of a cascade times the fragment shader position allows looking up the depth in its layer
+uniform mat4 shadow_map_matrices[4];
+uniform int cascades;           // the number of cascades
+uniform vec4 cascade_splits;    // the distance from the camera where each cascade ends
 
 // material uniforms
 uniform vec3 Ka;    // ambient reflection properties of the material
@@ -26,11 +29,15 @@ uniform vec3 Kd;    // diffuse reflection propoerties of the material
 uniform vec3 Ks;    // specular properties of the material
 uniform float Ns;   // specular exponent
 
-// light source
-uniform vec3 light; // light position in view space
-uniform vec3 Ia;    // ambient light properties
-uniform vec3 Id;    // diffuse properties of the light source
-uniform vec3 Is;    // specular properties of the light source
+//=== per-frame data, shared by all programs and written once per view (see FrameUniformBuffer in shaders.py)
+layout(std140) uniform FrameData {
+    mat4 P;         // the projection matrix
+    mat4 V;         // the view matrix
+    vec3 light;     // light position in view space
+    vec3 Ia;        // ambient light properties
+    vec3 Id;        // diffuse properties of the light source
+    vec3 Is;        // specular properties of the light source
+};
 
 uniform float alpha = 1.0f;
 
@@ -74,7 +81,15 @@ void main() {
 
     final_color = phong(texval);
 
-    vec4 p = shadow_map_matrix*vec4(position_view_space, 1);
+    // the first cascade reaching past the fragment, the fragments beyond the last one are not shadowed
+    float depth = -position_view_space.z;
+    int cascade = 0;
+    while (cascade < cascades && depth > cascade_splits[cascade])
+        cascade++;
+
+    vec4 p = shadow_map_matrices[clamp(cascade, 0, max(cascades - 1, 0))]*vec4(position_view_space, 1);
+    if (cascade == cascades)
+        p.w = 0;
 
     //float zlight = texture(old_map, p.xy/p.w).r;
 
@@ -107,7 +122,7 @@ void main() {
 		// this is another alternative that also works:
 		//p.z -= 0.01;
 
-		float val = texture(shadow_map, p.xyz);
+		float val = texture(shadow_map, vec4(p.xy, cascade, p.z));
         //if (val < 0.5f)
 		//	final_color.xyz = Ka*Ia*texval.xyz; //
         final_color.xyz = (1.0-val)*Ka*Ia*texval.xyz + val*final_color.xyz;
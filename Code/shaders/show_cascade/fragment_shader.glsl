@@ -0,0 +1,14 @@
+#version 130
+
+in vec2 fragment_texCoord;	// the fragment texture coordinates
+
+out vec4 final_color; 		// the only output is the fragment colour
+
+uniform sampler2DArray sampler;	// the cascades of the shadow map
+uniform int layer;				// the cascade to show
+
+void main(void)
+{
+	// sample from the layer of the cascade
+	final_color = texture(sampler, vec3(fragment_texCoord, layer));
+}
@@ -90,3 +90,6 @@ class ShowTexture(DrawModelFromMesh):
 
         # Finishes initialising the mesh
         DrawModelFromMesh.__init__(self, scene=scene, M=poseMatrix(position=[0, 0, 1]), mesh=mesh, shader=ShowTextureShader(), visible=False)
+
+        # drawn on top of the scene
+        self.render_pass = PASS_OVERLAY
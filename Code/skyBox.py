@@ -1,6 +1,6 @@
 # Description: Skybox class
 
-from BaseModel import BaseModel,DrawModelFromMesh
+from BaseModel import BaseModel,DrawModelFromMesh,PASS_BACKGROUND
 from mesh import *
 from matutils import *
 from texture import *
@@ -20,21 +20,6 @@ class SkyBoxShader(BaseShaderProgram):
         BaseShaderProgram.__init__(self, name=name)
         self.add_uniform('sampler_cube')
 
-    def bind(self, model, M):
-        """
-        Binds the shader.
-        :param model: The model to bind.
-        :param M: The model matrix.
-        :return: None
-        """
-        BaseShaderProgram.bind(self, model, M)
-        P = model.scene.P  # get projection matrix from the scene
-        V = model.scene.camera.V  # get view matrix from the camera
-        Vr = np.identity(4)
-        Vr[:3, :3] = V[:3, :3]
-
-        self.uniforms['PVM'].bind(np.matmul(P, np.matmul(V, M)))
-
 
 
 class SkyBox(DrawModelFromMesh):
@@ -51,6 +36,9 @@ class SkyBox(DrawModelFromMesh):
                                    mesh=CubeMesh(texture=CubeMap(name='skybox/london'), inside=True),
                                    shader=SkyBoxShader(), name='skybox')
 
+        # the skybox does not write the depth buffer, so it is drawn before the other models
+        self.render_pass = PASS_BACKGROUND
+
     def draw(self):
         glDepthMask(GL_FALSE)
         DrawModelFromMesh.draw(self)
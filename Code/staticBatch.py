@@ -0,0 +1,177 @@
+# Description: This file contains the StaticBatch class, which merges static models into a few large meshes.
+
+import numpy as np
+
+from OpenGL.GL import *
+
+from matutils import *
+
+from mesh import Mesh, normalize_rows
+
+from BaseModel import DrawModelFromMesh
+
+# default size of the cells of the grid splitting the batch into chunks, in world units
+CHUNK_SIZE = 16.0
+
+
+class StaticBatch:
+    """
+    Merges models that never move into a few large meshes, so that they are drawn with one call per chunk instead
+    of one call per model. The vertices of each model are transformed to world coordinates once, and models
+    sharing the same shader, material and textures are concatenated in a single vertex and index buffer pair.
+    Each group is split along a grid of the xz plane, so that the chunks are still culled separately.
+    The batched models must be created with DrawModelFromMesh(static=True): they are not uploaded to the GPU,
+    and setting the model matrix M of one of them rebuilds the batch before the next frame (see update()).
+    """
+    def __init__(self, scene, models, chunk_size=CHUNK_SIZE):
+        """
+        Builds the batch.
+        :param scene: the scene object
+        :param models: the list of static models to merge
+        :param chunk_size: [optional] the size of the grid cells splitting the batch, None for a single chunk per group
+        """
+        self.scene = scene
+        self.chunk_size = chunk_size
+
+        self.models = list(models)
+        for model in self.models:
+            model.batch = self
+
+        # the models drawing the merged meshes, one per chunk
+        self.chunks = []
+
+        # the batch is rebuilt by update() when a model has moved
+        self.dirty = False
+
+        self.build()
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def invalidate(self):
+        """
+        Marks the batch for rebuilding, called when the model matrix of a batched model is changed.
+        :return: None
+        """
+        self.dirty = True
+
+    def update(self):
+        """
+        Rebuilds the batch if a model has moved since it was built. Call this once per frame before drawing.
+        :return: True if the batch was rebuilt
+        """
+        if not self.dirty:
+            return False
+
+        print('(W) Warning: rebuilding static batch, a static model has moved')
+        self.build()
+        return True
+
+    def group_key(self, model):
+        """
+        Returns the key of the state of a model: only models with the same key are merged together.
+        :param model: the model
+        :return: a hashable key
+        """
+        mesh = model.mesh
+        return (
+            type(model.shader), model.shader.name, model.primitive, id(mesh.material),
+            tuple(id(texture) for texture in mesh.textures),
+            tuple(getattr(mesh, name) is None for name in ('colors', 'textureCoords', 'tangents', 'binormals'))
+        )
+
+    def cell(self, model):
+        """
+        Returns the grid cell containing the centre of the world bounding box of a model.
+        :param model: the model
+        :return: the (x, z) indices of the cell
+        """
+        bounds = model.world_bounds()
+        if self.chunk_size is None or bounds is None:
+            return (0, 0)
+        center = bounds[0].mean(axis=0)
+        return tuple(np.floor(center[[0, 2]] / self.chunk_size).astype(int))
+
+    def build(self):
+        """
+        Groups the models by state and grid cell, and creates one model drawing the merged mesh of each group.
+        The previous chunks are released, and replaced in the bounding volume hierarchy of the scene.
+        :return: None
+        """
+        groups = {}
+        for model in self.models:
+            groups.setdefault((self.group_key(model), self.cell(model)), []).append(model)
+
+        old = self.chunks
+        self.chunks = []
+        for (key, cell), models in groups.items():
+            mesh = merge_meshes(models)
+            mesh.name = 'static batch {} {}'.format(models[0].name, cell)
+            self.chunks.append(DrawModelFromMesh(scene=self.scene, M=poseMatrix(), mesh=mesh, shader=models[0].shader,
+                                                 vertex_format=models[0].vertex_format))
+
+        bvh = self.scene.bvh
+        in_bvh = [chunk for chunk in old if chunk in bvh.models]
+        for chunk in in_bvh:
+            bvh.remove(chunk)
+        if len(old) > 0 and len(in_bvh) == len(old):
+            bvh.add_models(self.chunks)
+
+        for chunk in old:
+            release(chunk)
+
+        self.dirty = False
+        print('Static batch: {} models merged in {} chunks'.format(len(self.models), len(self.chunks)))
+
+
+def merge_meshes(models):
+    """
+    Transforms the meshes of a list of models to world coordinates and concatenates them. The models must share
+    the same material and textures, and have the same attribute arrays.
+    :param models: the list of models
+    :return: the merged Mesh, to be drawn with the identity model matrix
+    """
+    first = models[0].mesh
+    Ms = [np.asarray(model.M, dtype=np.float64) for model in models]
+
+    # the vertices are transformed by M, the normals by its inverse-transpose and the tangents by its linear part
+    vertices = np.concatenate([
+        np.matmul(model.mesh.vertices, M[:3, :3].T) + M[:3, 3] for model, M in zip(models, Ms)]).astype('f')
+    normals = np.concatenate([
+        normalize_rows(np.matmul(model.mesh.normals, np.linalg.inv(M[:3, :3]))) for model, M in zip(models, Ms)])
+
+    # the indices of each mesh are shifted by the number of vertices before it
+    offsets = np.cumsum([0] + [model.mesh.vertices.shape[0] for model in models[:-1]])
+    faces = np.concatenate([
+        model.mesh.faces.astype(np.uint32) + np.uint32(offset) for model, offset in zip(models, offsets)])
+
+    def concatenate(name, transform=None):
+        if getattr(first, name) is None:
+            return None
+        if transform is None:
+            return np.concatenate([getattr(model.mesh, name) for model in models]).astype('f')
+        return np.concatenate([
+            normalize_rows(np.matmul(getattr(model.mesh, name), M[:3, :3].T)) for model, M in zip(models, Ms)])
+
+    # the material and textures are shared with the models rather than loaded again
+    mesh = Mesh(vertices=vertices, faces=faces, normals=normals, textureCoords=concatenate('textureCoords'))
+    mesh.material = first.material
+    mesh.textures = list(first.textures)
+    mesh.colors = concatenate('colors')
+    mesh.tangents = concatenate('tangents', transform=True)
+    mesh.binormals = concatenate('binormals', transform=True)
+    return mesh
+
+
+def release(model):
+    """
+    Deletes the buffers and vertex array of a model that is no longer used.
+    :param model: the model
+    :return: None
+    """
+    buffers = list(model.vbos.values())
+    if model.index_buffer is not None:
+        buffers.append(model.index_buffer)
+    if len(buffers) > 0:
+        glDeleteBuffers(len(buffers), buffers)
+    glDeleteVertexArrays(1, [model.vao])
@@ -0,0 +1,102 @@
+# Description: This file contains the tests of the normals, tangents and binormals computed by the Mesh class.
+# Run from the Code folder with: python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mesh import Mesh
+
+
+def reference_normals(vertices, faces, textureCoords):
+    """
+    The loop over the faces which Mesh.calculate_normals() replaced, with the second texture edge taken from the
+    first corner like the position edges. Vertices whose vectors sum to zero are left to NaN.
+    :param vertices: the array of the vertex positions
+    :param faces: the int array of the vertex indices of the faces
+    :param textureCoords: the array of the texture coordinates of the vertices
+    :return: a tuple (normals, tangents, binormals)
+    """
+    normals = np.zeros((vertices.shape[0], 3), dtype='f')
+    tangents = np.zeros((vertices.shape[0], 3), dtype='f')
+    binormals = np.zeros((vertices.shape[0], 3), dtype='f')
+
+    for f in range(faces.shape[0]):
+        a = vertices[faces[f, 1]] - vertices[faces[f, 0]]
+        b = vertices[faces[f, 2]] - vertices[faces[f, 0]]
+        face_normal = np.cross(a, b)
+
+        txa = textureCoords[faces[f, 1], :] - textureCoords[faces[f, 0], :]
+        txb = textureCoords[faces[f, 2], :] - textureCoords[faces[f, 0], :]
+        face_tangent = txb[0]*a - txa[0]*b
+        face_binormal = -txb[1]*a + txa[1]*b
+
+        for j in range(3):
+            normals[faces[f, j], :] += face_normal
+            tangents[faces[f, j], :] += face_tangent
+            binormals[faces[f, j], :] += face_binormal
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+        tangents /= np.linalg.norm(tangents, axis=1, keepdims=True)
+        binormals /= np.linalg.norm(binormals, axis=1, keepdims=True)
+    return normals, tangents, binormals
+
+
+class TestMeshNormals(unittest.TestCase):
+    """
+    Compares Mesh.calculate_normals() with the loop it replaced on a small textured pyramid.
+    """
+    def setUp(self):
+        # a square pyramid, with an unused vertex (5) and a vertex only used by a degenerate face (6)
+        self.vertices = np.array([
+            [-1., 0., -1.], [1., 0., -1.], [1., 0., 1.], [-1., 0., 1.], [0., 1.5, 0.],
+            [3., 3., 3.], [0., -2., 0.],
+        ], dtype='f')
+        self.faces = np.array([
+            [0, 4, 1], [1, 4, 2], [2, 4, 3], [3, 4, 0], [0, 1, 2], [0, 2, 3], [6, 6, 6],
+        ], dtype=np.uint32)
+        self.textureCoords = np.array([
+            [0., 0.], [1., 0.], [1., 1.], [0., 1.], [0.5, 0.5], [0., 0.], [0.5, 0.],
+        ], dtype='f')
+        self.mesh = Mesh(vertices=self.vertices, faces=self.faces, textureCoords=self.textureCoords, load_textures=False)
+        self.reference = reference_normals(self.vertices, self.faces, self.textureCoords)
+
+    def test_matches_reference(self):
+        used = np.arange(5)
+        for name, vectors, expected in zip(['normals', 'tangents', 'binormals'],
+                                           [self.mesh.normals, self.mesh.tangents, self.mesh.binormals],
+                                           self.reference):
+            with self.subTest(name):
+                self.assertEqual(vectors.shape, (self.vertices.shape[0], 3))
+                np.testing.assert_allclose(vectors[used], expected[used], atol=1e-6)
+
+    def test_unit_length(self):
+        for vectors in [self.mesh.normals, self.mesh.tangents, self.mesh.binormals]:
+            np.testing.assert_allclose(np.linalg.norm(vectors[:5], axis=1), 1.0, atol=1e-6)
+
+    def test_apex_normal_points_up(self):
+        np.testing.assert_allclose(self.mesh.normals[4], [0., 1., 0.], atol=1e-6)
+
+    def test_zero_length_left_to_zero(self):
+        # the loop divided by zero on the unused and degenerate vertices
+        for expected in self.reference:
+            self.assertTrue(np.all(np.isnan(expected[5:])))
+
+        for vectors in [self.mesh.normals, self.mesh.tangents, self.mesh.binormals]:
+            self.assertTrue(np.all(np.isfinite(vectors)))
+            np.testing.assert_array_equal(vectors[5:], 0.0)
+
+    def test_untextured_mesh(self):
+        mesh = Mesh(vertices=self.vertices, faces=self.faces, load_textures=False)
+        np.testing.assert_allclose(mesh.normals[:5], self.reference[0][:5], atol=1e-6)
+        self.assertIsNone(mesh.tangents)
+        self.assertIsNone(mesh.binormals)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,73 @@
 # Description: This file contains the Texture class which is used to load textures from files and store them in OpenGL.
 
+import ctypes
+from concurrent.futures import ThreadPoolExecutor
+
 import pygame
 from OpenGL.GL import *
+from OpenGL.GL.EXT.texture_filter_anisotropic import *
 import numpy as np
 
+from textureCache import TextureCache
+
+# number and size of the pixel buffer objects the streamed textures are uploaded through
+PBO_COUNT = 3
+PBO_SIZE = 4 << 20
+
+# the colour of the 1x1 texture shown in place of the streamed textures until their image is uploaded
+PLACEHOLDER_COLOR = [128, 128, 128, 255]
+
+# the minification filters sampling the mipmaps, for each magnification filter: trilinear filtering for GL_LINEAR
+MIPMAP_FILTERS = {
+    GL_NEAREST: GL_NEAREST_MIPMAP_NEAREST,
+    GL_LINEAR: GL_LINEAR_MIPMAP_LINEAR,
+}
+
+# the sampling presets selectable per texture with set_sampling_parameter(), see jurassic.py for their benchmark
+SAMPLING_PRESETS = {
+    'nearest': {'sample': GL_NEAREST, 'use_mipmaps': False, 'anisotropy': None},
+    'bilinear': {'sample': GL_LINEAR, 'use_mipmaps': False, 'anisotropy': None},
+    'trilinear': {'sample': GL_LINEAR, 'use_mipmaps': True, 'anisotropy': None},
+    'anisotropic': {'sample': GL_LINEAR, 'use_mipmaps': True, 'anisotropy': 16.0},
+}
+
+# the options of the textures loaded for the materials of the meshes (see Mesh), changed by the scenes
+material_sampling = {}
+
+# the largest anisotropy supported by the driver, queried at the first use (0 without anisotropic filtering)
+max_anisotropy = None
+
+
+def anisotropy_limit():
+    """
+    Returns the largest anisotropy supported by the driver.
+    :return: the maximum value of GL_TEXTURE_MAX_ANISOTROPY, or 0 if anisotropic filtering is not supported
+    """
+    global max_anisotropy
+    if max_anisotropy is None:
+        if glInitTextureFilterAnisotropicEXT():
+            max_anisotropy = float(np.ravel(glGetFloatv(GL_MAX_TEXTURE_MAX_ANISOTROPY_EXT))[0])
+        else:
+            print('(W) Warning: anisotropic filtering is not supported')
+            max_anisotropy = 0.0
+    return max_anisotropy
+
+
+# the images being decoded in advance by the asset loader (see assetLoader.py), as futures indexed by file name
+pending_images = {}
+
+
+def load_image(name):
+    """
+    Returns an image file, decoded in advance if the asset loader was asked for it, or loaded now otherwise.
+    :param name: the name of the image file in the textures folder
+    :return: an ImageWrapper object
+    """
+    future = pending_images.pop(name, None)
+    if future is not None:
+        return future.result()
+    return ImageWrapper(name)
+
 
 class ImageWrapper:
     """
@@ -12,8 +76,13 @@ class ImageWrapper:
     def __init__(self, name):
         # load the image from file using pyGame - any other image reading function could be used here.
         print('Loading image: texture/{}'.format(name))
+        self.name = name
         self.img = pygame.image.load('./textures/{}'.format(name))
 
+        # the pixel data already converted for OpenGL, and its mipmap levels, for each format
+        self.converted = {}
+        self.mip_chains = {}
+
     def width(self):
         return self.img.get_width()
 
@@ -22,17 +91,38 @@ class ImageWrapper:
 
     def data(self, format=GL_RGB):
         # convert the python image object to a plain byte array for passsing to OpenGL
-        if format == GL_RGBA:
-            return pygame.image.tostring(self.img, "RGBA", 1)
-        elif format == GL_RGB:
-            return pygame.image.tostring(self.img, "RGB", 1)
+        if format not in self.converted:
+            if format == GL_RGBA:
+                self.converted[format] = pygame.image.tostring(self.img, "RGBA", 1)
+            elif format == GL_RGB:
+                self.converted[format] = pygame.image.tostring(self.img, "RGB", 1)
+        return self.converted.get(format)
+
+    def mipmaps(self, format=GL_RGB):
+        """
+        Returns the mipmap levels of the image, computed on the CPU and stored in the texture cache.
+        :param format: [optional] the OpenGL pixel format, GL_RGB or GL_RGBA
+        :return: the list of uint8 arrays of shape (height, width, channels) of the levels 1 and below
+        """
+        if format not in self.mip_chains:
+            channels = 4 if format == GL_RGBA else 3
+            pixels = np.frombuffer(self.data(format), dtype=np.uint8).reshape(self.height(), self.width(), channels)
+            self.mip_chains[format] = TextureCache().mip_chain(self.name, pixels)
+        return self.mip_chains[format]
 
 
 class Texture:
     '''
     Class to handle texture loading.
     '''
-    def __init__(self, name, img=None, wrap=GL_REPEAT, sample=GL_NEAREST, format=GL_RGBA, type=GL_UNSIGNED_BYTE, target=GL_TEXTURE_2D):
+    # the defaults of the textures created without calling __init__, such as the cube maps
+    mipmaps = None
+    use_mipmaps = False
+    anisotropy = None
+    levels = 1
+    streaming = False
+
+    def __init__(self, name, img=None, wrap=GL_REPEAT, sample=GL_NEAREST, format=GL_RGBA, type=GL_UNSIGNED_BYTE, target=GL_TEXTURE_2D, stream=None, mipmaps=None, anisotropy=None):
         """
         Initialises the texture.
         :param name: The name of the texture file to load.
@@ -42,6 +132,11 @@ class Texture:
         :param format: [optional] The format of the texture.
         :param type: [optional] The type of the texture.
         :param target: [optional] The target of the texture.
+        :param stream: [optional] Whether to load the file in the background with the texture streamer, by default
+        if the streamer is enabled (see TextureStreamer).
+        :param mipmaps: [optional] How to build the mipmaps: 'gpu' with glGenerateMipmap, 'cpu' from the chain stored
+        in the texture cache (see textureCache.py), or None for no mipmaps.
+        :param anisotropy: [optional] The maximum anisotropy of the sampling, None for isotropic sampling.
         """
         self.name = name
         self.format = format
@@ -49,6 +144,23 @@ class Texture:
         self.wrap = wrap
         self.sample = sample
         self.target = target
+        self.mipmaps = mipmaps
+        self.use_mipmaps = mipmaps is not None
+        self.anisotropy = anisotropy
+
+        # whether the texture still shows the placeholder of the texture streamer
+        if stream is None:
+            stream = texture_streamer.enabled
+        self.streaming = stream and img is None and target == GL_TEXTURE_2D and type == GL_UNSIGNED_BYTE
+
+        # the parameters set while the texture shows the placeholder, applied when it is uploaded
+        self.parameters = {}
+
+        if self.streaming:
+            self.textureid = texture_streamer.placeholder()
+            print('* Streaming texture {}'.format('./textures/{}'.format(name)))
+            texture_streamer.request(self)
+            return
 
         self.textureid = glGenTextures(1)
 
@@ -57,45 +169,110 @@ class Texture:
         self.bind()
 
         if img is None:
-            img = ImageWrapper(name)
+            img = load_image(name)
+            self.width, self.height = img.width(), img.height()
 
             # load the texture in the buffer
             glTexImage2D(self.target, 0, format, img.width(), img.height(), 0, format, type, img.data(format))
+            self.generate_mipmaps(img)
         else:
-            # if a data array is provided use this
+            # if a data array is provided use this, its mipmaps are always generated by the GPU
+            self.width, self.height = img.shape[0], img.shape[1]
             glTexImage2D(self.target, 0, format, img.shape[0], img.shape[1], 0, format, type, img)
+            self.generate_mipmaps()
 
+        # set what happens for texture coordinates outside [0,1], and how sampling from the texture is done.
+        self.apply_sampling()
 
-        # set what happens for texture coordinates outside [0,1]
-        glTexParameteri(self.target, GL_TEXTURE_WRAP_S, wrap)
-        glTexParameteri(self.target, GL_TEXTURE_WRAP_T, wrap)
+        self.unbind()
 
-        # set how sampling from the texture is done.
-        glTexParameteri(self.target, GL_TEXTURE_MAG_FILTER, sample)
-        glTexParameteri(self.target, GL_TEXTURE_MIN_FILTER, sample)
+    def generate_mipmaps(self, img=None):
+        """
+        Builds the mipmap levels of the bound texture, once its level 0 is loaded.
+        :param img: [optional] the ImageWrapper of level 0, needed to upload the levels computed on the CPU
+        :return: None
+        """
+        if self.mipmaps is None:
+            return
 
-        self.unbind()
+        if self.mipmaps == 'cpu' and img is not None:
+            # the rows of the small levels are not aligned on 4 bytes
+            levels = img.mipmaps(self.format)
+            glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+            for level, pixels in enumerate(levels, start=1):
+                glTexImage2D(self.target, level, self.format, pixels.shape[1], pixels.shape[0], 0, self.format,
+                             self.type, pixels)
+            glPixelStorei(GL_UNPACK_ALIGNMENT, 4)
+            glTexParameteri(self.target, GL_TEXTURE_MAX_LEVEL, len(levels))
+            self.levels = len(levels) + 1
+        else:
+            glGenerateMipmap(self.target)
+            self.levels = int(np.log2(max(self.width, self.height, 1))) + 1
+
+    def min_filter(self):
+        """
+        Returns the minification filter of the texture, sampling the mipmaps if they are enabled and built.
+        :return: the value of GL_TEXTURE_MIN_FILTER
+        """
+        if self.use_mipmaps and self.levels > 1:
+            return MIPMAP_FILTERS.get(self.sample, self.sample)
+        return self.sample
+
+    def apply_sampling(self):
+        """
+        Sets the wrapping and sampling parameters of the bound texture from the attributes of this object.
+        :return: None
+        """
+        glTexParameteri(self.target, GL_TEXTURE_WRAP_S, self.wrap)
+        glTexParameteri(self.target, GL_TEXTURE_WRAP_T, self.wrap)
+        glTexParameteri(self.target, GL_TEXTURE_MAG_FILTER, self.sample)
+        glTexParameteri(self.target, GL_TEXTURE_MIN_FILTER, self.min_filter())
+
+        if anisotropy_limit() > 0:
+            anisotropy = 1.0 if self.anisotropy is None else min(self.anisotropy, anisotropy_limit())
+            glTexParameterf(self.target, GL_TEXTURE_MAX_ANISOTROPY_EXT, anisotropy)
 
     def set_shadow_comparison(self):
         self.set_parameter(GL_TEXTURE_COMPARE_MODE, GL_COMPARE_REF_TO_TEXTURE)
 
     def set_parameter(self, param, value):
+        # the placeholder of the streamed textures is shared, the parameter is set when the texture is uploaded
+        if self.streaming:
+            self.parameters[param] = value
+            return
+
         self.bind()
         glTexParameteri(self.target, param, value)
         self.unbind()
 
     def set_wrap_parameter(self, wrap=GL_REPEAT):
         self.wrap = wrap
+        if self.streaming:
+            return
         self.bind()
         glTexParameteri(self.target, GL_TEXTURE_WRAP_S, wrap)
         glTexParameteri(self.target, GL_TEXTURE_WRAP_T, wrap)
         self.unbind()
 
-    def set_sampling_parameter(self, sample=GL_NEAREST):
+    def set_sampling_parameter(self, sample=GL_NEAREST, use_mipmaps=None, anisotropy=None):
+        """
+        Changes the sampling of the texture, e.g. with one of the SAMPLING_PRESETS.
+        :param sample: [optional] the magnification filter, and the minification filter without mipmaps
+        :param use_mipmaps: [optional] whether to sample the mipmaps, if built, unchanged if None
+        :param anisotropy: [optional] the maximum anisotropy of the sampling, None for isotropic sampling
+        :return: None
+        """
         self.sample = sample
+        if use_mipmaps is not None:
+            self.use_mipmaps = use_mipmaps
+        self.anisotropy = anisotropy
+
+        # the placeholder of the streamed textures is shared, their sampling is set when they are uploaded
+        if self.streaming:
+            return
+
         self.bind()
-        glTexParameteri(self.target, GL_TEXTURE_MAG_FILTER, sample)
-        glTexParameteri(self.target, GL_TEXTURE_MIN_FILTER, sample)
+        self.apply_sampling()
         self.unbind()
 
     def set_data_from_image(self, data, width=None, height=None):
@@ -115,3 +292,313 @@ class Texture:
 
     def unbind(self):
         glBindTexture(self.target, 0)
+
+
+class StreamedImage:
+    """
+    The state of a texture being uploaded by the texture streamer.
+    """
+    def __init__(self, texture, image):
+        """
+        Initialises the upload.
+        :param texture: the Texture object, showing the placeholder until the upload is complete
+        :param image: the future of the decoded ImageWrapper
+        """
+        self.texture = texture
+        self.image = image
+
+        # the texture receiving the rows, created at the first slice
+        self.textureid = None
+        self.pixels = None
+        self.width = 0
+        self.height = 0
+        self.row_size = 0
+
+        # the number of rows already uploaded
+        self.rows = 0
+
+
+class TextureStreamer:
+    """
+    Loads textures in the background, so that loading large images does not block the first frames. The images
+    are decoded by a pool of threads, and their rows are uploaded through a ring of pixel buffer objects (PBO), mapped
+    once for all when the driver supports persistent mapping (OpenGL 4.4), so that the copy to the GPU runs
+    asynchronously. Until all their rows are uploaded, the textures show a shared 1x1 placeholder texture.
+    The uploads are done by update(), which must be called once per frame from the thread of the OpenGL context.
+    With a budget, each call uploads at most this number of bytes, so that streaming never stalls a frame.
+    """
+    def __init__(self, buffers=PBO_COUNT, buffer_size=PBO_SIZE, threads=None):
+        """
+        Initialises the streamer, disabled. The OpenGL objects are created at the first use.
+        :param buffers: [optional] the number of pixel buffer objects in the ring
+        :param buffer_size: [optional] the size in bytes of each pixel buffer object
+        :param threads: [optional] the number of threads decoding the images
+        """
+        self.enabled = False
+        self.budget = None
+        self.buffer_count = buffers
+        self.buffer_size = buffer_size
+        self.threads = threads
+
+        self.pool = None
+        self.placeholder_id = None
+
+        # the textures waiting for their image or being uploaded, in the order of the requests
+        self.queue = []
+
+        # the ring of pixel buffer objects: the fence signalled when the GPU has read each of them, the address of
+        # each one when it is persistently mapped, and the write position in the current one
+        self.pbos = None
+        self.fences = []
+        self.addresses = []
+        self.current = 0
+        self.offset = 0
+
+        # the number of bytes uploaded during the current frame, and during the last completed frame
+        self.uploaded = 0
+        self.last_frame = 0
+
+    def enable(self, budget=None):
+        """
+        Makes the textures created from now on stream their image, unless given stream=False.
+        :param budget: [optional] the maximum number of bytes uploaded per frame, None to upload the decoded images at once
+        :return: None
+        """
+        self.enabled = True
+        self.budget = budget
+
+    def placeholder(self):
+        """
+        Returns the texture shown in place of the textures being streamed.
+        :return: the OpenGL texture ID
+        """
+        if self.placeholder_id is None:
+            self.placeholder_id = glGenTextures(1)
+            glBindTexture(GL_TEXTURE_2D, self.placeholder_id)
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, 1, 1, 0, GL_RGBA, GL_UNSIGNED_BYTE,
+                         np.array(PLACEHOLDER_COLOR, dtype=np.uint8))
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            glBindTexture(GL_TEXTURE_2D, 0)
+        return self.placeholder_id
+
+    def request(self, texture):
+        """
+        Starts decoding the image of a texture, which is then uploaded by update().
+        :param texture: the Texture object
+        :return: None
+        """
+        # the image may already be decoded by the asset loader
+        image = pending_images.pop(texture.name, None)
+        if image is None:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.threads)
+            image = self.pool.submit(decode, texture.name, texture.format, texture.mipmaps)
+        self.queue.append(StreamedImage(texture, image))
+
+    def __len__(self):
+        return len(self.queue)
+
+    def create_buffers(self):
+        """
+        Creates the ring of pixel buffer objects, persistently mapped if the driver supports it.
+        :return: None
+        """
+        self.pbos = list(np.atleast_1d(glGenBuffers(self.buffer_count)))
+        self.fences = [None] * self.buffer_count
+        self.addresses = []
+
+        persistent = bool(glBufferStorage) and bool(glMapBufferRange)
+        for pbo in self.pbos:
+            glBindBuffer(GL_PIXEL_UNPACK_BUFFER, pbo)
+            if persistent:
+                flags = GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+                glBufferStorage(GL_PIXEL_UNPACK_BUFFER, self.buffer_size, None, flags)
+                pointer = glMapBufferRange(GL_PIXEL_UNPACK_BUFFER, 0, self.buffer_size, flags)
+                self.addresses.append(ctypes.cast(pointer, ctypes.c_void_p).value)
+            else:
+                glBufferData(GL_PIXEL_UNPACK_BUFFER, self.buffer_size, None, GL_STREAM_DRAW)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+
+        if not persistent:
+            self.addresses = None
+            print('(W) Warning: persistent buffer mapping is not supported, streaming textures with glBufferSubData')
+
+    def next_buffer(self):
+        """
+        Fences the current pixel buffer object, if it was written, and moves to the next one of the ring.
+        :return: None
+        """
+        if self.offset > 0:
+            self.fences[self.current] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+            self.current = (self.current + 1) % len(self.pbos)
+            self.offset = 0
+
+    def acquire(self, wait):
+        """
+        Checks that the GPU has finished reading the current pixel buffer object before writing to it again.
+        :param wait: whether to wait for the GPU if the buffer is still being read
+        :return: True if the buffer can be written
+        """
+        fence = self.fences[self.current]
+        if fence is None:
+            return True
+
+        timeout = 1000000000 if wait else 0
+        if glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, timeout) == GL_TIMEOUT_EXPIRED:
+            return False
+
+        glDeleteSync(fence)
+        self.fences[self.current] = None
+        return True
+
+    def upload(self, job, budget):
+        """
+        Copies rows of an image into the current pixel buffer object, and from there into the texture.
+        :param job: the StreamedImage
+        :param budget: the maximum number of bytes to upload, None for no limit
+        :return: the number of bytes uploaded
+        """
+        space = (self.buffer_size - self.offset) // job.row_size
+        rows = min(job.height - job.rows, space)
+        if budget is not None:
+            # at least one row is uploaded each frame, so that the upload progresses with a tiny budget
+            rows = min(rows, max(1, budget // job.row_size))
+        if rows <= 0:
+            return 0
+
+        start = job.rows * job.row_size
+        size = rows * job.row_size
+        if self.addresses is None:
+            glBufferSubData(GL_PIXEL_UNPACK_BUFFER, self.offset, size, job.pixels[start:start + size])
+        else:
+            ctypes.memmove(self.addresses[self.current] + self.offset, job.pixels[start:].ctypes.data, size)
+
+        glBindTexture(GL_TEXTURE_2D, job.textureid)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, job.rows, job.width, rows, job.texture.format, job.texture.type,
+                        ctypes.c_void_p(self.offset))
+
+        job.rows += rows
+        self.offset += size
+        return size
+
+    def start(self, job):
+        """
+        Allocates the texture receiving the rows of a decoded image.
+        :param job: the StreamedImage
+        :return: None
+        """
+        image = job.image.result()
+        job.width = image.width()
+        job.height = image.height()
+        job.pixels = np.frombuffer(image.data(job.texture.format), dtype=np.uint8)
+        job.row_size = job.pixels.shape[0] // job.height
+        if job.row_size > self.buffer_size:
+            raise ValueError('Texture {} is too wide to be streamed through {} bytes buffers'.format(
+                job.texture.name, self.buffer_size))
+
+        # with a pixel buffer object bound, the None data would be read as an offset in it
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        job.textureid = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, job.textureid)
+        glTexImage2D(GL_TEXTURE_2D, 0, job.texture.format, job.width, job.height, 0, job.texture.format,
+                     job.texture.type, None)
+
+    def finish(self, job):
+        """
+        Makes a texture show its uploaded image instead of the placeholder.
+        :param job: the StreamedImage
+        :return: None
+        """
+        texture = job.texture
+        texture.textureid = job.textureid
+        texture.width, texture.height = job.width, job.height
+        texture.streaming = False
+
+        # the mipmaps are built from the uploaded level 0, or uploaded directly when computed on the CPU, from client
+        # memory rather than from the pixel buffer object
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        glBindTexture(GL_TEXTURE_2D, job.textureid)
+        texture.generate_mipmaps(job.image.result())
+        texture.apply_sampling()
+        for param, value in texture.parameters.items():
+            glTexParameteri(GL_TEXTURE_2D, param, value)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        print('* Streamed texture {} ({}x{}) at ID {}'.format(texture.name, job.width, job.height, texture.textureid))
+
+    def update(self):
+        """
+        Uploads the decoded images, within the budget of bytes per frame. The textures are bound directly, so this
+        must be called before the render queue resets the tracked bindings (see RenderState).
+        :return: the number of textures completed
+        """
+        ready = [job for job in self.queue if job.textureid is not None or job.image.done()]
+        if len(ready) == 0:
+            return 0
+
+        if self.pbos is None:
+            self.create_buffers()
+
+        budget = self.budget
+        completed = 0
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        for job in ready:
+            if job.textureid is None:
+                self.start(job)
+
+            while job.rows < job.height and (budget is None or budget > 0):
+                if job.row_size > self.buffer_size - self.offset:
+                    self.next_buffer()
+
+                # without a budget, wait for the GPU rather than leave the image for the next frame
+                if not self.acquire(wait=budget is None):
+                    break
+                glBindBuffer(GL_PIXEL_UNPACK_BUFFER, self.pbos[self.current])
+
+                size = self.upload(job, budget)
+                self.uploaded += size
+                if budget is not None:
+                    budget -= size
+
+            if job.rows < job.height:
+                break
+
+            self.finish(job)
+            self.queue.remove(job)
+            completed += 1
+
+        # the next frame writes to the next buffer, the GPU reading this one in the meantime
+        self.next_buffer()
+
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 4)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        return completed
+
+    def end_frame(self):
+        """
+        Called once per frame to store the statistics of the frame and reset the counter.
+        :return: the number of bytes uploaded during the frame
+        """
+        self.last_frame = self.uploaded
+        self.uploaded = 0
+        return self.last_frame
+
+
+def decode(name, format, mipmaps=None):
+    """
+    Loads an image file and converts it to a pixel format, in a thread of the texture streamer.
+    :param name: the name of the image file in the textures folder
+    :param format: the OpenGL pixel format
+    :param mipmaps: [optional] the mipmaps option of the texture, the levels are prepared here if 'cpu'
+    :return: an ImageWrapper object
+    """
+    image = ImageWrapper(name)
+    image.data(format)
+    if mipmaps == 'cpu':
+        image.mipmaps(format)
+    return image
+
+
+# the streamer shared by all textures, enabled by the scenes loading large textures
+texture_streamer = TextureStreamer()
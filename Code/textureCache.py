@@ -0,0 +1,93 @@
+# Description: This file contains the TextureCache class, which stores the mipmap chains of the textures on disk.
+
+import os
+import re
+import threading
+import zipfile
+
+import numpy as np
+
+
+def generate_mip_chain(pixels):
+    """
+    Computes the mipmap levels of an image, each one averaging the 2x2 blocks of texels of the level above, down to
+    a single texel. The sizes of the levels are halved and rounded down, as OpenGL expects; the last row or column
+    of odd sized levels is dropped.
+    :param pixels: a uint8 array of shape (height, width, channels)
+    :return: the list of uint8 arrays of the levels 1 and below
+    """
+    levels = []
+    level = pixels.astype(np.float32)
+    while level.shape[0] > 1 or level.shape[1] > 1:
+        height, width = level.shape[0], level.shape[1]
+        if height > 1:
+            rows = height // 2 * 2
+            level = (level[0:rows:2] + level[1:rows:2]) / 2
+        if width > 1:
+            columns = width // 2 * 2
+            level = (level[:, 0:columns:2] + level[:, 1:columns:2]) / 2
+        levels.append(np.round(level).astype(np.uint8))
+
+    return levels
+
+
+class TextureCache:
+    """
+    Stores the mipmap chains computed on the CPU, so that the next runs read them instead of filtering the images
+    again. Each chain is one .npz file holding the levels and the size and modification time of the image file,
+    and is computed again when the image has changed.
+    """
+    def __init__(self, folder='cache/textures'):
+        """
+        Initialises the cache.
+        :param folder: [optional] the folder containing the cached chains
+        """
+        self.folder = folder
+
+    def entry(self, name, channels):
+        """
+        Returns the file storing the chain of an image.
+        :param name: the name of the image file in the textures folder
+        :param channels: the number of channels of the pixels
+        :return: the path of the .npz file
+        """
+        return os.path.join(self.folder, '{}_{}.npz'.format(re.sub(r'[^\w.-]', '_', name), channels))
+
+    def mip_chain(self, name, pixels):
+        """
+        Returns the mipmap levels of an image, from the cache if they are up to date, computing and storing them
+        otherwise.
+        :param name: the name of the image file in the textures folder
+        :param pixels: the uint8 array of shape (height, width, channels) of the image
+        :return: the list of uint8 arrays of the levels 1 and below
+        """
+        stat = os.stat('./textures/{}'.format(name))
+        signature = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        entry = self.entry(name, pixels.shape[2])
+
+        if os.path.isfile(entry):
+            try:
+                with np.load(entry) as data:
+                    if np.array_equal(data['signature'], signature):
+                        return [data['level{}'.format(i)] for i in range(1, int(data['levels']) + 1)]
+                print('(W) Mipmap cache for {} is out of date, rebuilding'.format(name))
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile) as error:
+                print('(W) Could not read mipmap cache for {}: {}'.format(name, error))
+
+        levels = generate_mip_chain(pixels)
+
+        # the chain is written next to its entry and then renamed, so that an interrupted run never leaves a partly
+        # written entry, the images being decoded by several threads
+        arrays = {'level{}'.format(i): level for i, level in enumerate(levels, start=1)}
+        temporary = '{}.{}.{}.tmp'.format(entry, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(temporary, 'wb') as file:
+                np.savez(file, signature=signature, levels=len(levels), **arrays)
+            os.replace(temporary, entry)
+        except OSError as error:
+            print('(W) Could not write mipmap cache for {}: {}'.format(name, error))
+            return levels
+        print('Stored {} mipmap levels of {} in cache'.format(len(levels), name))
+
+        return levels
@@ -0,0 +1,212 @@
+# Description: This file contains the VertexFormat class, which packs the vertex attributes of a mesh in one buffer.
+
+import numpy as np
+
+from OpenGL.GL import *
+
+from matutils import *
+
+# the encodings of the attribute components: the OpenGL type, and whether the integers are normalised to [-1, 1]
+# (or [0, 1] for unsigned types) when read by the shader.
+ENCODINGS = {
+    'float': (GL_FLOAT, False),
+    'half': (GL_HALF_FLOAT, False),
+    'short': (GL_SHORT, True),
+    'ubyte': (GL_UNSIGNED_BYTE, True),
+    'int_2_10_10_10': (GL_INT_2_10_10_10_REV, True),
+}
+
+
+class VertexFormat:
+    """
+    Describes how the vertex attributes of a mesh are stored in a single interleaved buffer: each vertex is one
+    row of the buffer, holding its attributes one after the other, each one aligned on 4 bytes. The attributes are
+    stored as 32 bits floats unless the format gives them another encoding:
+    - 'half': 16 bits floats,
+    - 'short': 16 bits integers, normalised to [-1, 1]. Positions are first centred on the mesh and scaled by its
+      largest extent, and the model matrix is multiplied by the inverse transform when drawing (see pack()),
+    - 'ubyte': 8 bits unsigned integers normalised to [0, 1], e.g. for colours,
+    - 'int_2_10_10_10': the three components of a unit vector packed in one signed 32 bits integer (10 bits each),
+      e.g. for normals and tangents.
+    """
+    def __init__(self, name, encodings={}):
+        """
+        Initialises the format.
+        :param name: the name of the format, for the messages
+        :param encodings: [optional] a dictionary giving the encoding of some attributes, e.g. {'normal': 'int_2_10_10_10'}
+        """
+        for attribute, encoding in encodings.items():
+            if encoding not in ENCODINGS:
+                raise ValueError('Unknown encoding {} for vertex attribute {}'.format(encoding, attribute))
+
+        self.name = name
+        self.encodings = dict(encodings)
+
+    def encoding(self, attribute):
+        """
+        Returns the encoding of an attribute.
+        :param attribute: the name of the attribute
+        :return: the name of the encoding
+        """
+        return self.encodings.get(attribute, 'float')
+
+    def size(self, attribute, components):
+        """
+        Returns the number of bytes taken by an attribute in each vertex, including its padding.
+        :param attribute: the name of the attribute
+        :param components: the number of components of the attribute
+        :return: the number of bytes
+        """
+        encoding = self.encoding(attribute)
+        if encoding == 'int_2_10_10_10':
+            return 4
+        nbytes = components * np.dtype(COMPONENT_TYPES[encoding]).itemsize
+        return (nbytes + 3) // 4 * 4
+
+    def stride(self, attributes):
+        """
+        Returns the number of bytes taken by each vertex.
+        :param attributes: a list of tuples (name, number of components) of the attributes stored
+        :return: the number of bytes
+        """
+        return sum(self.size(name, components) for name, components in attributes)
+
+    def pack(self, arrays):
+        """
+        Packs the vertex attributes in one interleaved array.
+        :param arrays: a list of tuples (name, data) with data an array of shape (vertices, components)
+        :return: a tuple (data, layout, stride, transform) with data the uint8 array of shape (vertices, stride)
+        to upload, layout a list of tuples (name, size, GL type, normalized, offset) to give to
+        glVertexAttribPointer, and transform the matrix to apply on the right of the model matrix to recover the
+        positions (None if the positions are not quantised)
+        """
+        n = arrays[0][1].shape[0]
+        stride = self.stride([(name, data.shape[1]) for name, data in arrays])
+
+        buffer = np.zeros((n, stride), dtype=np.uint8)
+        layout = []
+        transform = None
+        offset = 0
+        for name, data in arrays:
+            encoding = self.encoding(name)
+            gl_type, normalized = ENCODINGS[encoding]
+            components = data.shape[1]
+
+            if name == 'position' and encoding == 'short':
+                data, transform = quantise_positions(data)
+
+            packed = encode(np.asarray(data, dtype=np.float64), encoding)
+            size = self.size(name, components)
+            buffer[:, offset:offset + packed.shape[1]] = packed
+
+            # the packed vectors have a fourth component, ignored by the shaders reading them as vec3
+            if encoding == 'int_2_10_10_10':
+                components = 4
+            layout.append((name, components, gl_type, normalized, offset))
+            offset += size
+
+        return buffer, layout, stride, transform
+
+
+# the numpy type of the components of each encoding
+COMPONENT_TYPES = {
+    'float': '<f4',
+    'half': '<f2',
+    'short': '<i2',
+    'ubyte': 'u1',
+    'int_2_10_10_10': '<i4',
+}
+
+
+def encode(data, encoding):
+    """
+    Converts the components of a vertex attribute to an encoding.
+    :param data: an array of shape (vertices, components)
+    :param encoding: the name of the encoding
+    :return: the bytes of each vertex, as a uint8 array of shape (vertices, bytes)
+    """
+    if encoding == 'float' or encoding == 'half':
+        values = data.astype(COMPONENT_TYPES[encoding])
+    elif encoding == 'short':
+        values = np.round(np.clip(data, -1.0, 1.0) * 32767).astype(COMPONENT_TYPES[encoding])
+    elif encoding == 'ubyte':
+        values = np.round(np.clip(data, 0.0, 1.0) * 255).astype(COMPONENT_TYPES[encoding])
+    else:
+        # x in the lowest 10 bits, then y and z, the top 2 bits (w) are left to zero
+        fields = np.round(np.clip(data[:, :3], -1.0, 1.0) * 511).astype(np.int64) & 0x3FF
+        shifts = np.array([0, 10, 20])[:fields.shape[1]]
+        values = (fields << shifts).sum(axis=1, keepdims=True).astype(np.uint32).view(COMPONENT_TYPES[encoding])
+
+    return np.ascontiguousarray(values).view(np.uint8).reshape(data.shape[0], -1)
+
+
+def quantise_positions(vertices):
+    """
+    Maps the vertex positions into the cube [-1, 1]^3, with the same scale along all axes so that the normals
+    transformed by the inverse-transpose of the model matrix keep their direction.
+    :param vertices: the array of vertex positions
+    :return: a tuple (positions, transform) with the mapped positions, and the matrix mapping them back
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    if vertices.shape[0] == 0:
+        return vertices, poseMatrix()
+
+    low = vertices.min(axis=0)
+    high = vertices.max(axis=0)
+    center = (low + high) / 2
+    scale = max((high - low).max() / 2, 1e-12)
+
+    transform = np.matmul(translationMatrix(center), scaleMatrix([scale, scale, scale]))
+    return (vertices - center) / scale, transform
+
+
+# the same layout as the separate VBOs, all 32 bits floats, but in a single buffer
+FLOAT_FORMAT = VertexFormat('float')
+
+# unit vectors packed in 32 bits, texture coordinates and colours in 16 and 8 bits
+PACKED_FORMAT = VertexFormat('packed', {
+    'normal': 'int_2_10_10_10',
+    'tangent': 'int_2_10_10_10',
+    'binormal': 'int_2_10_10_10',
+    'texCoord': 'half',
+    'color': 'ubyte',
+})
+
+# PACKED_FORMAT, with the positions quantised to 16 bits integers
+COMPACT_FORMAT = VertexFormat('compact', dict(PACKED_FORMAT.encodings, position='short'))
+
+# PACKED_FORMAT, with the positions as 16 bits floats
+HALF_FORMAT = VertexFormat('half', dict(PACKED_FORMAT.encodings, position='half'))
+
+
+if __name__ == '__main__':
+    # memory report of the vertex formats on the shipped models: python vertexFormat.py
+    import glob
+
+    from blender import OBJ_RECORDS, has_texture_indices, parse_faces
+
+    formats = [FLOAT_FORMAT, PACKED_FORMAT, HALF_FORMAT, COMPACT_FORMAT]
+
+    print('{:35s} {:>9s} {:>12s}'.format('model', 'vertices', 'separate') + ''.join(
+        ' {:>12s}'.format(vertex_format.name) for vertex_format in formats))
+    totals = np.zeros(len(formats) + 1, dtype=np.int64)
+    for name in sorted(glob.glob('models/*.obj') + glob.glob('models/*.OBJ')):
+        with open(name, 'rb') as objfile:
+            data = objfile.read()
+
+        # the attributes of the meshes created by load_obj_file(): the normals are always computed, and the
+        # tangents and binormals when the faces give texture coordinates
+        nvertices = len(OBJ_RECORDS['vertex'].findall(data))
+        faces, _ = parse_faces(OBJ_RECORDS['face'].findall(data))
+        attributes = [('position', 3), ('normal', 3)]
+        if len(OBJ_RECORDS['vertex texture'].findall(data)) > 0 and has_texture_indices(faces):
+            attributes += [('texCoord', 2), ('tangent', 3), ('binormal', 3)]
+
+        strides = [4 * sum(components for _, components in attributes)]
+        strides += [vertex_format.stride(attributes) for vertex_format in formats]
+        totals += nvertices * np.array(strides)
+
+        print('{:35s} {:9d}'.format(name, nvertices) + ''.join(' {:12d}'.format(stride) for stride in strides))
+
+    print('{:35s} {:>9s}'.format('total (KiB)', '') + ''.join(' {:12.0f}'.format(total / 1024) for total in totals))
+    print('(bytes per vertex, "separate" is one float32 VBO per attribute)')